@@ -0,0 +1,84 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Peak RSS growth of building an attachment data URL, against attachment size.
+
+Each measurement runs in a fresh subprocess with an empty attachment cache.
+Peak RSS includes pages of memory mapped files, which are page cache and reclaimable,
+so the peak Python heap (bytes/str objects, via tracemalloc) is reported too.
+
+    python benchmarks/attachment_rss.py --size 16 --size 64 --size 256
+"""
+
+import base64
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import click
+
+MIB = 1024 * 1024
+
+
+def peak_rss() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def naive_data_url(path: str) -> str:
+    # The encoding chainchat used before attachments were streamed through the cache
+    with open(path, "rb") as f:
+        return f"data:application/pdf;base64,{base64.b64encode(f.read()).decode("utf-8")}"
+
+
+def chainchat_data_url(path: str) -> str:
+    from chainchat.attachment import Attachment
+
+    return Attachment(path, mimetype="application/pdf").data_url()
+
+
+MODES = {"naive": naive_data_url, "chainchat": chainchat_data_url}
+
+
+@click.command()
+@click.option("--size", "sizes", type=int, multiple=True, default=(16, 64, 256), help="Attachment size in MiB.")
+@click.option("--child", nargs=2, hidden=True)
+def main(sizes: tuple[int, ...], child: tuple[str, str] | None) -> None:
+    if child:
+        mode, path = child
+        import chainchat.attachment  # noqa: F401
+
+        before = peak_rss()
+        tracemalloc.start()
+        MODES[mode](path)
+        heap = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        click.echo(f"{peak_rss() - before} {heap}")
+        return
+
+    click.echo(f"{'size MiB':>10} {'mode':>10} {'RSS MiB':>10} {'x size':>8} {'heap MiB':>10} {'x size':>8}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "attachment.pdf")
+            with open(path, "wb") as f:
+                for _ in range(size):
+                    f.write(os.urandom(MIB))
+            for mode in MODES:
+                with tempfile.TemporaryDirectory() as cachedir:
+                    output = subprocess.run(  # noqa: S603
+                        [sys.executable, __file__, "--child", mode, path],
+                        env=os.environ | {"XDG_CACHE_HOME": cachedir},
+                        check=True,
+                        capture_output=True,
+                        text=True,
+                    ).stdout
+                rss, heap = (int(value) / MIB for value in output.split())
+                click.echo(f"{size:>10} {mode:>10} {rss:>10.1f} {rss / size:>8.2f} {heap:>10.1f} {heap / size:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Checkpoint database size and per turn write latency against conversation length,
+for langgraph's SqliteSaver (full history in every checkpoint) and chainchat's DeltaSqliteSaver.
+
+Each turn adds a human message and an AI response of --message-bytes to a conversation.
+
+    python benchmarks/checkpoints.py --turns 50 --turns 100 --turns 200
+"""
+
+import os
+import sqlite3
+import tempfile
+import time
+
+import click
+
+
+def savers():
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    from chainchat.conversation import DeltaSqliteSaver
+
+    return {"sqlite": SqliteSaver, "delta": DeltaSqliteSaver}
+
+
+def run(saver_class, path: str, turns: int, message_bytes: int) -> tuple[int, float, float]:
+    """Return database size, and mean milliseconds spent saving checkpoints per turn over the last 10 turns."""
+    from langchain_core.messages import AIMessage, HumanMessage
+    from langgraph.graph import START, MessagesState, StateGraph
+
+    config = {"configurable": {"thread_id": "benchmark"}}
+    response = "x" * message_bytes
+    graph = StateGraph(state_schema=MessagesState)
+    graph.add_edge(START, "respond")
+    graph.add_node("respond", lambda state: {"messages": [AIMessage(response)]})
+
+    with sqlite3.connect(path, check_same_thread=False) as conn:
+        saver = saver_class(conn)
+        put = saver.put
+        put_seconds = 0.0
+
+        def timed_put(*args, **kwargs):
+            nonlocal put_seconds
+            start = time.perf_counter()
+            try:
+                return put(*args, **kwargs)
+            finally:
+                put_seconds += time.perf_counter() - start
+
+        saver.put = timed_put
+        app = graph.compile(checkpointer=saver)
+        last = []
+        for turn in range(turns):
+            put_seconds = 0.0
+            start = time.perf_counter()
+            app.invoke({"messages": [HumanMessage(f"turn {turn}")]}, config)
+            if turn >= turns - 10:
+                last.append((put_seconds, time.perf_counter() - start))
+    n = len(last)
+    return os.path.getsize(path), sum(p for p, _ in last) / n * 1000, sum(t for _, t in last) / n * 1000
+
+
+@click.command()
+@click.option("--turns", "turns_list", type=int, multiple=True, default=(25, 50, 100, 200), help="Conversation turns.")
+@click.option("--message-bytes", type=int, default=2000, show_default=True, help="AI response size.")
+def main(turns_list: tuple[int, ...], message_bytes: int) -> None:
+    click.echo(f"{'turns':>6} {'saver':>8} {'DB KiB':>10} {'put ms/turn':>12} {'turn ms':>10}")
+    for turns in turns_list:
+        for name, saver_class in savers().items():
+            with tempfile.TemporaryDirectory() as tmpdir:
+                size, put_ms, turn_ms = run(saver_class, os.path.join(tmpdir, "checkpoint.db"), turns, message_bytes)
+            click.echo(f"{turns:>6} {name:>8} {size / 1024:>10.0f} {put_ms:>12.2f} {turn_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""CPU time per streamed token spent in chainchat itself, with no network.
+
+Recorded (tests/fixtures) and synthetic OpenAI SSE streams are replayed through
+ChatOpenAI and Chat.prompt, for a long response, many small chunks, a tool call loop
+and a large attachment. Stages are measured separately with time.process_time():
+
+    model       ChatOpenAI parsing the stream, the baseline everything else adds to
+    graph       Chat.prompt (stateless) minus model
+    checkpoint  Chat.prompt persisting the conversation to sqlite, minus stateless
+    text        render_text
+    markdown    render_markdown
+    trim        trim_messages over the conversation history, per history token
+
+Results are appended to a JSONL file and compared with the previous run stored there,
+so regressions between versions are visible.
+
+    python benchmarks/overhead.py --repeat 5 --label my-branch
+"""
+
+import contextlib
+import io
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable, Iterator
+from datetime import UTC, datetime
+from typing import Any
+
+import click
+
+FIXTURES = pathlib.Path(__file__).parent.parent / "tests" / "fixtures"
+DEFAULT_RESULTS = pathlib.Path(__file__).parent / "overhead-results.jsonl"
+STAGES = ("model", "graph", "checkpoint", "text", "markdown", "trim")
+WORDS = "the quick brown fox jumps over the lazy dog while **markdown** and `code` stream past".split()
+
+
+def sse_stream(contents: list[str]) -> list[bytes]:
+    """OpenAI chat completion SSE events streaming contents as separate chunks."""
+
+    def event(delta: dict[str, Any], finish_reason: str | None = None) -> bytes:
+        chunk = {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n".encode()
+
+    return [
+        event({"role": "assistant", "content": ""}),
+        *(event({"content": content}) for content in contents),
+        event({}, "stop"),
+        b"data: [DONE]\n\n",
+    ]
+
+
+def long_response(tokens: int) -> list[str]:
+    # Markdown paragraphs with a list every few paragraphs
+    contents = []
+    for i in range(tokens):
+        if i % 60 == 59:
+            contents.append("\n\n")
+        elif i % 240 == 239:
+            contents.append("\n\n- ")
+        else:
+            contents.append(f"{WORDS[i % len(WORDS)]} ")
+    return contents
+
+
+def small_chunks(tokens: int) -> list[str]:
+    text = "".join(long_response(tokens // 4 + 1))
+    return list(text[:tokens])
+
+
+class Scenario:
+    def __init__(
+        self,
+        name: str,
+        streams: Callable[[], list[list[bytes]]],
+        prompt: str = "Benchmark",
+        tools: bool = False,
+        attachment_mib: int = 0,
+    ):
+        self.name = name
+        self.streams = streams
+        self.prompt = prompt
+        self.tools = tools
+        self.attachment_mib = attachment_mib
+
+
+def synthetic(contents: list[str]) -> Callable[[], list[list[bytes]]]:
+    stream = sse_stream(contents)
+    return lambda: [stream]
+
+
+def recorded(*fixtures: str) -> Callable[[], list[list[bytes]]]:
+    from chainchat.trace import read_trace
+
+    streams = [[chunk for _, chunk in exchange.chunks] for f in fixtures for exchange in read_trace(FIXTURES / f)]
+    return lambda: streams
+
+
+def scenarios(tokens: int, attachment_mib: int) -> dict[str, Scenario]:
+    return {
+        scenario.name: scenario
+        for scenario in (
+            Scenario("long", synthetic(long_response(tokens))),
+            Scenario("small-chunks", synthetic(small_chunks(tokens * 4))),
+            Scenario(
+                "tools",
+                recorded("gpt-4o-mini-tool1.dat", "gpt-4o-mini-tool2.dat"),
+                prompt="Summarize the file ./simple.txt",
+                tools=True,
+            ),
+            Scenario("attachment", recorded("gpt-4o-mini-cutoff.dat"), attachment_mib=attachment_mib),
+        )
+    }
+
+
+class ReplayModel:
+    """ChatOpenAI answering every run with the same streams."""
+
+    def __init__(self, streams: list[list[bytes]]):
+        import httpx
+        from langchain_openai import ChatOpenAI
+
+        from chainchat.trace import Exchange, ReplayTransport
+
+        self.exchanges = [
+            Exchange(request={}, headers=[("Content-Type", "text/event-stream")], chunks=[(0, c) for c in stream])
+            for stream in streams
+        ]
+        self.transport = ReplayTransport()
+        self.model = ChatOpenAI(
+            model_name="gpt-4o-mini",
+            openai_api_key="XXX",
+            http_client=httpx.Client(transport=self.transport),
+            max_retries=0,
+        )
+
+    def __call__(self):
+        self.transport.exchanges.clear()
+        self.transport.exchanges.extend(self.exchanges)
+        return self.model
+
+
+def cpu_time(func: Callable[[], Any], repeat: int) -> float:
+    """Minimum CPU seconds of repeat runs, output discarded."""
+    best = float("inf")
+    for _ in range(repeat):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.process_time()
+            func()
+            best = min(best, time.process_time() - start)
+    return best
+
+
+def consume(chunks: Iterator[str]) -> str:
+    return "".join(chunks)
+
+
+def run_scenario(scenario: Scenario, repeat: int, workdir: pathlib.Path) -> dict[str, Any]:
+    from langchain_community.tools import ReadFileTool
+    from langchain_core.messages import AIMessage, HumanMessage, trim_messages
+
+    from chainchat import render
+    from chainchat.attachment import Attachment
+    from chainchat.chat import Chat
+
+    attachments = []
+    if scenario.attachment_mib:
+        path = workdir / f"attachment-{scenario.attachment_mib}.png"
+        if not path.exists():
+            path.write_bytes(os.urandom(scenario.attachment_mib * 1024 * 1024))
+        attachments.append(Attachment(str(path)))
+    tools = [ReadFileTool()] if scenario.tools else None
+    (workdir / "simple.txt").write_text("This is a test file.")
+
+    streams = scenario.streams()
+    replay_model = ReplayModel(streams)
+    runs = iter(range(sys.maxsize))
+
+    def prompt(**kwargs: Any) -> str:
+        chat = Chat(replay_model(), tools=tools, **kwargs)
+        return chat.prompt(scenario.prompt, consume, attachments)
+
+    # Content chunks streamed to the renderer, what "tokens" means here
+    chunks: list[str] = []
+    Chat(replay_model(), tools=tools, stateless=True).prompt(
+        scenario.prompt, lambda response: consume(chunks.append(c) or c for c in response), attachments
+    )
+    tokens = len(chunks)
+
+    def model_only() -> None:
+        model = replay_model()
+        for _ in streams:
+            for _ in model.stream(scenario.prompt):
+                pass
+
+    history = [
+        message for i in range(100) for message in (HumanMessage(f"{scenario.prompt} {i}"), AIMessage("".join(chunks)))
+    ]
+    history_tokens = sum(len(message.content) // 4 for message in history)
+
+    def trim() -> None:
+        trim_messages(
+            history,
+            max_tokens=history_tokens // 2,
+            strategy="last",
+            # The model's tiktoken counter downloads its encoding, so count approximately to stay offline
+            token_counter=lambda messages: sum(len(message.content) // 4 for message in messages),
+            include_system=True,
+            allow_partial=False,
+            start_on="human",
+        )
+
+    console_file = render.console.file
+    render.console.file = io.StringIO()
+    try:
+        model = cpu_time(model_only, repeat)
+        stateless = cpu_time(lambda: prompt(stateless=True), repeat)
+        persistent = cpu_time(lambda: prompt(conversation_id=f"benchmark-{scenario.name}-{next(runs)}"), repeat)
+        text = cpu_time(lambda: render.render_text(iter(chunks)), repeat)
+        markdown = cpu_time(lambda: render.render_markdown(iter(chunks)), repeat)
+        trimmed = cpu_time(trim, repeat)
+    finally:
+        render.console.file = console_file
+
+    return {
+        "tokens": tokens,
+        # Microseconds of CPU per token
+        "model": model / tokens * 1e6,
+        "graph": max(stateless - model, 0) / tokens * 1e6,
+        "checkpoint": max(persistent - stateless, 0) / tokens * 1e6,
+        "text": text / tokens * 1e6,
+        "markdown": markdown / tokens * 1e6,
+        "trim": trimmed / history_tokens * 1e6,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(  # noqa: S603
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            cwd=pathlib.Path(__file__).parent,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_run(results: pathlib.Path) -> dict[str, Any] | None:
+    if not results.exists():
+        return None
+    lines = results.read_text().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+@click.command()
+@click.option("--scenario", "names", multiple=True, help="Scenarios to run, default all.")
+@click.option("--tokens", type=int, default=2000, show_default=True, help="Synthetic response length in chunks.")
+@click.option("--attachment-mib", type=int, default=16, show_default=True, help="Attachment scenario size in MiB.")
+@click.option("--repeat", type=int, default=3, show_default=True, help="Runs per measurement, the fastest is kept.")
+@click.option(
+    "--results",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=DEFAULT_RESULTS,
+    show_default=True,
+    help="JSONL file results are appended to and compared with.",
+)
+@click.option("--label", help="Label for this run, default the git revision.")
+def main(
+    names: tuple[str, ...], tokens: int, attachment_mib: int, repeat: int, results: pathlib.Path, label: str | None
+) -> None:
+    results = results.resolve()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Keep conversations and the attachment cache out of the user's directories
+        os.environ["XDG_DATA_HOME"] = os.environ["XDG_CACHE_HOME"] = tmpdir
+        workdir = pathlib.Path(tmpdir)
+        os.chdir(workdir)
+        available = scenarios(tokens, attachment_mib)
+        measured = {name: run_scenario(available[name], repeat, workdir) for name in names or available}
+
+    previous = previous_run(results)
+    change = f", change from {previous['label']}" if previous else ""
+    click.echo(f"CPU microseconds per token{change}")
+    click.echo(f"{'scenario':>14} {'tokens':>7} " + " ".join(f"{stage:>17}" for stage in STAGES))
+    for name, stages in measured.items():
+        before = (previous or {}).get("scenarios", {}).get(name, {})
+        cells = []
+        for stage in STAGES:
+            cell = f"{stages[stage]:.2f}"
+            if before.get(stage):
+                cell += f" ({(stages[stage] - before[stage]) / before[stage]:+.0%})"
+            cells.append(f"{cell:>17}")
+        click.echo(f"{name:>14} {stages['tokens']:>7} " + " ".join(cells))
+
+    run = {
+        "label": label or git_revision() or "unknown",
+        "timestamp": datetime.now(UTC).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": measured,
+    }
+    with results.open("a") as f:
+        f.write(json.dumps(run) + "\n")
+
+
+if __name__ == "__main__":
+    main()
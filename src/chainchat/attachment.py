@@ -5,20 +5,31 @@ from __future__ import annotations
 
 import base64
 import enum
+import hashlib
 import mimetypes
+import mmap
+import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+import time
 from collections.abc import Sequence
-from functools import cached_property
-from typing import TYPE_CHECKING, Any
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, cached_property
+from typing import TYPE_CHECKING, Any, BinaryIO
 
 import click
-import httpx
-from langchain_core.messages.human import HumanMessage
+
+from .cache import attachments_execute, attachments_path, evict_attachments
 
 if TYPE_CHECKING:
     from langchain_core.prompts.chat import MessageLikeRepresentation
 
 mimetypes.init()
 
+MAX_ATTACHMENT_WORKERS = 16
+
 
 class AttachmentType(enum.StrEnum):
     ANTHROPIC = "anthropic"
@@ -27,6 +38,186 @@ class AttachmentType(enum.StrEnum):
     IMAGE_URL_BASE64 = "image_url_base64"
 
 
+# Types that can send a remote attachment as its URL, depending on its mimetype
+URL_ATTACHMENT_TYPES = (AttachmentType.OPENAI, AttachmentType.IMAGE_URL)
+
+
+# Multiple of 3 so chunks base64 encode without padding, and of the page size for madvise
+BASE64_CHUNK_SIZE = 3 * 1024 * 1024
+
+
+def encode_base64(source: pathlib.Path, destination: BinaryIO) -> None:
+    with open(source, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset in range(0, len(mm), BASE64_CHUNK_SIZE):
+                destination.write(base64.b64encode(mm[offset : offset + BASE64_CHUNK_SIZE]))
+                # Release encoded pages so resident memory stays bounded by the chunk size
+                if hasattr(mmap, "MADV_DONTNEED"):
+                    mm.madvise(mmap.MADV_DONTNEED, offset, min(BASE64_CHUNK_SIZE, len(mm) - offset))
+
+
+def data_url_prefix(mimetype: str) -> str:
+    return f"data:{mimetype};base64,"
+
+
+def read_data_url(path: pathlib.Path, mimetype: str | None = None) -> str:
+    """Read a cached data URL file, or just its base64 data if mimetype is None.
+
+    Strings are decoded straight from the mapped file, so no intermediate bytes copy is made.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+        data_offset = mm.find(b",") + 1
+        if mimetype is not None and view[:data_offset] == data_url_prefix(mimetype).encode():
+            return str(view, "ascii")
+        data = str(view[data_offset:], "ascii")
+    return data if mimetype is None else f"{data_url_prefix(mimetype)}{data}"
+
+
+# Digests of content handed out in this process, loaders are memoized so their files must not be evicted
+referenced_digests: set[str] = set()
+
+
+class CachedContent:
+    def __init__(self, digest: str, mimetype: str):
+        referenced_digests.add(digest)
+        self.digest = digest
+        self.mimetype = mimetype
+        self.data_urls: dict[str, str] = {}
+
+    @property
+    def path(self) -> pathlib.Path:
+        return attachments_path() / self.digest
+
+    @property
+    def data_url_path(self) -> pathlib.Path:
+        return attachments_path() / f"{self.digest}.url"
+
+    def content(self) -> bytes:
+        return self.path.read_bytes()
+
+    @cached_property
+    def base64_content(self) -> str:
+        return read_data_url(self.data_url_path)
+
+    def data_url(self, mimetype: str) -> str:
+        if mimetype not in self.data_urls:
+            self.data_urls[mimetype] = read_data_url(self.data_url_path, mimetype)
+        return self.data_urls[mimetype]
+
+
+def lookup_cached(cursor: sqlite3.Cursor, source: str, validator: str | None = None) -> sqlite3.Row | None:
+    row = cursor.execute("SELECT * FROM attachments WHERE source = :source", {"source": source}).fetchone()
+    if not row or (validator is not None and row["validator"] != validator):
+        return None
+    if not (attachments_path() / row["digest"]).exists():
+        return None
+    cursor.execute(
+        "UPDATE attachments SET accessed = :accessed WHERE source = :source",
+        {"accessed": time.time(), "source": source},
+    )
+    return row
+
+
+def store_cached(path: pathlib.Path, mimetype: str, digest: str | None = None, move: bool = False) -> CachedContent:
+    """Add the file at path to the cache, moving it into the cache if move is set."""
+    if digest is None:
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+    content = CachedContent(digest, mimetype)
+    if not content.path.exists():
+        # Stored as a complete data URL so it can be decoded into a single string
+        with tempfile.NamedTemporaryFile(dir=content.path.parent, delete=False) as f:
+            f.write(data_url_prefix(mimetype).encode())
+            encode_base64(path, f)
+        os.replace(f.name, content.data_url_path)
+        if move:
+            os.replace(path, content.path)
+        else:
+            with open(path, "rb") as src, tempfile.NamedTemporaryFile(dir=content.path.parent, delete=False) as f:
+                shutil.copyfileobj(src, f)
+            os.replace(f.name, content.path)
+    elif move:
+        path.unlink()
+    return content
+
+
+def record_cached(source: str, validator: str | None, content: CachedContent) -> None:
+    with attachments_execute() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO attachments VALUES(:source, :validator, :digest, :mimetype, :size, :accessed)",
+            {
+                "source": source,
+                "validator": validator,
+                "digest": content.digest,
+                "mimetype": content.mimetype,
+                "size": content.path.stat().st_size + content.data_url_path.stat().st_size,
+                "accessed": time.time(),
+            },
+        )
+        evict_attachments(cursor, keep=referenced_digests)
+
+
+@cache
+def load_local(path: str, mtime_ns: int, size: int) -> CachedContent:
+    validator = f"{mtime_ns}:{size}"
+    with attachments_execute() as cursor:
+        row = lookup_cached(cursor, path, validator)
+    if row:
+        return CachedContent(row["digest"], row["mimetype"])
+    content = store_cached(pathlib.Path(path), guess_mimetype(path))
+    record_cached(path, validator, content)
+    return content
+
+
+@cache
+def load_remote(url: str) -> CachedContent:
+    import httpx
+
+    from .httpclient import shared_client
+
+    with attachments_execute() as cursor:
+        row = lookup_cached(cursor, url)
+    # No transaction is held across the download, so attachments can load concurrently
+    headers = {}
+    if row and row["validator"]:
+        etag, _, last_modified = row["validator"].partition("\n")
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    with shared_client().stream("GET", url, headers=headers) as response:
+        if row and response.status_code == httpx.codes.NOT_MODIFIED:
+            return CachedContent(row["digest"], row["mimetype"])
+        response.raise_for_status()
+        # Download to a file, hashing as we go, so the content is never fully in memory
+        hasher = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=attachments_path(), delete=False) as f:
+            try:
+                for chunk in response.iter_bytes():
+                    hasher.update(chunk)
+                    f.write(chunk)
+            except BaseException:
+                os.unlink(f.name)
+                raise
+    content = store_cached(
+        pathlib.Path(f.name),
+        response.headers.get("content-type", "application/octet-stream"),
+        digest=hasher.hexdigest(),
+        move=True,
+    )
+    etag = response.headers.get("etag", "")
+    last_modified = response.headers.get("last-modified", "")
+    # Without a validator the content can't be revalidated, so it is only reused for this session
+    record_cached(url, f"{etag}\n{last_modified}" if etag or last_modified else None, content)
+    return content
+
+
+def guess_mimetype(url: str) -> str:
+    return mimetypes.guess_type(url, strict=False)[0] or "application/octet-stream"
+
+
 class Attachment:
     def __init__(
         self,
@@ -43,30 +234,39 @@ class Attachment:
         if self.mimetype:
             return self.mimetype
         if not self.is_local:
-            response = httpx.head(self.url)
+            if "cached_content" in self.__dict__ or self.attachment_type not in URL_ATTACHMENT_TYPES:
+                # Taken from the GET response headers, the content is cached so it is only fetched once
+                return self.cached_content.mimetype
+            from .httpclient import shared_client
+
+            # The URL itself is sent, so don't download the content just for its type
+            response = shared_client().head(self.url)
             response.raise_for_status()
             return response.headers.get("content-type", "application/octet-stream")
         else:
-            return mimetypes.guess_type(self.url, strict=False)[0] or "application/octet-stream"
+            return guess_mimetype(self.url)
 
     @cached_property
     def is_local(self) -> bool:
         return "://" not in self.url
 
-    def content(self) -> bytes:
+    @cached_property
+    def cached_content(self) -> CachedContent:
         if not self.is_local:
-            response = httpx.get(self.url)
-            response.raise_for_status()
-            return response.content
+            return load_remote(self.url)
         else:
-            with open(self.url, "rb") as f:
-                return f.read()
+            path = os.path.abspath(self.url)
+            stat = os.stat(path)
+            return load_local(path, stat.st_mtime_ns, stat.st_size)
+
+    def content(self) -> bytes:
+        return self.cached_content.content()
 
     def base64_content(self) -> str:
-        return base64.b64encode(self.content()).decode("utf-8")
+        return self.cached_content.base64_content
 
     def data_url(self) -> str:
-        return f"data:{self.resolved_mimetype};base64,{self.base64_content()}"
+        return self.cached_content.data_url(self.resolved_mimetype)
 
     def to_message_content(self) -> dict:
         # openai supports images, and audio using a different format - "input_audio"
@@ -144,9 +344,12 @@ def build_message_with_attachments(
 ) -> MessageLikeRepresentation:
     if not attachments:
         return prompt
-    return HumanMessage(
-        [
-            {"type": "text", "text": prompt},
-            *[attachment.to_message_content() for attachment in attachments],
-        ]
-    )
+    from langchain_core.messages.human import HumanMessage
+
+    if len(attachments) > 1:
+        # Fetch and encode attachments concurrently, remote fetches share the pooled client
+        with ThreadPoolExecutor(max_workers=min(len(attachments), MAX_ATTACHMENT_WORKERS)) as executor:
+            contents = list(executor.map(Attachment.to_message_content, attachments))
+    else:
+        contents = [attachments[0].to_message_content()]
+    return HumanMessage([{"type": "text", "text": prompt}, *contents])
@@ -0,0 +1,137 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from __future__ import annotations
+
+import asyncio
+import enum
+import json
+import time
+from collections import defaultdict
+from collections.abc import Callable, Iterable
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Any, TextIO
+
+from langchain_core.messages.ai import UsageMetadata, add_usage
+
+from .attachment import Attachment, AttachmentType, build_message_with_attachments
+
+if TYPE_CHECKING:
+    from .chat import Chat
+
+
+class Order(enum.StrEnum):
+    INPUT = "input"
+    COMPLETION = "completion"
+
+
+def parse_attachment(value: str | dict[str, str]) -> Attachment:
+    if isinstance(value, str):
+        return Attachment(value)
+    return Attachment(value["url"], AttachmentType(value.get("type", AttachmentType.IMAGE_URL)))
+
+
+class BatchRunner:
+    """Run JSONL prompts concurrently, writing a JSONL result for each.
+
+    Each input line is an object with a "prompt", and optional "id", "attachments" (urls/paths,
+    or objects with "url" and "type") and "conversation_id".
+    Prompts without a conversation_id run statelessly, prompts with one continue that stored conversation.
+    Prompts for the same conversation run one at a time.
+    """
+
+    def __init__(self, chat_factory: Callable[[bool], Chat], concurrency: int, order: Order = Order.INPUT):
+        self.chat_factory = chat_factory
+        self.chats: dict[bool, Chat] = {}
+        self.concurrency = concurrency
+        self.order = order
+        self.failures = 0
+        self.conversation_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    def chat(self, persistent: bool) -> Chat:
+        if persistent not in self.chats:
+            self.chats[persistent] = self.chat_factory(persistent)
+        return self.chats[persistent]
+
+    async def run(self, lines: Iterable[str], output: TextIO) -> None:
+        # In flight and buffered results are bounded by concurrency, slots are freed when a result is written
+        slots = asyncio.Semaphore(self.concurrency)
+        results: asyncio.Queue[tuple[int, dict[str, Any]] | None] = asyncio.Queue()
+
+        async def run_line(index: int, line: str) -> None:
+            results.put_nowait((index, await self.run_item(index, line)))
+
+        async def produce() -> None:
+            tasks: list[asyncio.Task] = []
+            iterator = iter(lines)
+            index = 0
+            # Read in a thread, input may be a pipe
+            try:
+                while (line := await asyncio.to_thread(next, iterator, None)) is not None:
+                    if not line.strip():
+                        continue
+                    await slots.acquire()
+                    tasks.append(asyncio.create_task(run_line(index, line)))
+                    index += 1
+            finally:
+                await asyncio.gather(*tasks)
+                results.put_nowait(None)
+
+        producer = asyncio.create_task(produce())
+        pending: dict[int, dict[str, Any]] = {}
+        next_index = 0
+        while (item := await results.get()) is not None:
+            index, result = item
+            pending[index] = result
+            if self.order is Order.COMPLETION:
+                ready = [index]
+            else:
+                ready = []
+                while next_index in pending:
+                    ready.append(next_index)
+                    next_index += 1
+            for index in ready:
+                output.write(json.dumps(pending.pop(index)) + "\n")
+                output.flush()
+                slots.release()
+        await producer
+
+    async def run_item(self, index: int, line: str) -> dict[str, Any]:
+        result: dict[str, Any] = {"index": index}
+        start = time.perf_counter()
+        try:
+            item = json.loads(line)
+            if not isinstance(item, dict) or not isinstance(item.get("prompt"), str):
+                raise ValueError("Expected an object with a prompt")
+            if "id" in item:
+                result["id"] = item["id"]
+            conversation_id = item.get("conversation_id")
+            if conversation_id is not None:
+                result["conversation_id"] = conversation_id
+            attachments = [parse_attachment(attachment) for attachment in item.get("attachments", [])]
+            # Attachments are fetched synchronously, keep that off the event loop
+            message = await asyncio.to_thread(build_message_with_attachments, item["prompt"], attachments)
+
+            chat = self.chat(conversation_id is not None)
+            text: list[str] = []
+            usage: UsageMetadata | None = None
+            async with self.conversation_locks[conversation_id] if conversation_id else nullcontext():
+                async for chunk in chat.astream_chunks([message], conversation_id):
+                    if isinstance(chunk.content, str):
+                        text.append(chunk.content)
+                    else:
+                        text.extend(
+                            part if isinstance(part, str) else part.get("text", "")
+                            for part in chunk.content
+                            if isinstance(part, str) or part.get("type") == "text"
+                        )
+                    if chunk.usage_metadata:
+                        usage = add_usage(usage, chunk.usage_metadata)
+            result["response"] = "".join(text)
+            result["input_tokens"] = usage["input_tokens"] if usage else None
+            result["output_tokens"] = usage["output_tokens"] if usage else None
+        except Exception as e:
+            self.failures += 1
+            result["error"] = f"{type(e).__name__}: {str(e)[:2048]}"
+        result["latency"] = time.perf_counter() - start
+        return result
@@ -1,11 +1,17 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import hashlib
+import json
+import os
 import pathlib
+import re
 import sqlite3
-from collections.abc import Iterator
+import sys
+from collections.abc import Container, Iterator
 from contextlib import AbstractContextManager, closing, contextmanager
-from importlib.metadata import version
+from functools import cache
+from typing import Literal
 
 import platformdirs
 
@@ -18,37 +24,108 @@ def db_path() -> pathlib.Path:
     return cache_path(ensure_exists=True) / "chainchat.db"
 
 
+ATTACHMENTS_MAX_BYTES = 512 * 1024 * 1024
+
+
+def attachments_path() -> pathlib.Path:
+    path = cache_path(ensure_exists=True) / "attachments"
+    path.mkdir(exist_ok=True)
+    return path
+
+
+# Bump when the models/tools index schema changes, the index is then rebuilt from scratch
+INDEX_VERSION = 6
+
+
+def migrate(connection: sqlite3.Connection) -> None:
+    if connection.execute("PRAGMA user_version").fetchone()[0] < INDEX_VERSION:
+        connection.executescript(
+            f"""
+            DROP TABLE IF EXISTS models;
+            DROP TABLE IF EXISTS tools;
+            DROP TABLE IF EXISTS tools_fts;
+            DROP TABLE IF EXISTS fingerprints;
+            PRAGMA user_version = {INDEX_VERSION};
+            """
+        )
+
+
 @contextmanager
-def execute(schema: str) -> Iterator[sqlite3.Cursor]:
-    connection = sqlite3.connect(db_path(), autocommit=False)
+def transaction(cursor: sqlite3.Cursor, immediate: bool) -> Iterator[None]:
+    # A deferred transaction upgrading its read lock fails at once while another connection commits,
+    # an immediate one takes the write lock up front and waits for it instead
+    cursor.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    cursor.execute("COMMIT")
+
+
+@contextmanager
+def execute(schema: str, immediate: bool = False) -> Iterator[sqlite3.Cursor]:
+    connection = sqlite3.connect(db_path(), autocommit=True)
     connection.row_factory = sqlite3.Row
-    with closing(connection):
-        with connection:
+    with closing(connection), closing(connection.cursor()) as cursor:
+        with transaction(cursor, immediate):
+            migrate(connection)
             connection.executescript(schema)
-        with connection, closing(connection.cursor()) as cursor:
+        with transaction(cursor, immediate):
             yield cursor
 
 
 def format_distributions_key(distributions: list[str]) -> str:
+    from importlib.metadata import version
+
     return ",".join(f"{distribution}-{version(distribution)}" for distribution in distributions)
 
 
+# options is the JSON serialized click option schema of the model command, so help renders without importing it
+MODELS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS models (
+        distributions TEXT, module TEXT, class TEXT, options TEXT, UNIQUE (distributions, module, class)
+    );
+    CREATE TABLE IF NOT EXISTS fingerprints (name TEXT PRIMARY KEY, fingerprint TEXT, distributions TEXT);
+"""
+
+# tools_fts is a full text index of tool names and descriptions, kept in sync with tools by triggers
+TOOLS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tools (
+        id INTEGER PRIMARY KEY,
+        distributions TEXT,
+        module TEXT,
+        class TEXT,
+        name TEXT,
+        description TEXT,
+        UNIQUE (distributions, module, class)
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS tools_fts USING fts5(
+        name, description, content='tools', content_rowid='id', tokenize='porter unicode61'
+    );
+    CREATE TRIGGER IF NOT EXISTS tools_fts_insert AFTER INSERT ON tools BEGIN
+        INSERT INTO tools_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS tools_fts_delete AFTER DELETE ON tools BEGIN
+        INSERT INTO tools_fts (tools_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END;
+    CREATE TABLE IF NOT EXISTS fingerprints (name TEXT PRIMARY KEY, fingerprint TEXT, distributions TEXT);
+"""
+
+INDEX_TABLES = ("models", "tools", "fingerprints")
+
+
 def models_execute() -> AbstractContextManager[sqlite3.Cursor]:
-    return execute(
-        """
-        CREATE TABLE IF NOT EXISTS models (distributions TEXT, module TEXT, class TEXT);
-        CREATE INDEX IF NOT EXISTS models_distributions_idx ON models (distributions);
-        """
-    )
+    return execute(MODELS_SCHEMA)
 
 
 def tools_execute() -> AbstractContextManager[sqlite3.Cursor]:
-    return execute(
-        """
-        CREATE TABLE IF NOT EXISTS tools (distributions TEXT, module TEXT, class TEXT, name TEXT, description TEXT);
-        CREATE INDEX IF NOT EXISTS tools_distributions_idx ON tools (distributions);
-        """
-    )
+    return execute(TOOLS_SCHEMA)
+
+
+def index_execute() -> AbstractContextManager[sqlite3.Cursor]:
+    return execute(MODELS_SCHEMA + TOOLS_SCHEMA)
 
 
 def distributions_cached(cursor: sqlite3.Cursor, table: str, distributions: str) -> bool:
@@ -60,3 +137,161 @@ def distributions_cached(cursor: sqlite3.Cursor, table: str, distributions: str)
         ).fetchone()[0]
         == 1
     )
+
+
+METADATA_SUFFIXES = (".dist-info", ".egg-info")
+SITE_DIRECTORIES = ("site-packages", "dist-packages")
+
+
+@cache
+def installed_fingerprint() -> str:
+    """Fingerprint installed distributions from the mtimes of site directories and their dist-info directories.
+
+    This is a single stat pass, much cheaper than scanning distribution metadata.
+    Other sys.path entries, like the current directory, don't install distributions and are left out
+    so changing them doesn't force a rescan.
+    """
+    stats: list[str] = []
+    for entry in sys.path:
+        if not entry or os.path.basename(os.path.normpath(entry)) not in SITE_DIRECTORIES:
+            continue
+        try:
+            stats.append(f"{entry}:{os.stat(entry).st_mtime_ns}")
+            with os.scandir(entry) as entries:
+                stats.extend(
+                    sorted(f"{e.name}:{e.stat().st_mtime_ns}" for e in entries if e.name.endswith(METADATA_SUFFIXES))
+                )
+        except OSError:
+            # Missing entry
+            continue
+    return hashlib.sha256("\n".join(stats).encode()).hexdigest()
+
+
+def fingerprinted_distributions(cursor: sqlite3.Cursor, name: str) -> list[str] | None:
+    """Return the distributions keys discovered for name if installed distributions haven't changed since."""
+    row = cursor.execute(
+        "SELECT distributions FROM fingerprints WHERE name = :name AND fingerprint = :fingerprint",
+        {"name": name, "fingerprint": installed_fingerprint()},
+    ).fetchone()
+    return json.loads(row["distributions"]) if row else None
+
+
+def update_fingerprint(cursor: sqlite3.Cursor, name: str, distributions_keys: list[str]) -> None:
+    cursor.execute(
+        "INSERT OR REPLACE INTO fingerprints VALUES(:name, :fingerprint, :distributions)",
+        {"name": name, "fingerprint": installed_fingerprint(), "distributions": json.dumps(distributions_keys)},
+    )
+
+
+def fts_query(text: str, operator: Literal["OR", "AND"] = "OR") -> str | None:
+    """Convert free text to an FTS5 query matching any (OR) or all (AND) of its words, or word prefixes."""
+    words = re.findall(r"\w+", text)
+    return f" {operator} ".join(f'"{word}"*' for word in words) if words else None
+
+
+def match_tools(
+    cursor: sqlite3.Cursor, distributions_keys: list[str], query: str, limit: int | None = None
+) -> list[sqlite3.Row]:
+    """Search tool names and descriptions, best matches first. Name matches rank above description matches."""
+    match = fts_query(query)
+    if match is None:
+        return []
+    placeholders = ",".join(["?"] * len(distributions_keys))
+    return cursor.execute(
+        f"""
+        SELECT tools.* FROM tools_fts JOIN tools ON tools.id = tools_fts.rowid
+        WHERE tools_fts MATCH ? AND tools.distributions IN ({placeholders})
+        ORDER BY bm25(tools_fts, 10.0, 1.0) LIMIT ?
+        """,  # noqa: S608
+        [match, *distributions_keys, -1 if limit is None else limit],
+    ).fetchall()
+
+
+def distributions_installed(distributions_key: str) -> bool:
+    """Return whether every distribution-version in the key matches the installed version."""
+    from importlib.metadata import PackageNotFoundError, version
+
+    for distribution in distributions_key.split(","):
+        name, _, distribution_version = distribution.rpartition("-")
+        try:
+            if version(name) != distribution_version:
+                return False
+        except (PackageNotFoundError, ValueError):
+            return False
+    return True
+
+
+def prune(cursor: sqlite3.Cursor, table: str) -> int:
+    """Delete rows for distributions that are no longer installed, and stale fingerprints.
+
+    Returns the number of rows deleted from table.
+    """
+    stale_keys = [
+        row["distributions"]
+        for row in cursor.execute(f"SELECT DISTINCT distributions FROM {table}").fetchall()  # noqa: S608
+        if not distributions_installed(row["distributions"])
+    ]
+    cursor.executemany(
+        f"DELETE FROM {table} WHERE distributions = ?",  # noqa: S608
+        ((distributions_key,) for distributions_key in stale_keys),
+    )
+    deleted = cursor.rowcount if stale_keys else 0
+    cursor.execute(
+        "DELETE FROM fingerprints WHERE fingerprint != :fingerprint", {"fingerprint": installed_fingerprint()}
+    )
+    return deleted
+
+
+def index_stats(cursor: sqlite3.Cursor, table: str) -> tuple[int, int, int]:
+    """Return the number of rows, distributions keys and stale distributions keys in table."""
+    rows = cursor.execute(f"SELECT count(*) FROM {table}").fetchone()[0]  # noqa: S608
+    distributions_keys = [
+        row["distributions"]
+        for row in cursor.execute(f"SELECT DISTINCT distributions FROM {table}").fetchall()  # noqa: S608
+    ]
+    stale = sum(not distributions_installed(distributions_key) for distributions_key in distributions_keys)
+    return rows, len(distributions_keys), stale
+
+
+def clear_index(cursor: sqlite3.Cursor) -> None:
+    for table in INDEX_TABLES:
+        cursor.execute(f"DELETE FROM {table}")  # noqa: S608
+
+
+def vacuum() -> tuple[int, int]:
+    """Compact the cache database, returns its size in bytes before and after."""
+    path = db_path()
+    before = path.stat().st_size if path.exists() else 0
+    # VACUUM can't run inside a transaction
+    with closing(sqlite3.connect(path, autocommit=True)) as connection:
+        connection.execute("VACUUM")
+    return before, path.stat().st_size
+
+
+def attachments_execute() -> AbstractContextManager[sqlite3.Cursor]:
+    # source is a URL or absolute path, validator the ETag/Last-Modified or mtime/size it was cached with.
+    # Content is stored once per digest, size is the on disk size of the raw and base64 files.
+    return execute(
+        """
+        CREATE TABLE IF NOT EXISTS attachments (
+            source TEXT PRIMARY KEY, validator TEXT, digest TEXT, mimetype TEXT, size INTEGER, accessed REAL
+        );
+        CREATE INDEX IF NOT EXISTS attachments_digest_idx ON attachments (digest);
+        """,
+        immediate=True,
+    )
+
+
+def evict_attachments(cursor: sqlite3.Cursor, keep: Container[str], max_bytes: int | None = None) -> None:
+    if max_bytes is None:
+        max_bytes = ATTACHMENTS_MAX_BYTES
+    total = 0
+    for row in cursor.execute(
+        "SELECT digest, MAX(accessed) AS accessed, MAX(size) AS size FROM attachments GROUP BY digest "
+        "ORDER BY accessed DESC"
+    ).fetchall():
+        total += row["size"]
+        if total > max_bytes and row["digest"] not in keep:
+            cursor.execute("DELETE FROM attachments WHERE digest = :digest", {"digest": row["digest"]})
+            for path in attachments_path().glob(f"{row["digest"]}*"):
+                path.unlink(missing_ok=True)
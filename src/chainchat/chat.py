@@ -2,10 +2,11 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 from __future__ import annotations
 
+import asyncio
 import enum
 import readline  # for input()  # noqa: F401
-import sqlite3
-from collections.abc import Callable, Generator, Iterator, Sequence
+import time
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Callable, Generator, Iterator, Sequence
 from typing import TYPE_CHECKING, Any
 
 import click
@@ -13,15 +14,26 @@ from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import AIMessage, HumanMessage, trim_messages
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableLambda
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.checkpoint.sqlite import SqliteSaver
 from langgraph.graph import START, MessagesState, StateGraph
-from langgraph.prebuilt import ToolNode, tools_condition
+from langgraph.prebuilt import tools_condition
 from rich.markdown import Markdown
 
 from .attachment import Attachment, AttachmentType, build_message_with_attachments
-from .conversation import checkpointer_path
+from .conversation import shared_checkpointer
+from .metrics import MetricsHandler
+from .ratelimit import (
+    RetryPolicy,
+    StreamedTokens,
+    StreamedTokensHandler,
+    TokenBucketRateLimiter,
+    UsageHandler,
+    streamed_tokens,
+)
 from .render import console
+from .tool import ConcurrentToolNode, bind_tools
 
 if TYPE_CHECKING:
     from langchain_core.prompts.chat import MessageLikeRepresentation
@@ -59,11 +71,27 @@ class Chat:
         tools: Sequence[BaseTool] | None = None,
         max_history_tokens: int | None = None,
         conversation_id: str | None = None,
+        tool_concurrency: int | None = None,
+        tool_timeout: float | None = None,
+        stateless: bool = False,
+        retry: RetryPolicy | None = None,
+        metrics: MetricsHandler | None = None,
     ):
+        callbacks: list[BaseCallbackHandler] = [ToolLoggingHandler()]
+        if metrics is not None:
+            callbacks.append(metrics)
+        self.rate_limiter = model.rate_limiter if isinstance(model.rate_limiter, TokenBucketRateLimiter) else None
+        if self.rate_limiter is not None:
+            callbacks.append(UsageHandler(self.rate_limiter))
+        # Only retried when configured, otherwise the provider SDK's own retries apply
+        self.retry = retry or (self.rate_limiter.retry if self.rate_limiter is not None else None)
+        if self.retry is not None:
+            callbacks.append(StreamedTokensHandler())
+
         if tools:
             tools_list = list(tools)
-            tools_node = ToolNode(tools_list)
-            tools_model = model.bind_tools(tools_list)
+            tools_node = ConcurrentToolNode(tools_list, max_concurrency=tool_concurrency, timeout=tool_timeout)
+            tools_model = bind_tools(model, tools_list)
         else:
             tools_model = None
             tools_node = None
@@ -88,25 +116,65 @@ class Chat:
 
         graph = StateGraph(state_schema=MessagesState)
         graph.add_edge(START, "agent")
-        graph.add_node("agent", self._run_chain)
+        graph.add_node("agent", RunnableLambda(self._run_chain, afunc=self._arun_chain, name="agent"))
         if tools_node:
             graph.add_conditional_edges("agent", tools_condition)
             graph.add_node("tools", tools_node)
             graph.add_edge("tools", "agent")
 
-        if conversation_id is not None:
-            # https://ricardoanderegg.com/posts/python-sqlite-thread-safety/
-            connection = sqlite3.connect(checkpointer_path(True), check_same_thread=sqlite3.threadsafety != 3)
-            checkpointer = SqliteSaver(connection)
+        checkpointer: BaseCheckpointSaver | None
+        if stateless:
+            # Each invocation is independent, nothing accumulates across them
+            checkpointer = None
+        elif conversation_id is not None:
+            checkpointer = shared_checkpointer()
         else:
             checkpointer = MemorySaver()
+        if metrics is not None and checkpointer is not None:
+            metrics.time_checkpointer(checkpointer)
         self.graph = graph.compile(checkpointer=checkpointer).with_config(
             {"configurable": {"thread_id": conversation_id or "1"}},
-            callbacks=[ToolLoggingHandler()],
+            callbacks=callbacks,
         )
 
+    def _retry_delay(self, attempt: int, error: Exception, streamed: StreamedTokens) -> float | None:
+        # Tokens already streamed to the renderer would be rendered again
+        if self.retry is None or streamed.count:
+            return None
+        delay = self.retry.delay(attempt, error)
+        if delay is not None and self.rate_limiter is not None:
+            self.rate_limiter.throttle(delay)
+        return delay
+
     def _run_chain(self, state: MessagesState) -> MessagesState:
-        return {"messages": [self.chain.invoke(state)]}
+        attempt = 0
+        while True:
+            attempt += 1
+            streamed = StreamedTokens()
+            token = streamed_tokens.set(streamed)
+            try:
+                return {"messages": [self.chain.invoke(state)]}
+            except Exception as e:
+                if (delay := self._retry_delay(attempt, e, streamed)) is None:
+                    raise
+            finally:
+                streamed_tokens.reset(token)
+            time.sleep(delay)
+
+    async def _arun_chain(self, state: MessagesState) -> MessagesState:
+        attempt = 0
+        while True:
+            attempt += 1
+            streamed = StreamedTokens()
+            token = streamed_tokens.set(streamed)
+            try:
+                return {"messages": [await self.chain.ainvoke(state)]}
+            except Exception as e:
+                if (delay := self._retry_delay(attempt, e, streamed)) is None:
+                    raise
+            finally:
+                streamed_tokens.reset(token)
+            await asyncio.sleep(delay)
 
     def stream(self, messages: Sequence[MessageLikeRepresentation]) -> Generator[str | list[str | dict], Any, None]:
         for chunk, _ in self.graph.stream(
@@ -117,6 +185,28 @@ class Chat:
             if isinstance(chunk, AIMessage) and chunk.content:  # Filter to just model responses
                 yield chunk.content
 
+    async def astream(
+        self, messages: Sequence[MessageLikeRepresentation]
+    ) -> AsyncGenerator[str | list[str | dict], None]:
+        async for chunk in self.astream_chunks(messages):
+            if chunk.content:
+                yield chunk.content
+
+    async def astream_chunks(
+        self, messages: Sequence[MessageLikeRepresentation], conversation_id: str | None = None
+    ) -> AsyncGenerator[AIMessage, None]:
+        """Stream model response chunks, including those with only usage metadata.
+        Models that don't stream yield their complete response as a single message.
+        conversation_id overrides the conversation the Chat was created with.
+        """
+        async for chunk, _ in self.graph.astream(
+            {"messages": messages},
+            {"configurable": {"thread_id": conversation_id}} if conversation_id is not None else None,
+            stream_mode="messages",
+        ):
+            if isinstance(chunk, AIMessage):  # Filter to just model responses
+                yield chunk
+
     def prompt(
         self,
         prompt: str,
@@ -125,6 +215,16 @@ class Chat:
     ) -> str:
         return renderer(self.stream(build_message_with_attachments(prompt, attachments)))
 
+    async def aprompt(
+        self,
+        prompt: str,
+        renderer: Callable[[AsyncIterator[str]], Awaitable[str]],
+        attachments: Sequence[Attachment] | None = None,
+    ) -> str:
+        # Attachments are fetched synchronously, keep that off the event loop
+        message = await asyncio.to_thread(build_message_with_attachments, prompt, attachments)
+        return await renderer(self.astream(message))
+
     def chat(self, renderer: Callable[[Iterator[str]], str], attachments: Sequence[Attachment] | None = None) -> None:
         console.print(f"[green]Chat - Ctrl-D or {Command.QUIT} to quit")
         console.print(f"[green]Enter {Command.MULTI} to enter/exit multiline mode, {Command.HELP} for more commands")
@@ -0,0 +1,76 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Checkpoint database access that doesn't need langgraph, so listing conversations starts quickly."""
+
+import datetime
+import enum
+import pathlib
+import sqlite3
+from contextlib import closing
+from typing import Any
+
+import platformdirs
+
+from .render import console
+
+# Seconds to wait for other processes to finish writing before failing with "database is locked"
+BUSY_TIMEOUT = 30
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Checkpoint database user_version, 1 once checkpoint messages are stored in the messages table,
+# 2 once conversations are summarized in the conversations table, 4 once message text is indexed in messages_fts
+# with the rowids of messages (3 indexed it with unrelated rowids)
+MESSAGES_VERSION = 1
+CONVERSATIONS_VERSION = 2
+MESSAGES_FTS_VERSION = 4
+
+
+class ConversationSort(enum.StrEnum):
+    UPDATED = "updated"
+    CREATED = "created"
+    MESSAGES = "messages"
+
+
+def checkpointer_path(ensure_exists: bool = False) -> pathlib.Path:
+    return platformdirs.user_data_path("chainchat", "rectalogic", ensure_exists=ensure_exists) / "checkpoint.db"
+
+
+def connect(path: pathlib.Path) -> sqlite3.Connection:
+    """Connect to a checkpoint database so several processes can use it at once."""
+    # https://ricardoanderegg.com/posts/python-sqlite-thread-safety/
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=sqlite3.threadsafety != 3)
+    # Lets vacuum free pages incrementally, only takes effect on new databases until they are vacuumed
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # Readers don't block the writer, and commits only sync the write ahead log at checkpoints
+    conn.execute("PRAGMA journal_mode = WAL").fetchall()
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}").fetchall()
+    return conn
+
+
+def list_conversations(
+    limit: int | None = None,
+    since: datetime.datetime | None = None,
+    sort: ConversationSort = ConversationSort.UPDATED,
+):
+    from rich.markdown import Markdown
+
+    query = "SELECT thread_id, title FROM conversations"
+    parameters: dict[str, Any] = {"limit": -1 if limit is None else limit}
+    if since is not None:
+        query += " WHERE updated >= :since"
+        # Checkpoint timestamps are UTC ISO format, naive datetimes are local time
+        parameters["since"] = since.astimezone(datetime.UTC).isoformat()
+    query += f" ORDER BY {sort} DESC LIMIT :limit"
+    with closing(connect(checkpointer_path(True))) as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < MESSAGES_FTS_VERSION:
+            # The conversations table is created and filled by migrating with the checkpointer
+            from .conversation import DeltaSqliteSaver
+
+            DeltaSqliteSaver(conn).setup()
+        for thread_id, title in conn.execute(query, parameters).fetchall():
+            if title:
+                if len(title) > 60:
+                    title = title[:60] + "\u2026"
+                console.print(f"[green]{thread_id}[/]: ", Markdown(title), end="")
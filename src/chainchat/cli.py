@@ -1,25 +1,37 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+from __future__ import annotations
+
+import functools
 import os
 from collections.abc import Callable, Iterator
-from typing import Any
+from typing import TYPE_CHECKING, Any, TextIO
 
 import click
-from dotenv import load_dotenv
-from langchain_core.language_models.chat_models import BaseChatModel
 
-from . import chat
-from .attachment import ATTACHMENT, Attachment, AttachmentType, attachment_type_callback
-from .conversation import list_conversations, show_conversation
+from .attachment import ATTACHMENT, AttachmentType, attachment_type_callback
 from .model import LazyModelGroup
-from .pipe import chainpipe
-from .render import render_markdown, render_text
-from .tool import create_tools, load_tool_descriptions
+from .render import DEFAULT_REFRESH_PER_SECOND
+
+if TYPE_CHECKING:
+    from datetime import datetime
+
+    from langchain_core.language_models.chat_models import BaseChatModel
+
+    from .attachment import Attachment
+    from .metrics import MetricsHandler
+
+# Modules pulling in langchain, langgraph, httpx etc. are imported by the commands that use them,
+# so startup stays fast for --help and commands that don't need them.
+
 
+def process_renderer(
+    markdown: bool, refresh_per_second: float = DEFAULT_REFRESH_PER_SECOND
+) -> Callable[[Iterator[str]], str]:
+    from .render import render_markdown, render_text
 
-def process_renderer(markdown: bool) -> Callable[[Iterator[str]], str]:
-    return render_markdown if markdown else render_text
+    return functools.partial(render_markdown, refresh_per_second=refresh_per_second) if markdown else render_text
 
 
 @click.group()
@@ -61,6 +73,8 @@ def cli(
     tool_discovery: tuple[str, ...],
     model_presets: str,
 ) -> None:
+    from dotenv import load_dotenv
+
     load_dotenv(dotenv)
     for alias, env_var in alias_env:
         if env_var in os.environ:
@@ -73,6 +87,12 @@ def cli(
 @cli.group("chat", cls=LazyModelGroup)
 @click.option("--system-message", "-s", help="System message.")
 @click.option("--tool", "-t", help="Enable specified tools, see 'list-tools'.", multiple=True)
+@click.option(
+    "--tool-concurrency",
+    type=click.IntRange(min=1),
+    help="Max tool calls from a single response to run concurrently.",
+)
+@click.option("--tool-timeout", type=click.FloatRange(min=0, min_open=True), help="Tool call timeout in seconds.")
 @click.option("--attachment", "-a", type=ATTACHMENT, help="Send attachment with prompt.", multiple=True)
 @click.option(
     "--attachment-type",
@@ -83,9 +103,23 @@ def cli(
     multiple=True,
 )
 @click.option("--markdown/--no-markdown", help="Render LLM responses as Markdown.", default=True)
+@click.option(
+    "--refresh-per-second",
+    type=float,
+    default=DEFAULT_REFRESH_PER_SECOND,
+    show_default=True,
+    help="Max Markdown display refreshes per second while streaming, 0 for every chunk.",
+)
 @click.option("--max-history-tokens", type=int, help="Max chat history tokens to keep.")
 @click.option("--prompt", help="Prompt text to send, if not specified enter interactive chat.")
 @click.option("--conversation-id", help="Persist conversation using id")
+@click.option(
+    "--stats",
+    type=click.Choice(["summary", "json", "openmetrics"]),
+    is_flag=False,
+    flag_value="summary",
+    help="Print latency, throughput, tool and checkpoint timings to stderr, as a summary, JSON or OpenMetrics.",
+)
 def chat_(*args: Any, **kwargs: Any) -> None:
     pass
 
@@ -97,37 +131,166 @@ def process_model_results(
     model: BaseChatModel,
     system_message: str | None,
     tool: tuple[str],
+    tool_concurrency: int | None,
+    tool_timeout: float | None,
     attachment: tuple[Attachment],
     attachment_type: tuple[Attachment],
     markdown: bool,
+    refresh_per_second: float,
     max_history_tokens: int | None,
     prompt: str | None,
     conversation_id: str | None,
+    stats: str | None,
 ) -> None:
+    from . import chat
+    from .metrics import MetricsHandler
+    from .tool import create_tools
+
     tool_discovery = ctx.parent.obj["tool_discovery"]
-    if prompt is not None:
-        chat.Chat(
-            model,
-            system_message=system_message,
-            tools=create_tools(tool, tool_discovery),
-            conversation_id=conversation_id,
-        ).prompt(prompt, process_renderer(markdown), attachment + attachment_type)
-    else:
-        chat.Chat(
+    metrics = MetricsHandler() if stats else None
+    try:
+        if prompt is not None:
+            chat.Chat(
+                model,
+                system_message=system_message,
+                tools=create_tools(tool, tool_discovery),
+                tool_concurrency=tool_concurrency,
+                tool_timeout=tool_timeout,
+                conversation_id=conversation_id,
+                metrics=metrics,
+            ).prompt(prompt, process_renderer(markdown, refresh_per_second), attachment + attachment_type)
+        else:
+            chat.Chat(
+                model,
+                system_message=system_message,
+                tools=create_tools(tool, tool_discovery),
+                tool_concurrency=tool_concurrency,
+                tool_timeout=tool_timeout,
+                max_history_tokens=max_history_tokens,
+                conversation_id=conversation_id,
+                metrics=metrics,
+            ).chat(process_renderer(markdown, refresh_per_second), attachment + attachment_type)
+    finally:
+        print_stats(metrics, stats)
+
+
+def print_stats(metrics: MetricsHandler | None, stats: str | None) -> None:
+    if metrics is not None and stats is not None:
+        from .metrics import StatsFormat
+
+        click.echo(metrics.format(StatsFormat(stats)), err=True)
+
+
+@cli.group(cls=LazyModelGroup, help="Run prompts from a JSONL file through a model, writing JSONL results.")
+@click.option("--system-message", "-s", help="System message.")
+@click.option("--tool", "-t", help="Enable specified tools, see 'list-tools'.", multiple=True)
+@click.option(
+    "--tool-concurrency",
+    type=click.IntRange(min=1),
+    help="Max tool calls from a single response to run concurrently.",
+)
+@click.option("--tool-timeout", type=click.FloatRange(min=0, min_open=True), help="Tool call timeout in seconds.")
+@click.option("--max-history-tokens", type=int, help="Max chat history tokens to keep.")
+@click.option(
+    "--input",
+    "-i",
+    "input_",
+    type=click.File("r"),
+    default="-",
+    show_default=True,
+    help="JSONL prompts, objects with prompt and optional id, attachments and conversation_id.",
+)
+@click.option("--output", "-o", type=click.File("w"), default="-", show_default=True, help="JSONL results.")
+@click.option(
+    "--concurrency",
+    "-c",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Max prompts to run concurrently.",
+)
+@click.option(
+    "--order",
+    type=click.Choice(["input", "completion"]),
+    default="input",
+    show_default=True,
+    help="Write results in input order, or as they complete.",
+)
+@click.option(
+    "--stats",
+    type=click.Choice(["summary", "json", "openmetrics"]),
+    is_flag=False,
+    flag_value="summary",
+    help="Print latency, throughput, tool and checkpoint timings to stderr, as a summary, JSON or OpenMetrics.",
+)
+def batch(*args: Any, **kwargs: Any) -> None:
+    pass
+
+
+@batch.result_callback()
+@click.pass_context
+def process_batch_results(
+    ctx: click.Context,
+    model: BaseChatModel,
+    system_message: str | None,
+    tool: tuple[str],
+    tool_concurrency: int | None,
+    tool_timeout: float | None,
+    max_history_tokens: int | None,
+    input_: TextIO,
+    output: TextIO,
+    concurrency: int,
+    order: str,
+    stats: str | None,
+) -> None:
+    import asyncio
+
+    from . import chat
+    from .batch import BatchRunner, Order
+    from .metrics import MetricsHandler
+    from .tool import create_tools
+
+    tools = create_tools(tool, ctx.parent.obj["tool_discovery"])
+    metrics = MetricsHandler() if stats else None
+
+    def chat_factory(persistent: bool) -> chat.Chat:
+        return chat.Chat(
             model,
             system_message=system_message,
-            tools=create_tools(tool, tool_discovery),
+            tools=tools,
+            tool_concurrency=tool_concurrency,
+            tool_timeout=tool_timeout,
             max_history_tokens=max_history_tokens,
-            conversation_id=conversation_id,
-        ).chat(process_renderer(markdown), attachment + attachment_type)
+            # Prompts pass their own conversation_id, this only selects persistent storage
+            conversation_id="batch" if persistent else None,
+            stateless=not persistent,
+            metrics=metrics,
+        )
+
+    runner = BatchRunner(chat_factory, concurrency, Order(order))
+    try:
+        asyncio.run(runner.run(input_, output))
+    finally:
+        print_stats(metrics, stats)
+    if runner.failures:
+        click.echo(f"{runner.failures} prompts failed", err=True)
+        ctx.exit(1)
 
 
 @cli.command(help="List available tools for tool-calling LLMs.")
 @click.option("--descriptions/--no-descriptions", default=False, help="Show tool descriptions.")
+@click.option("--search", "-s", metavar="QUERY", help="Only list tools matching words in QUERY, best matches first.")
 @click.pass_context
-def list_tools(ctx: click.Context, descriptions: bool) -> None:
-    tools = load_tool_descriptions(ctx.obj["tool_discovery"])
-    for tool_name in sorted(tools.keys()):
+def list_tools(ctx: click.Context, descriptions: bool, search: str | None) -> None:
+    from .tool import load_tool_descriptions, search_tools
+
+    if search is not None:
+        tools = {name: row["description"] for name, row in search_tools(ctx.obj["tool_discovery"], search).items()}
+        tool_names = list(tools.keys())
+    else:
+        tools = load_tool_descriptions(ctx.obj["tool_discovery"])
+        tool_names = sorted(tools.keys())
+    for tool_name in tool_names:
         if descriptions:
             click.echo(f"{tool_name}: {tools[tool_name]}")
         else:
@@ -169,6 +332,8 @@ def pipe_results(
 ) -> None:
     if len(models) != 2:
         raise click.UsageError("Must specify exactly two models to pipe chat.")
+    from .pipe import chainpipe
+
     chainpipe(
         prompt,
         models[0],
@@ -184,12 +349,121 @@ def conversations() -> None:
     pass
 
 
-@conversations.command("list", help="List conversations.")
-def list_() -> None:
-    list_conversations()
+@conversations.command("list", help="List conversations, most recent first.")
+@click.option("--limit", "-n", type=click.IntRange(min=0), help="Max conversations to list.")
+@click.option("--since", type=click.DateTime(), help="Only list conversations updated since this (local) time.")
+@click.option(
+    "--sort",
+    type=click.Choice(["updated", "created", "messages"]),
+    default="updated",
+    show_default=True,
+    help="Sort by last update, creation or message count.",
+)
+def list_(limit: int | None, since: datetime | None, sort: str) -> None:
+    from .checkpointdb import ConversationSort, list_conversations
+
+    list_conversations(limit, since, ConversationSort(sort))
+
+
+@conversations.command(help="Search conversation messages, listing the best matching conversations first.")
+@click.argument("query")
+@click.option("--limit", "-n", type=click.IntRange(min=1), default=20, show_default=True, help="Max conversations.")
+def search(query: str, limit: int) -> None:
+    from .conversation import search_conversations
+
+    search_conversations(query, limit)
 
 
 @conversations.command(help="Show the specified conversation.")
 @click.argument("conversation_id")
 def show(conversation_id: str) -> None:
+    from .conversation import show_conversation
+
     show_conversation(conversation_id)
+
+
+@conversations.command(help="Delete the specified conversations.")
+@click.argument("conversation_ids", metavar="CONVERSATION_ID...", nargs=-1, required=True)
+def delete(conversation_ids: tuple[str, ...]) -> None:
+    from .conversation import delete_conversations
+
+    click.echo(f"conversations: deleted {delete_conversations(conversation_ids)}")
+
+
+@conversations.command("prune", help="Delete old checkpoints and conversations.")
+@click.option("--latest-only", is_flag=True, help="Keep only the latest checkpoint of each conversation.")
+@click.option(
+    "--older-than", type=click.IntRange(min=0), metavar="DAYS", help="Delete conversations not updated for DAYS."
+)
+@click.option(
+    "--max-size",
+    type=click.IntRange(min=0),
+    metavar="MB",
+    help="Delete least recently updated conversations until the database uses at most MB.",
+)
+def prune_conversations_(latest_only: bool, older_than: int | None, max_size: int | None) -> None:
+    from datetime import timedelta
+
+    from .conversation import prune_conversations
+
+    if not latest_only and older_than is None and max_size is None:
+        raise click.UsageError("Specify at least one of --latest-only, --older-than or --max-size.")
+    prune_conversations(
+        latest_only,
+        None if older_than is None else timedelta(days=older_than),
+        None if max_size is None else max_size * 1024 * 1024,
+    )
+
+
+@conversations.command("vacuum", help="Compact the conversation database.")
+def vacuum_conversations_() -> None:
+    from .conversation import vacuum_conversations
+
+    before, after = vacuum_conversations()
+    click.echo(f"size: {before} -> {after} bytes")
+
+
+@cli.group("cache", help="Manage the model and tool discovery cache.")
+def cache_() -> None:
+    pass
+
+
+@cache_.command(help="Show discovery cache statistics.")
+def stats() -> None:
+    from .cache import db_path, index_execute, index_stats
+
+    with index_execute() as cursor:
+        for table in ("models", "tools"):
+            rows, distributions, stale = index_stats(cursor, table)
+            click.echo(f"{table}: {rows} rows, {distributions} distributions ({stale} stale)")
+    click.echo(f"size: {db_path().stat().st_size} bytes")
+
+
+@cache_.command("prune", help="Delete cached models and tools of distributions that are no longer installed.")
+def prune_() -> None:
+    from .cache import index_execute, prune
+
+    with index_execute() as cursor:
+        for table in ("models", "tools"):
+            click.echo(f"{table}: pruned {prune(cursor, table)} rows")
+
+
+@cache_.command("vacuum", help="Compact the cache database.")
+def vacuum_() -> None:
+    from .cache import vacuum
+
+    before, after = vacuum()
+    click.echo(f"size: {before} -> {after} bytes")
+
+
+@cache_.command(help="Clear and rediscover cached models and tools.")
+@click.pass_context
+def rebuild(ctx: click.Context) -> None:
+    from .cache import clear_index, index_execute
+    from .model import discover_models
+    from .tool import discover_tools
+
+    with index_execute() as cursor:
+        clear_index(cursor)
+    click.echo(f"models: {len(discover_models())}")
+    click.echo(f"tools: {len(discover_tools(ctx.obj['tool_discovery']))}")
@@ -1,36 +1,681 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import asyncio
+import atexit
+import datetime
+import itertools
+import json
 import pathlib
+import re
+import sqlite3
+import threading
+from collections.abc import AsyncIterator, Iterable, Iterator, Sequence
+from contextlib import closing, contextmanager, nullcontext
+from typing import Any
 
-import platformdirs
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
 from langgraph.checkpoint.sqlite import SqliteSaver
 from rich.markdown import Markdown
+from rich.text import Text
 
+from .cache import fts_query
+from .checkpointdb import (
+    CONVERSATIONS_VERSION,
+    MESSAGES_FTS_VERSION,
+    MESSAGES_VERSION,
+    checkpointer_path,
+    connect,
+)
 from .render import console
 
 
-def checkpointer_path(ensure_exists: bool = False) -> pathlib.Path:
-    return platformdirs.user_data_path("chainchat", "rectalogic", ensure_exists=ensure_exists) / "checkpoint.db"
+class ThreadedSqliteSaver(SqliteSaver):
+    """SqliteSaver that also supports async graphs by running its queries in a worker thread."""
 
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        return await asyncio.to_thread(self.get_tuple, config)
 
-def list_conversations():
-    with SqliteSaver.from_conn_string(checkpointer_path(True)) as checkpointer:
-        for row in checkpointer.conn.execute("SELECT DISTINCT thread_id from checkpoints").fetchall():
-            thread_id = row[0]
-            checkpoint = checkpointer.get({"configurable": {"thread_id": thread_id}})
-            messages = checkpoint.get("channel_values", {}).get("messages")
-            if messages and isinstance(messages[0], HumanMessage):
-                content = messages[0].content
-                if content:
-                    if len(content) > 60:
-                        content = content[:60] + "\u2026"
-                    console.print(f"[green]{thread_id}[/]: ", Markdown(content), end="")
+    async def alist(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,  # noqa: A002
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        checkpoints = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id)
+
+
+# Threads deleted or pruned per transaction, so a concurrently running chat is not locked out for long
+PRUNE_BATCH = 50
+# Pages freed per incremental vacuum step
+VACUUM_PAGES = 1024
+
+TITLE_LENGTH = 200
+
+
+def message_text(message: BaseMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(
+        part if isinstance(part, str) else part.get("text", "")
+        for part in message.content
+        if isinstance(part, str) or part.get("type") == "text"
+    )
+
+
+def conversation_title(messages: Sequence[BaseMessage]) -> str | None:
+    """Snippet of the first human message."""
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            return message_text(message)[:TITLE_LENGTH] or None
+    return None
+
+
+def conversation_model(messages: Sequence[BaseMessage]) -> str | None:
+    """Model of the last AI response."""
+    for message in reversed(messages):
+        if isinstance(message, AIMessage):
+            metadata = message.response_metadata
+            return metadata.get("model_name") or metadata.get("model")
+    return None
+
+
+def message_ranges(seqs: Sequence[int]) -> list[list[int]]:
+    """Compress message seqs into [start, end) ranges."""
+    ranges: list[list[int]] = []
+    for seq in seqs:
+        if ranges and ranges[-1][1] == seq:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([seq, seq + 1])
+    return ranges
+
+
+class DeltaSqliteSaver(ThreadedSqliteSaver):
+    """Checkpointer storing each conversation message once.
+
+    SqliteSaver serializes the full messages channel into every checkpoint, so a conversation
+    stores O(n²) message bytes. Here messages are appended to a messages table keyed by
+    (thread_id, checkpoint_ns, seq), and checkpoints store the ranges of seqs making up their
+    messages. Messages are rebuilt from the ranges when a checkpoint is read.
+    Databases written by SqliteSaver are migrated when first opened.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, **kwargs: Any):
+        super().__init__(conn, **kwargs)
+        # Messages and their seqs as of the last checkpoint put or got for each thread.
+        # Graphs pass the same message objects from step to step, so messages already stored are found by identity.
+        self.known_messages: dict[tuple[str, str], list[tuple[BaseMessage, int]]] = {}
+
+    def setup(self) -> None:
+        if self.is_setup:
+            return
+        super().setup()
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                seq INTEGER NOT NULL,
+                type TEXT,
+                value BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, seq)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoint_messages (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                ranges TEXT NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                thread_id TEXT PRIMARY KEY,
+                title TEXT,
+                created TEXT NOT NULL,
+                updated TEXT NOT NULL,
+                messages INTEGER NOT NULL,
+                model TEXT
+            );
+            CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+            CREATE INDEX IF NOT EXISTS conversations_created ON conversations (created);
+            -- Full text index of human and AI message text in top level conversations
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                text,
+                thread_id UNINDEXED,
+                seq UNINDEXED,
+                role UNINDEXED,
+                tokenize = 'porter unicode61'
+            );
+            """
+        )
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] >= MESSAGES_FTS_VERSION:
+            return
+        with self.conn:
+            # Take the write lock before checking again, so only one of several processes migrates the database
+            self.conn.execute("BEGIN IMMEDIATE")
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < MESSAGES_VERSION:
+                self.migrate()
+            if version < CONVERSATIONS_VERSION:
+                self.index_conversations()
+            if version < MESSAGES_FTS_VERSION:
+                self.index_messages()
+
+    def index_messages(self) -> None:
+        """Index the text of existing messages."""
+        self.conn.execute("DELETE FROM messages_fts")
+        rows = self.conn.execute("SELECT thread_id, seq, type, value FROM messages WHERE checkpoint_ns = ''")
+        self.index_message_text(
+            self.conn.cursor(),
+            ((thread_id, seq, self.serde.loads_typed((type_, value))) for thread_id, seq, type_, value in rows),
+        )
+        self.conn.execute(f"PRAGMA user_version = {MESSAGES_FTS_VERSION}")
+
+    @staticmethod
+    def index_message_text(cursor: sqlite3.Cursor, messages: Iterable[tuple[str, int, BaseMessage]]) -> None:
+        # Indexed with the rowid of the message, so index rows can be deleted along with their messages
+        cursor.executemany(
+            "INSERT INTO messages_fts (rowid, text, thread_id, seq, role) "
+            "SELECT rowid, ?, thread_id, seq, ? FROM messages WHERE thread_id = ? AND checkpoint_ns = '' AND seq = ?",
+            (
+                (text, message.type, thread_id, seq)
+                for thread_id, seq, message in messages
+                if isinstance(message, HumanMessage | AIMessage) and (text := message_text(message))
+            ),
+        )
+
+    def index_conversations(self) -> None:
+        """Summarize existing conversations from their first and latest checkpoints."""
+        for thread_id, first_id, last_id in self.conn.execute(
+            "SELECT thread_id, MIN(checkpoint_id), MAX(checkpoint_id) FROM checkpoints "
+            "WHERE checkpoint_ns = '' GROUP BY thread_id"
+        ).fetchall():
+            created = self.serde.loads_typed(self.checkpoint_blob(thread_id, first_id))["ts"]
+            last = self.load_messages(
+                CheckpointTuple(
+                    {"configurable": {"thread_id": thread_id, "checkpoint_ns": "", "checkpoint_id": last_id}},
+                    self.serde.loads_typed(self.checkpoint_blob(thread_id, last_id)),
+                    {},
+                ),
+                self.conn.cursor(),
+            ).checkpoint
+            self.update_conversation(
+                self.conn.cursor(), thread_id, last["channel_values"].get("messages") or [], last["ts"], created
+            )
+        self.conn.execute(f"PRAGMA user_version = {CONVERSATIONS_VERSION}")
+
+    def checkpoint_blob(self, thread_id: str, checkpoint_id: str) -> tuple[str, bytes]:
+        return self.conn.execute(
+            "SELECT type, checkpoint FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = '' AND checkpoint_id = ?",
+            (thread_id, checkpoint_id),
+        ).fetchone()
+
+    @staticmethod
+    def update_conversation(
+        cursor: sqlite3.Cursor,
+        thread_id: str,
+        messages: Sequence[BaseMessage],
+        updated: str,
+        created: str | None = None,
+    ) -> None:
+        cursor.execute(
+            """
+            INSERT INTO conversations (thread_id, title, created, updated, messages, model)
+            VALUES (:thread_id, :title, :created, :updated, :messages, :model)
+            ON CONFLICT (thread_id) DO UPDATE SET
+                title = COALESCE(conversations.title, excluded.title),
+                updated = excluded.updated,
+                messages = excluded.messages,
+                model = COALESCE(excluded.model, conversations.model)
+            """,
+            {
+                "thread_id": thread_id,
+                "title": conversation_title(messages),
+                "created": created or updated,
+                "updated": updated,
+                "messages": len(messages),
+                "model": conversation_model(messages),
+            },
+        )
+
+    def migrate(self) -> None:
+        """Move messages out of checkpoints written by SqliteSaver, storing messages shared by checkpoints once."""
+        keys = self.conn.execute(
+            """
+            SELECT thread_id, checkpoint_ns, checkpoint_id FROM checkpoints AS c
+            WHERE NOT EXISTS (
+                SELECT 1 FROM checkpoint_messages AS m
+                WHERE m.thread_id = c.thread_id AND m.checkpoint_ns = c.checkpoint_ns
+                    AND m.checkpoint_id = c.checkpoint_id
+            )
+            ORDER BY thread_id, checkpoint_ns, checkpoint_id
+            """
+        ).fetchall()
+        thread: tuple[str, str] | None = None
+        stored: dict[tuple[str, bytes], int] = {}
+        next_seq = 0
+        for thread_id, checkpoint_ns, checkpoint_id in keys:
+            if thread != (thread_id, checkpoint_ns):
+                thread = (thread_id, checkpoint_ns)
+                stored = {}
+                next_seq = self.next_seq(self.conn, thread_id, checkpoint_ns)
+            type_, value = self.conn.execute(
+                "SELECT type, checkpoint FROM checkpoints "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchone()
+            checkpoint = self.serde.loads_typed((type_, value))
+            messages = checkpoint["channel_values"].pop("messages", None)
+            if not isinstance(messages, list):
+                continue
+            seqs = []
+            for message in messages:
+                serialized = self.serde.dumps_typed(message)
+                if (seq := stored.get(serialized)) is None:
+                    seq = stored[serialized] = next_seq
+                    next_seq += 1
+                    self.conn.execute(
+                        "INSERT INTO messages (thread_id, checkpoint_ns, seq, type, value) VALUES (?, ?, ?, ?, ?)",
+                        (thread_id, checkpoint_ns, seq, *serialized),
+                    )
+                seqs.append(seq)
+            self.conn.execute(
+                "UPDATE checkpoints SET type = ?, checkpoint = ? "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (*self.serde.dumps_typed(checkpoint), thread_id, checkpoint_ns, checkpoint_id),
+            )
+            self.conn.execute(
+                "INSERT INTO checkpoint_messages (thread_id, checkpoint_ns, checkpoint_id, ranges) "
+                "VALUES (?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint_id, json.dumps(message_ranges(seqs))),
+            )
+        self.conn.execute(f"PRAGMA user_version = {MESSAGES_VERSION}")
+
+    @staticmethod
+    def next_seq(cursor: sqlite3.Cursor | sqlite3.Connection, thread_id: str, checkpoint_ns: str) -> int:
+        return cursor.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE thread_id = ? AND checkpoint_ns = ?",
+            (thread_id, checkpoint_ns),
+        ).fetchone()[0]
+
+    def load_messages(self, checkpoint_tuple: CheckpointTuple, cursor: sqlite3.Cursor | None = None) -> CheckpointTuple:
+        """Rebuild the messages of a checkpoint from its message ranges."""
+        configurable = checkpoint_tuple.config["configurable"]
+        thread_id, checkpoint_ns = str(configurable["thread_id"]), configurable.get("checkpoint_ns", "")
+        with nullcontext(cursor) if cursor is not None else self.cursor(transaction=False) as cur:
+            row = cur.execute(
+                "SELECT ranges FROM checkpoint_messages "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (thread_id, checkpoint_ns, configurable["checkpoint_id"]),
+            ).fetchone()
+            if row is None:
+                return checkpoint_tuple
+            # Only load messages not already known from the last checkpoint of the thread
+            loaded = {seq: message for message, seq in self.known_messages.get((thread_id, checkpoint_ns), [])}
+            seqs: list[int] = []
+            for start, end in json.loads(row[0]):
+                if not all(seq in loaded for seq in range(start, end)):
+                    for seq, type_, value in cur.execute(
+                        "SELECT seq, type, value FROM messages "
+                        "WHERE thread_id = ? AND checkpoint_ns = ? AND seq >= ? AND seq < ?",
+                        (thread_id, checkpoint_ns, start, end),
+                    ).fetchall():
+                        loaded[seq] = self.serde.loads_typed((type_, value))
+                seqs.extend(range(start, end))
+            messages = [loaded[seq] for seq in seqs]
+            self.known_messages[(thread_id, checkpoint_ns)] = list(zip(messages, seqs, strict=True))
+        checkpoint_tuple.checkpoint["channel_values"]["messages"] = messages
+        return checkpoint_tuple
+
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        checkpoint_tuple = super().get_tuple(config)
+        return None if checkpoint_tuple is None else self.load_messages(checkpoint_tuple)
+
+    def list(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,  # noqa: A002
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> Iterator[CheckpointTuple]:
+        # The base list holds the connection lock while iterating, so fetch the checkpoints before their messages
+        for checkpoint_tuple in list(super().list(config, filter=filter, before=before, limit=limit)):
+            yield self.load_messages(checkpoint_tuple)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        messages = checkpoint["channel_values"].get("messages")
+        if not isinstance(messages, list):
+            return super().put(config, checkpoint, metadata, new_versions)
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        stripped = {
+            **checkpoint,
+            "channel_values": {key: value for key, value in checkpoint["channel_values"].items() if key != "messages"},
+        }
+        type_, serialized_checkpoint = self.serde.dumps_typed(stripped)
+        serialized_metadata = self.jsonplus_serde.dumps(metadata)
+        with self.cursor() as cur:
+            known = self.known_messages.get((thread_id, checkpoint_ns), [])
+            common = 0
+            for (known_message, _), message in zip(known, messages, strict=False):
+                if known_message is not message:
+                    break
+                common += 1
+            seqs = [seq for _, seq in known[:common]]
+            if new_messages := messages[common:]:
+                next_seq = self.next_seq(cur, thread_id, checkpoint_ns)
+                cur.executemany(
+                    "INSERT INTO messages (thread_id, checkpoint_ns, seq, type, value) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (thread_id, checkpoint_ns, next_seq + i, *self.serde.dumps_typed(message))
+                        for i, message in enumerate(new_messages)
+                    ],
+                )
+                seqs.extend(range(next_seq, next_seq + len(new_messages)))
+                if checkpoint_ns == "":
+                    self.index_message_text(
+                        cur, ((thread_id, next_seq + i, message) for i, message in enumerate(new_messages))
+                    )
+            self.known_messages[(thread_id, checkpoint_ns)] = list(zip(messages, seqs, strict=True))
+            cur.execute(
+                "INSERT OR REPLACE INTO checkpoints "
+                "(thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    checkpoint["id"],
+                    config["configurable"].get("checkpoint_id"),
+                    type_,
+                    serialized_checkpoint,
+                    serialized_metadata,
+                ),
+            )
+            cur.execute(
+                "INSERT OR REPLACE INTO checkpoint_messages (thread_id, checkpoint_ns, checkpoint_id, ranges) "
+                "VALUES (?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], json.dumps(message_ranges(seqs))),
+            )
+            if checkpoint_ns == "":
+                self.update_conversation(cur, thread_id, messages, checkpoint["ts"])
+        return {
+            "configurable": {
+                "thread_id": config["configurable"]["thread_id"],
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def delete_threads(self, thread_ids: Iterable[str]) -> int:
+        """Delete conversations, returns the number deleted."""
+        deleted = 0
+        for batch in itertools.batched(thread_ids, PRUNE_BATCH):
+            threads = json.dumps(batch)
+            with self.cursor() as cur:
+                deleted += cur.execute(
+                    "SELECT count(DISTINCT thread_id) FROM checkpoints "
+                    "WHERE thread_id IN (SELECT value FROM json_each(?))",
+                    (threads,),
+                ).fetchone()[0]
+                cur.execute(
+                    "DELETE FROM messages_fts WHERE rowid IN "
+                    "(SELECT rowid FROM messages WHERE thread_id IN (SELECT value FROM json_each(?)))",
+                    (threads,),
+                )
+                for table in ("checkpoints", "writes", "checkpoint_messages", "messages", "conversations"):
+                    cur.execute(
+                        f"DELETE FROM {table} WHERE thread_id IN (SELECT value FROM json_each(?))",  # noqa: S608
+                        (threads,),
+                    )
+                for key in [key for key in self.known_messages if key[0] in batch]:
+                    del self.known_messages[key]
+        return deleted
+
+    def prune_checkpoints(self) -> int:
+        """Delete all but the latest checkpoint of each thread, and messages only deleted checkpoints used.
+        Returns the number of checkpoints deleted.
+        """
+        with self.cursor(transaction=False) as cur:
+            thread_ids = [row[0] for row in cur.execute("SELECT DISTINCT thread_id FROM checkpoints").fetchall()]
+        deleted = 0
+        for batch in itertools.batched(thread_ids, PRUNE_BATCH):
+            threads = json.dumps(batch)
+            with self.cursor() as cur:
+                cur.execute(
+                    """
+                    DELETE FROM checkpoints
+                    WHERE thread_id IN (SELECT value FROM json_each(:threads)) AND checkpoint_id < (
+                        SELECT MAX(checkpoint_id) FROM checkpoints AS latest
+                        WHERE latest.thread_id = checkpoints.thread_id
+                            AND latest.checkpoint_ns = checkpoints.checkpoint_ns
+                    )
+                    """,
+                    {"threads": threads},
+                )
+                deleted += cur.rowcount
+                for table in ("writes", "checkpoint_messages"):
+                    cur.execute(
+                        f"""
+                        DELETE FROM {table}
+                        WHERE thread_id IN (SELECT value FROM json_each(:threads)) AND NOT EXISTS (
+                            SELECT 1 FROM checkpoints AS c
+                            WHERE c.thread_id = {table}.thread_id AND c.checkpoint_ns = {table}.checkpoint_ns
+                                AND c.checkpoint_id = {table}.checkpoint_id
+                        )
+                        """,  # noqa: S608
+                        {"threads": threads},
+                    )
+                self.delete_unreferenced_messages(cur, threads)
+        return deleted
+
+    @staticmethod
+    def delete_unreferenced_messages(cursor: sqlite3.Cursor, threads: str) -> None:
+        """Delete messages of the JSON array of threads no longer referenced by any checkpoint."""
+        referenced: dict[tuple[str, str], set[int]] = {}
+        for thread_id, checkpoint_ns, ranges in cursor.execute(
+            "SELECT thread_id, checkpoint_ns, ranges FROM checkpoint_messages "
+            "WHERE thread_id IN (SELECT value FROM json_each(?))",
+            (threads,),
+        ).fetchall():
+            seqs = referenced.setdefault((thread_id, checkpoint_ns), set())
+            for start, end in json.loads(ranges):
+                seqs.update(range(start, end))
+        for thread_id, checkpoint_ns in cursor.execute(
+            "SELECT DISTINCT thread_id, checkpoint_ns FROM messages "
+            "WHERE thread_id IN (SELECT value FROM json_each(?))",
+            (threads,),
+        ).fetchall():
+            # Keep the last message, so seqs are not reused by a chat still holding messages it expects stored
+            unreferenced = (
+                "SELECT rowid FROM messages WHERE thread_id = :thread_id AND checkpoint_ns = :checkpoint_ns "
+                "AND seq NOT IN (SELECT value FROM json_each(:seqs)) AND seq < ("
+                "SELECT MAX(seq) FROM messages WHERE thread_id = :thread_id AND checkpoint_ns = :checkpoint_ns)"
+            )
+            parameters = {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "seqs": json.dumps(sorted(referenced.get((thread_id, checkpoint_ns), ()))),
+            }
+            cursor.execute(f"DELETE FROM messages_fts WHERE rowid IN ({unreferenced})", parameters)  # noqa: S608
+            cursor.execute(f"DELETE FROM messages WHERE rowid IN ({unreferenced})", parameters)  # noqa: S608
+
+    # Annotated as Sequence, list in the class namespace is the list method
+    def expired_threads(self, updated_before: datetime.datetime) -> Sequence[str]:
+        with self.cursor(transaction=False) as cur:
+            return [
+                row[0]
+                for row in cur.execute(
+                    "SELECT thread_id FROM conversations WHERE updated < ?",
+                    (updated_before.astimezone(datetime.UTC).isoformat(),),
+                ).fetchall()
+            ]
+
+    def used_bytes(self) -> int:
+        """Size of the pages in use, excluding free pages a vacuum would release."""
+        with self.cursor(transaction=False) as cur:
+            page_count = cur.execute("PRAGMA page_count").fetchone()[0]
+            freelist_count = cur.execute("PRAGMA freelist_count").fetchone()[0]
+            page_size = cur.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def prune_to_size(self, max_bytes: int) -> int:
+        """Delete the least recently updated conversations until the database uses at most max_bytes.
+        Returns the number deleted.
+        """
+        deleted = 0
+        while self.used_bytes() > max_bytes:
+            with self.cursor(transaction=False) as cur:
+                oldest = [
+                    row[0]
+                    for row in cur.execute(
+                        "SELECT thread_id FROM conversations ORDER BY updated LIMIT ?", (PRUNE_BATCH,)
+                    ).fetchall()
+                ]
+            if not oldest:
+                break
+            # Measure after each one, so no more than needed are deleted. Freed pages aren't counted,
+            # so no vacuum is needed to see the size drop
+            for thread_id in oldest:
+                deleted += self.delete_threads([thread_id])
+                if self.used_bytes() <= max_bytes:
+                    return deleted
+        return deleted
+
+    def vacuum(self) -> None:
+        """Release free pages to the filesystem, a few at a time so a running chat is not blocked for long.
+        The first vacuum of a database created before incremental vacuuming was enabled is a full VACUUM.
+        """
+        with self.cursor() as cur:
+            incremental = cur.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        if not incremental:
+            with self.lock:
+                self.conn.execute("VACUUM")
+        else:
+            while True:
+                with self.cursor() as cur:
+                    if cur.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                        break
+                    cur.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+        with self.cursor() as cur:
+            # Shrink the write ahead log too
+            cur.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+# Process wide checkpoint database connections by path, with the lock serializing their transactions
+connections: dict[pathlib.Path, tuple[sqlite3.Connection, threading.Lock]] = {}
+connections_lock = threading.Lock()
+
+
+def shared_checkpointer() -> DeltaSqliteSaver:
+    """Checkpointer using the process wide connection to the checkpoint database."""
+    path = checkpointer_path(True)
+    # Chats created on several threads at once must not each open a connection
+    with connections_lock:
+        if path not in connections:
+            connections[path] = (connect(path), threading.Lock())
+        conn, lock = connections[path]
+    checkpointer = DeltaSqliteSaver(conn)
+    checkpointer.lock = lock
+    return checkpointer
+
+
+@atexit.register
+def close_connections() -> None:
+    with connections_lock:
+        while connections:
+            _, (conn, lock) = connections.popitem()
+            with lock:
+                conn.close()
+
+
+@contextmanager
+def open_checkpointer() -> Iterator[DeltaSqliteSaver]:
+    with closing(connect(checkpointer_path(True))) as conn:
+        yield DeltaSqliteSaver(conn)
+
+
+def search_conversations(query: str, limit: int | None = None):
+    """Print the best matching message snippet of conversations with messages matching all words of query,
+    best matches first.
+    """
+    match = fts_query(query, "AND")
+    if match is None:
+        return
+    threads: set[str] = set()
+    with open_checkpointer() as checkpointer, checkpointer.cursor(transaction=False) as cursor:
+        for thread_id, snippet in cursor.execute(
+            # \x02 and \x03 delimit matches in the snippet
+            "SELECT thread_id, snippet(messages_fts, 0, char(2), char(3), '\u2026', 16) FROM messages_fts "
+            "WHERE messages_fts MATCH ? ORDER BY rank",
+            (match,),
+        ):
+            if thread_id in threads:
+                continue
+            threads.add(thread_id)
+            text = Text.assemble((f"{thread_id}", "green"), ": ")
+            for i, part in enumerate(re.split("[\x02\x03]", " ".join(snippet.split()))):
+                text.append(part, style="bold yellow" if i % 2 else None)
+            console.print(text)
+            if limit is not None and len(threads) >= limit:
+                break
+
+
+def delete_conversations(thread_ids: Sequence[str]) -> int:
+    with open_checkpointer() as checkpointer:
+        return checkpointer.delete_threads(thread_ids)
+
+
+def prune_conversations(
+    latest_only: bool = False, older_than: datetime.timedelta | None = None, max_bytes: int | None = None
+) -> None:
+    with open_checkpointer() as checkpointer:
+        if older_than is not None:
+            expired = checkpointer.expired_threads(datetime.datetime.now(datetime.UTC) - older_than)
+            console.print(f"conversations: deleted {checkpointer.delete_threads(expired)} not updated recently")
+        if latest_only:
+            console.print(f"checkpoints: deleted {checkpointer.prune_checkpoints()} older checkpoints")
+        if max_bytes is not None:
+            console.print(f"conversations: deleted {checkpointer.prune_to_size(max_bytes)} to fit size")
+
+
+def vacuum_conversations() -> tuple[int, int]:
+    """Compact the checkpoint database, returns its size in bytes before and after."""
+    path = checkpointer_path(True)
+    before = path.stat().st_size if path.exists() else 0
+    with open_checkpointer() as checkpointer:
+        checkpointer.vacuum()
+    return before, path.stat().st_size
 
 
 def show_conversation(thread_id: str):
-    with SqliteSaver.from_conn_string(checkpointer_path(True)) as checkpointer:
+    with open_checkpointer() as checkpointer:
         checkpoint = checkpointer.get({"configurable": {"thread_id": thread_id}})
         if not checkpoint:
             return
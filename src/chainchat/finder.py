@@ -1,11 +1,21 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import ast
 import inspect
-from collections.abc import Generator, Mapping
+import os
+import pathlib
+from collections.abc import Callable, Generator, Iterable, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
 from functools import cache
 from importlib import import_module, metadata
+from importlib.util import find_spec
 from types import ModuleType
+from typing import Any
+
+import click
 
 
 @cache
@@ -28,3 +38,300 @@ def find_package_classes[T](package: str | ModuleType, base_class: type[T]) -> G
         for _, cls in inspect.getmembers(module, inspect.isclass):
             if issubclass(cls, base_class):
                 yield cls
+
+
+# A class is referenced by its defining module and name
+type ClassRef = tuple[str, str]
+
+# Field default that isn't a literal, so can only be read by importing the class
+NONLITERAL = object()
+# Field without a default
+MISSING = object()
+
+
+@dataclass
+class ModuleSource:
+    name: str
+    is_package: bool
+    classes: dict[str, ast.ClassDef] = field(default_factory=dict)
+    # Names imported with from imports, name -> (module, name)
+    imports: dict[str, ClassRef] = field(default_factory=dict)
+    # Modules imported with import statements, alias -> module
+    modules: dict[str, str] = field(default_factory=dict)
+    # Lazily imported names from a _module_lookup table, name -> module
+    lazy: dict[str, str] = field(default_factory=dict)
+    all: list[str] | None = None
+
+
+class StaticFinder:
+    """Find classes in a package by parsing its source, without importing it.
+
+    Exported names are followed through __all__, imports and _module_lookup lazy import tables
+    to the modules defining them, and class inheritance is resolved the same way.
+    """
+
+    MAX_DEPTH = 32
+
+    def __init__(self):
+        self.sources: dict[str, ModuleSource | None] = {}
+        self.subclasses: dict[tuple[ClassRef, ClassRef], bool] = {}
+
+    def module_path(self, module: str) -> tuple[pathlib.Path, bool] | None:
+        top, *parts = module.split(".")
+        try:
+            spec = find_spec(top)
+        except (ImportError, ValueError):
+            return None
+        if spec is None:
+            return None
+        if not parts:
+            if spec.origin and spec.origin.endswith(".py"):
+                return pathlib.Path(spec.origin), spec.submodule_search_locations is not None
+            return None
+        locations = [pathlib.Path(location) for location in spec.submodule_search_locations or []]
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            for location in locations:
+                if (location / part / "__init__.py").is_file():
+                    if last:
+                        return location / part / "__init__.py", True
+                    locations = [location / part]
+                    break
+                if last and (location / f"{part}.py").is_file():
+                    return location / f"{part}.py", False
+                if not last and (location / part).is_dir():
+                    # Namespace package
+                    locations = [location / part]
+                    break
+            else:
+                return None
+        return None
+
+    def source(self, module: str) -> ModuleSource | None:
+        if module in self.sources:
+            return self.sources[module]
+        self.sources[module] = None
+        path = self.module_path(module)
+        if path is None:
+            return None
+        try:
+            tree = ast.parse(path[0].read_bytes(), filename=str(path[0]))
+        except (OSError, SyntaxError, ValueError):
+            return None
+        source = ModuleSource(module, path[1])
+        self.collect(source, tree.body)
+        self.sources[module] = source
+        return source
+
+    def collect(self, source: ModuleSource, body: list[ast.stmt]) -> None:
+        for node in body:
+            match node:
+                case ast.ClassDef():
+                    source.classes[node.name] = node
+                case ast.ImportFrom():
+                    module = self.absolute_module(source, node.module, node.level)
+                    for alias in node.names:
+                        source.imports[alias.asname or alias.name] = (module, alias.name)
+                case ast.Import():
+                    for alias in node.names:
+                        if alias.asname:
+                            source.modules[alias.asname] = alias.name
+                        else:
+                            top = alias.name.split(".")[0]
+                            source.modules[top] = top
+                case ast.Assign(targets=[ast.Name(id="__all__")]) | ast.AnnAssign(target=ast.Name(id="__all__")):
+                    value = literal(node.value)
+                    if isinstance(value, list | tuple):
+                        source.all = [name for name in value if isinstance(name, str)]
+                case (
+                    ast.Assign(targets=[ast.Name(id="_module_lookup")])
+                    | ast.AnnAssign(target=ast.Name(id="_module_lookup"))
+                ):
+                    value = literal(node.value)
+                    if isinstance(value, dict):
+                        source.lazy.update(
+                            (name, module)
+                            for name, module in value.items()
+                            if isinstance(name, str) and isinstance(module, str)
+                        )
+                case ast.If() | ast.Try() | ast.TryStar():
+                    # TYPE_CHECKING and optional import blocks
+                    self.collect(source, node.body)
+                    for handler in getattr(node, "handlers", []):
+                        self.collect(source, handler.body)
+                    self.collect(source, node.orelse)
+                    self.collect(source, getattr(node, "finalbody", []))
+
+    def absolute_module(self, source: ModuleSource, module: str | None, level: int) -> str:
+        if not level:
+            return module or ""
+        parts = source.name.split(".")
+        if not source.is_package:
+            parts = parts[:-1]
+        if level > 1:
+            parts = parts[: -(level - 1)]
+        return ".".join(parts + ([module] if module else []))
+
+    def resolve(self, module: str, name: str, depth: int = 0) -> ClassRef | None:
+        """Resolve name in module to the module and name of the class definition."""
+        source = self.source(module)
+        if source is None or depth > self.MAX_DEPTH:
+            return None
+        if name in source.classes:
+            return (module, name)
+        if name in source.imports:
+            imported_module, imported_name = source.imports[name]
+            return self.resolve(imported_module, imported_name, depth + 1)
+        if name in source.lazy:
+            return self.resolve(source.lazy[name], name, depth + 1)
+        return None
+
+    def resolve_expression(self, module: str, expression: ast.expr) -> ClassRef | None:
+        match expression:
+            case ast.Name(id=name):
+                return self.resolve(module, name)
+            case ast.Attribute(value=value, attr=name):
+                # module.Class, or package.module.Class
+                path = []
+                while isinstance(value, ast.Attribute):
+                    path.insert(0, value.attr)
+                    value = value.value
+                if not isinstance(value, ast.Name):
+                    return None
+                source = self.source(module)
+                if source is None:
+                    return None
+                if value.id in source.modules:
+                    base = source.modules[value.id]
+                elif value.id in source.imports:
+                    base = ".".join(source.imports[value.id])
+                else:
+                    return None
+                return self.resolve(".".join([base, *path]), name)
+        return None
+
+    def bases(self, ref: ClassRef) -> list[ClassRef]:
+        source = self.source(ref[0])
+        if source is None or ref[1] not in source.classes:
+            return []
+        return [
+            base_ref
+            for base in source.classes[ref[1]].bases
+            if (base_ref := self.resolve_expression(ref[0], base)) is not None
+        ]
+
+    def is_subclass(self, ref: ClassRef, base: ClassRef, depth: int = 0) -> bool:
+        if ref == base:
+            return True
+        if depth > self.MAX_DEPTH:
+            return False
+        if (ref, base) not in self.subclasses:
+            self.subclasses[(ref, base)] = False  # guard cycles
+            self.subclasses[(ref, base)] = any(
+                self.is_subclass(ref_base, base, depth + 1) for ref_base in self.bases(ref)
+            )
+        return self.subclasses[(ref, base)]
+
+    def field_default(self, ref: ClassRef, name: str, depth: int = 0) -> Any:
+        """Return the literal default of a class field, MISSING if it has no default or NONLITERAL."""
+        source = self.source(ref[0])
+        if source is None or ref[1] not in source.classes or depth > self.MAX_DEPTH:
+            return MISSING
+        for node in source.classes[ref[1]].body:
+            match node:
+                case ast.AnnAssign(target=ast.Name(id=target), value=value) if target == name:
+                    return MISSING if value is None else field_value(value)
+                case ast.Assign(targets=[ast.Name(id=target)], value=value) if target == name:
+                    return field_value(value)
+        # Depth first through the bases, which matches the MRO for single inheritance
+        for base in self.bases(ref):
+            default = self.field_default(base, name, depth + 1)
+            if default is not MISSING:
+                return default
+        return MISSING
+
+    def field_defaults(self, ref: ClassRef, names: Iterable[str]) -> dict[str, Any] | None:
+        """Return the literal defaults of fields (None if no default), None if any can't be read statically."""
+        defaults = {}
+        for name in names:
+            default = self.field_default(ref, name)
+            if default is NONLITERAL:
+                return None
+            defaults[name] = None if default is MISSING else default
+        return defaults
+
+    def find_classes(self, package: str, base_class: type | ClassRef) -> list[ClassRef] | None:
+        """Find the classes exported by package that subclass base_class, None if package source can't be found."""
+        source = self.source(package)
+        if source is None:
+            return None
+        base = (base_class.__module__, base_class.__qualname__) if isinstance(base_class, type) else base_class
+        names = (
+            source.all
+            if source.all is not None
+            else [name for name in source.classes.keys() | source.imports.keys() | source.lazy.keys()]
+        )
+        refs: list[ClassRef] = []
+        for name in names:
+            ref = self.resolve(package, name)
+            if ref is not None and ref not in refs and self.is_subclass(ref, base):
+                refs.append(ref)
+        return refs
+
+
+def literal(node: ast.expr | None) -> Any:
+    if node is None:
+        return None
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return NONLITERAL
+
+
+def field_value(node: ast.expr) -> Any:
+    # pydantic Field(default) or Field(default=default)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name | ast.Attribute):
+        func = node.func.id if isinstance(node.func, ast.Name) else node.func.attr
+        if func == "Field":
+            if node.args:
+                return literal(node.args[0])
+            for keyword in node.keywords:
+                if keyword.arg == "default":
+                    return literal(keyword.value)
+            return NONLITERAL if any(keyword.arg == "default_factory" for keyword in node.keywords) else MISSING
+    return literal(node)
+
+
+def scan_packages[T](scanner: Callable[[str], list[T]], packages: Iterable[str]) -> dict[str, list[T]]:
+    """Run scanner over each package in worker processes, up to one per CPU, so scans run in parallel
+    and a package that fails to import (or crashes its worker) is reported and skipped.
+    scanner must be a module level function returning picklable results.
+    """
+    packages = list(packages)
+    results: dict[str, list[T]] = {}
+    crashed: list[str] = []
+    if not packages:
+        return results
+
+    with ProcessPoolExecutor(max_workers=min(len(packages), os.cpu_count() or 1)) as executor:
+        futures = {package: executor.submit(scanner, package) for package in packages}
+        for package, future in futures.items():
+            try:
+                results[package] = future.result()
+            except BrokenProcessPool:
+                crashed.append(package)
+            except Exception as e:
+                report_scan_failure(package, e)
+
+    # A crashed worker breaks the whole pool, rescan those packages in isolation to find the culprit
+    for package in crashed:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                results[package] = executor.submit(scanner, package).result()
+            except Exception as e:
+                report_scan_failure(package, e)
+    return results
+
+
+def report_scan_failure(package: str, error: BaseException) -> None:
+    click.secho(f"Failed to scan {package}: {error!r}", err=True, dim=True)
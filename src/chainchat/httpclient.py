@@ -0,0 +1,97 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import threading
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+
+from . import trace
+
+DEFAULT_CLIENT = "default"
+HTTPLOG_CLIENT = "httplog"
+
+
+@dataclass(frozen=True)
+class ClientConfig:
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30
+    # Requires the h2 package (httpx[http2]), which isn't a dependency
+    http2: bool = False
+    # Generous read timeout, LLM responses can take minutes
+    timeout: float | None = 600
+    connect_timeout: float | None = 10
+    # Log requests and responses to stderr
+    log: bool = False
+    # Record exchanges to a binary trace file (.gz or .zst to compress)
+    trace: str | None = None
+    # Respond with the exchanges recorded in a trace file instead of the network,
+    # with their original timing if realtime
+    replay: str | None = None
+    realtime: bool = False
+
+    def transport_kwargs(self) -> dict[str, Any]:
+        return {
+            "http2": self.http2,
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        }
+
+    def client_kwargs(self) -> dict[str, Any]:
+        return {"timeout": httpx.Timeout(self.timeout, connect=self.connect_timeout)}
+
+
+# Process wide pooled clients by name, shared by model presets and attachments
+# so connections are kept alive across requests.
+client_configs: dict[str, ClientConfig] = {HTTPLOG_CLIENT: ClientConfig(log=True)}
+clients: dict[str, httpx.Client] = {}
+async_clients: dict[str, httpx.AsyncClient] = {}
+# Attachment prefetch threads create clients concurrently, only one may be created per name
+clients_lock = threading.Lock()
+
+
+def configure_client(name: str, **settings: Any) -> None:
+    """Configure the named client, raises ValueError if it is already configured differently."""
+    config = ClientConfig(**settings)
+    if client_configs.setdefault(name, config) != config:
+        raise ValueError(f"HTTP client {name} is already configured differently")
+
+
+def shared_client(name: str = DEFAULT_CLIENT) -> httpx.Client:
+    with clients_lock:
+        if name in clients:
+            return clients[name]
+        config = client_configs.setdefault(name, ClientConfig())
+        transport: httpx.BaseTransport
+        if config.replay:
+            transport = trace.ReplayTransport(config.replay, realtime=config.realtime)
+        else:
+            transport = httpx.HTTPTransport(**config.transport_kwargs())
+        if config.trace:
+            transport = trace.RecordTransport(transport, trace.trace_recorder(config.trace))
+        if config.log:
+            clients[name] = trace.HttpLogClient(transport=transport, **config.client_kwargs())
+        else:
+            clients[name] = httpx.Client(transport=transport, **config.client_kwargs())
+        return clients[name]
+
+
+def shared_async_client(name: str = DEFAULT_CLIENT) -> httpx.AsyncClient:
+    with clients_lock:
+        if name in async_clients:
+            return async_clients[name]
+        config = client_configs.setdefault(name, ClientConfig())
+        transport: httpx.AsyncBaseTransport
+        if config.replay:
+            transport = trace.ReplayTransport(config.replay, realtime=config.realtime)
+        else:
+            transport = httpx.AsyncHTTPTransport(**config.transport_kwargs())
+        if config.trace:
+            transport = trace.AsyncRecordTransport(transport, trace.trace_recorder(config.trace))
+        async_clients[name] = httpx.AsyncClient(transport=transport, **config.client_kwargs())
+        return async_clients[name]
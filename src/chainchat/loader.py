@@ -7,11 +7,13 @@ from functools import cache
 from importlib import import_module
 from typing import Any, TypeGuard
 
+import httpx
 import pydantic
 import yaml
 from langchain_core.language_models.chat_models import BaseChatModel
 
-from . import trace
+from . import httpclient
+from .ratelimit import TokenBucketRateLimiter, shared_rate_limiter
 
 
 class EnvVar(yaml.YAMLObject):
@@ -76,8 +78,50 @@ class HttpLogClient(yaml.YAMLObject):
     yaml_loader = yaml.SafeLoader
 
     @classmethod
-    def from_yaml(cls, loader: yaml.Loader, node: yaml.Node):
-        return trace.HttpLogClient()
+    def from_yaml(cls, loader: yaml.Loader, node: yaml.Node) -> httpx.Client:
+        return httpclient.shared_client(httpclient.HTTPLOG_CLIENT)
+
+
+def construct_http_client_name(loader: yaml.Loader, node: yaml.Node) -> str:
+    """Return the client name, it must be configured in the http_clients section unless it is the default."""
+    name = loader.construct_scalar(node) if isinstance(node, yaml.ScalarNode) else None
+    if not isinstance(name, str):
+        raise yaml.YAMLError("HTTP clients are referenced by name, configure them in the http_clients section")
+    name = name or httpclient.DEFAULT_CLIENT
+    if name != httpclient.DEFAULT_CLIENT and name not in httpclient.client_configs:
+        raise yaml.YAMLError(f"Unknown HTTP client {name}, configure it in the http_clients section")
+    return name
+
+
+class HttpClient(yaml.YAMLObject):
+    yaml_tag = "!http_client"
+    yaml_loader = yaml.SafeLoader
+
+    @classmethod
+    def from_yaml(cls, loader: yaml.Loader, node: yaml.Node) -> httpx.Client:
+        return httpclient.shared_client(construct_http_client_name(loader, node))
+
+
+class HttpAsyncClient(yaml.YAMLObject):
+    yaml_tag = "!http_async_client"
+    yaml_loader = yaml.SafeLoader
+
+    @classmethod
+    def from_yaml(cls, loader: yaml.Loader, node: yaml.Node) -> httpx.AsyncClient:
+        return httpclient.shared_async_client(construct_http_client_name(loader, node))
+
+
+class RateLimit(yaml.YAMLObject):
+    yaml_tag = "!rate_limit"
+    yaml_loader = yaml.SafeLoader
+
+    @classmethod
+    def from_yaml(cls, loader: yaml.Loader, node: yaml.Node) -> TokenBucketRateLimiter:
+        mapping = loader.construct_mapping(node) if isinstance(node, yaml.MappingNode) else {}
+        try:
+            return shared_rate_limiter(**mapping)
+        except TypeError as e:
+            raise yaml.YAMLError(f"Invalid rate limit: {str(e)}") from e
 
 
 class LazyLoader:
@@ -107,10 +151,22 @@ class LazyLoader:
     def prefixed_keys(self, section: str, prefix: str) -> list[str]:
         return [f"{prefix}{k}" for k in self.mapping.get(section, {}).keys()]
 
+    @cache  # noqa: B019
+    def configure_http_clients(self) -> None:
+        """Configure the named clients before loading any preset, presets may reference any of them."""
+        for name, node in self.mapping.get("http_clients", {}).items():
+            settings = self.loader.construct_mapping(node, deep=True) if isinstance(node, yaml.MappingNode) else {}
+            try:
+                httpclient.configure_client(name, **settings)
+            except (TypeError, ValueError) as e:
+                raise yaml.YAMLError(f"Invalid HTTP client {name}: {str(e)}") from e
+
     def load_pydantic(self, section: str, key: str):
         node = self.mapping.get(section, {}).get(key)
         if not node:
             return None
 
+        self.configure_http_clients()
+
         # XXX verify pydantic
         return self.loader.construct_object(node)
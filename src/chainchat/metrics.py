@@ -0,0 +1,364 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from __future__ import annotations
+
+import contextvars
+import enum
+import functools
+import json
+import statistics
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass, field
+from typing import Any
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, LLMResult
+from langgraph.checkpoint.base import BaseCheckpointSaver
+
+# Inter-token latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Set while a checkpoint save is timed, so async saves running the sync save in a thread are only counted once
+timing_checkpoint: contextvars.ContextVar[bool] = contextvars.ContextVar("timing_checkpoint", default=False)
+
+
+class StatsFormat(enum.StrEnum):
+    SUMMARY = "summary"
+    JSON = "json"
+    OPENMETRICS = "openmetrics"
+
+
+@dataclass
+class TurnMetrics:
+    """A single model request, timed from its start. Times are time.perf_counter() seconds."""
+
+    model: str
+    start: float
+    first_token: float | None = None
+    last_token: float | None = None
+    end: float | None = None
+    chunks: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    error: bool = False
+    token_intervals: list[float] = field(default_factory=list, repr=False)
+
+    @property
+    def time_to_first_token(self) -> float | None:
+        return None if self.first_token is None else self.first_token - self.start
+
+    @property
+    def duration(self) -> float | None:
+        return None if self.end is None else self.end - self.start
+
+    @property
+    def tokens_per_second(self) -> float | None:
+        """Output throughput while streaming, after the first token."""
+        if self.first_token is None or self.end is None or self.end <= self.first_token:
+            return None
+        # Count chunks if the provider did not report usage
+        return (self.output_tokens or self.chunks) / (self.end - self.first_token)
+
+
+@dataclass
+class ToolMetrics:
+    name: str
+    duration: float
+    error: bool = False
+
+
+class MetricsHandler(BaseCallbackHandler):
+    """Records model latency and throughput, tool durations and checkpoint save time."""
+
+    # Run callbacks inline on the event loop, so timestamps are not delayed by a thread hop
+    run_inline = True
+
+    def __init__(self) -> None:
+        self.turns: list[TurnMetrics] = []
+        self.tools: list[ToolMetrics] = []
+        self.checkpoint_saves = 0
+        self.checkpoint_seconds = 0.0
+        self.active_turns: dict[UUID, TurnMetrics] = {}
+        self.active_tools: dict[UUID, tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def on_chat_model_start(
+        self,
+        serialized: dict[str, Any],
+        messages: list[list[BaseMessage]],
+        *,
+        run_id: UUID,
+        metadata: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        model = (metadata or {}).get("ls_model_name") or serialized.get("name") or "unknown"
+        with self.lock:
+            turn = TurnMetrics(model=model, start=time.perf_counter())
+            self.turns.append(turn)
+            self.active_turns[run_id] = turn
+
+    def on_llm_new_token(
+        self, token: str, *, chunk: ChatGenerationChunk | None = None, run_id: UUID, **kwargs: Any
+    ) -> None:
+        now = time.perf_counter()
+        # Ignore chunks with only a role or usage, but count tool call argument chunks
+        if not token and not getattr(getattr(chunk, "message", None), "tool_call_chunks", None):
+            return
+        with self.lock:
+            if (turn := self.active_turns.get(run_id)) is None:
+                return
+            if turn.last_token is None:
+                turn.first_token = now
+            else:
+                turn.token_intervals.append(now - turn.last_token)
+            turn.last_token = now
+            turn.chunks += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        now = time.perf_counter()
+        with self.lock:
+            if (turn := self.active_turns.pop(run_id, None)) is None:
+                return
+            turn.end = now
+            for generations in response.generations:
+                for generation in generations:
+                    usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                    if usage:
+                        turn.input_tokens += usage["input_tokens"]
+                        turn.output_tokens += usage["output_tokens"]
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        now = time.perf_counter()
+        with self.lock:
+            if (turn := self.active_turns.pop(run_id, None)) is not None:
+                turn.end = now
+                turn.error = True
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        with self.lock:
+            self.active_tools[run_id] = (serialized.get("name", "unknown"), time.perf_counter())
+
+    def _end_tool(self, run_id: UUID, error: bool) -> None:
+        now = time.perf_counter()
+        with self.lock:
+            if (tool := self.active_tools.pop(run_id, None)) is not None:
+                name, start = tool
+                self.tools.append(ToolMetrics(name=name, duration=now - start, error=error))
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_tool(run_id, False)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_tool(run_id, True)
+
+    def record_checkpoint(self, seconds: float) -> None:
+        with self.lock:
+            self.checkpoint_saves += 1
+            self.checkpoint_seconds += seconds
+
+    def time_checkpointer(self, checkpointer: BaseCheckpointSaver) -> BaseCheckpointSaver:
+        """Time checkpoint saves by wrapping the checkpointer's save methods."""
+
+        def timed(method: Callable[..., Any]) -> Callable[..., Any]:
+            @functools.wraps(method)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                if timing_checkpoint.get():
+                    return method(*args, **kwargs)
+                token = timing_checkpoint.set(True)
+                start = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    self.record_checkpoint(time.perf_counter() - start)
+                    timing_checkpoint.reset(token)
+
+            return wrapper
+
+        def atimed(method: Callable[..., Any]) -> Callable[..., Any]:
+            @functools.wraps(method)
+            async def wrapper(*args: Any, **kwargs: Any) -> Any:
+                if timing_checkpoint.get():
+                    return await method(*args, **kwargs)
+                token = timing_checkpoint.set(True)
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    self.record_checkpoint(time.perf_counter() - start)
+                    timing_checkpoint.reset(token)
+
+            return wrapper
+
+        checkpointer.put = timed(checkpointer.put)  # type: ignore[method-assign]
+        checkpointer.put_writes = timed(checkpointer.put_writes)  # type: ignore[method-assign]
+        checkpointer.aput = atimed(checkpointer.aput)  # type: ignore[method-assign]
+        checkpointer.aput_writes = atimed(checkpointer.aput_writes)  # type: ignore[method-assign]
+        return checkpointer
+
+    def token_intervals(self) -> list[float]:
+        return [interval for turn in self.turns for interval in turn.token_intervals]
+
+    def latency_histogram(self) -> list[tuple[float, int]]:
+        """Cumulative inter-token latency counts for each bucket upper bound, ending with +Inf."""
+        intervals = self.token_intervals()
+        return [(bound, sum(1 for i in intervals if i <= bound)) for bound in LATENCY_BUCKETS] + [
+            (float("inf"), len(intervals))
+        ]
+
+    def to_json(self) -> dict[str, Any]:
+        intervals = self.token_intervals()
+        return {
+            "turns": [
+                {
+                    "model": turn.model,
+                    "time_to_first_token": turn.time_to_first_token,
+                    "duration": turn.duration,
+                    "chunks": turn.chunks,
+                    "input_tokens": turn.input_tokens,
+                    "output_tokens": turn.output_tokens,
+                    "tokens_per_second": turn.tokens_per_second,
+                    "error": turn.error,
+                }
+                for turn in self.turns
+            ],
+            "tools": [asdict(tool) for tool in self.tools],
+            "checkpoints": {"saves": self.checkpoint_saves, "seconds": self.checkpoint_seconds},
+            "inter_token_latency": {
+                "count": len(intervals),
+                "sum": sum(intervals),
+                "buckets": [[bucket_label(bound), count] for bound, count in self.latency_histogram()],
+            },
+        }
+
+    def to_openmetrics(self) -> str:
+        lines: list[str] = []
+
+        def metric(name: str, kind: str, unit: str | None, help_: str, samples: list[tuple[str, str, Any]]) -> None:
+            lines.append(f"# TYPE {name} {kind}")
+            if unit:
+                lines.append(f"# UNIT {name} {unit}")
+            lines.append(f"# HELP {name} {help_}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{{{labels}}} {value}" if labels else f"{name}{suffix} {value}")
+
+        def turn_labels(index: int, turn: TurnMetrics) -> str:
+            return f'turn="{index}",model="{escape_label(turn.model)}"'
+
+        turns = list(enumerate(self.turns, 1))
+        metric(
+            "chainchat_time_to_first_token_seconds",
+            "gauge",
+            "seconds",
+            "Time from model request to first streamed token.",
+            [("", turn_labels(i, t), t.time_to_first_token) for i, t in turns if t.time_to_first_token is not None],
+        )
+        metric(
+            "chainchat_turn_duration_seconds",
+            "gauge",
+            "seconds",
+            "Time from model request to end of response.",
+            [("", turn_labels(i, t), t.duration) for i, t in turns if t.duration is not None],
+        )
+        metric(
+            "chainchat_tokens_per_second",
+            "gauge",
+            None,
+            "Output tokens per second after the first token.",
+            [("", turn_labels(i, t), t.tokens_per_second) for i, t in turns if t.tokens_per_second is not None],
+        )
+        metric(
+            "chainchat_input_tokens",
+            "counter",
+            None,
+            "Model input tokens.",
+            [("_total", turn_labels(i, t), t.input_tokens) for i, t in turns],
+        )
+        metric(
+            "chainchat_output_tokens",
+            "counter",
+            None,
+            "Model output tokens.",
+            [("_total", turn_labels(i, t), t.output_tokens) for i, t in turns],
+        )
+        intervals = self.token_intervals()
+        metric(
+            "chainchat_inter_token_latency_seconds",
+            "histogram",
+            "seconds",
+            "Time between streamed tokens.",
+            [("_bucket", f'le="{bucket_label(bound)}"', count) for bound, count in self.latency_histogram()]
+            + [("_count", "", len(intervals)), ("_sum", "", sum(intervals))],
+        )
+        metric(
+            "chainchat_tool_duration_seconds",
+            "gauge",
+            "seconds",
+            "Tool call duration.",
+            [
+                ("", f'call="{i}",tool="{escape_label(tool.name)}",error="{str(tool.error).lower()}"', tool.duration)
+                for i, tool in enumerate(self.tools, 1)
+            ],
+        )
+        metric(
+            "chainchat_checkpoint_saves",
+            "counter",
+            None,
+            "Conversation checkpoint saves.",
+            [("_total", "", self.checkpoint_saves)],
+        )
+        metric(
+            "chainchat_checkpoint_save_seconds",
+            "counter",
+            "seconds",
+            "Time spent saving conversation checkpoints.",
+            [("_total", "", self.checkpoint_seconds)],
+        )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines: list[str] = []
+        for index, turn in enumerate(self.turns, 1):
+            parts = [f"turn {index} {turn.model}:"]
+            if turn.time_to_first_token is not None:
+                parts.append(f"first token {turn.time_to_first_token:.3f}s,")
+            parts.append(f"{turn.output_tokens or turn.chunks} tokens")
+            if turn.duration is not None:
+                parts.append(f"in {turn.duration:.3f}s")
+            if turn.tokens_per_second is not None:
+                parts.append(f"({turn.tokens_per_second:.1f} tokens/s)")
+            if turn.error:
+                parts.append("failed")
+            lines.append(" ".join(parts))
+        if intervals := self.token_intervals():
+            quantiles = statistics.quantiles(intervals, n=100) if len(intervals) > 1 else intervals * 99
+            lines.append(
+                f"inter-token latency: mean {statistics.fmean(intervals) * 1000:.1f}ms,"
+                f" p50 {quantiles[49] * 1000:.1f}ms, p95 {quantiles[94] * 1000:.1f}ms,"
+                f" max {max(intervals) * 1000:.1f}ms"
+            )
+        for tool in self.tools:
+            lines.append(f"tool {tool.name}: {tool.duration:.3f}s{' failed' if tool.error else ''}")
+        if self.checkpoint_saves:
+            lines.append(f"checkpoints: {self.checkpoint_saves} saves in {self.checkpoint_seconds:.3f}s")
+        return "\n".join(lines)
+
+    def format(self, stats_format: StatsFormat) -> str:
+        if stats_format == StatsFormat.JSON:
+            return json.dumps(self.to_json(), indent=2)
+        if stats_format == StatsFormat.OPENMETRICS:
+            return self.to_openmetrics()
+        return self.summary()
+
+
+def bucket_label(bound: float) -> float | str:
+    return "+Inf" if bound == float("inf") else bound
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
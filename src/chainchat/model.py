@@ -1,19 +1,30 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+from __future__ import annotations
+
+import json
 import re
 import sqlite3
 from functools import cache, cached_property
+from typing import TYPE_CHECKING, Any
 
 import click
-import pydanclick
-from langchain_core.language_models.chat_models import BaseChatModel
-from pydanclick.command import add_options
-from pydanclick.model import convert_to_click
 
-from .cache import distributions_cached, format_distributions_key, models_execute
-from .finder import find_package_classes, find_packages_distributions
-from .loader import LazyLoader, pydantic_class
+from .cache import (
+    distributions_cached,
+    fingerprinted_distributions,
+    format_distributions_key,
+    models_execute,
+    prune,
+    update_fingerprint,
+)
+from .finder import StaticFinder, find_package_classes, find_packages_distributions, scan_packages
+
+if TYPE_CHECKING:
+    from langchain_core.language_models.chat_models import BaseChatModel
+
+    from .loader import LazyLoader
 
 # https://stackoverflow.com/a/1176023/1480205
 OPTION_NAME_RE = re.compile(
@@ -29,14 +40,31 @@ OPTION_NAME_RE = re.compile(
 
 PRESET_PREFIX = "preset-"
 
+# Statically referenced so discovery doesn't need to import langchain_core
+BASE_CHAT_MODEL = ("langchain_core.language_models.chat_models", "BaseChatModel")
+
+# Model fields that can't be configured from the command line
+EXCLUDED_FIELDS = (
+    "llm",
+    "client",
+    "async_client",
+    "client_preview",
+    "cache",
+    "callbacks",
+    "callback_manager",
+    "rate_limiter",
+)
+
 
 class LazyModelGroup(click.Group):
     @cached_property
-    def discovered_commands(self) -> dict[str, tuple[str, str]]:
+    def discovered_commands(self) -> dict[str, tuple[str, str, str | None]]:
         return discover_models()
 
     @cache  # noqa: B019
     def presets(self, model_presets: str | None) -> LazyLoader:
+        from .loader import LazyLoader
+
         return LazyLoader(model_presets)
 
     def list_commands(self, ctx: click.Context) -> list[str]:
@@ -48,7 +76,9 @@ class LazyModelGroup(click.Group):
     def get_command(self, ctx: click.Context, cmd_name: str) -> click.Command | None:
         commands = self.discovered_commands
         if cmd_name in commands:
-            module, classname = commands[cmd_name]
+            module, classname, options = commands[cmd_name]
+            if options is not None:
+                return self.build_indexed_model_command(cmd_name, module, classname, json.loads(options))
             return self.build_discovered_model_command(cmd_name, module, classname)
         presets = self.presets(ctx.obj.get("model_presets"))
         commands = presets.prefixed_keys("models", PRESET_PREFIX)
@@ -56,7 +86,38 @@ class LazyModelGroup(click.Group):
             return self.build_preset_model_command(presets, cmd_name)
         return super().get_command(ctx, cmd_name)
 
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter) -> None:
+        # Discovered model help is known from the index, so listing doesn't build (and import) every model
+        discovered = self.discovered_commands
+        rows: list[tuple[str, str | click.Command]] = []
+        for cmd_name in self.list_commands(ctx):
+            if cmd_name in discovered:
+                module, classname, _ = discovered[cmd_name]
+                rows.append((cmd_name, f"Model {module}.{classname}"))
+            elif (command := self.get_command(ctx, cmd_name)) is not None and not command.hidden:
+                rows.append((cmd_name, command))
+
+        if rows:
+            limit = formatter.width - 6 - max(len(cmd_name) for cmd_name, _ in rows)
+            with formatter.section("Commands"):
+                formatter.write_dl(
+                    [
+                        (
+                            cmd_name,
+                            click.utils.make_default_short_help(command_help, limit)
+                            if isinstance(command_help, str)
+                            else command_help.get_short_help_str(limit),
+                        )
+                        for cmd_name, command_help in rows
+                    ]
+                )
+
     def build_discovered_model_command(self, cmd_name: str, module: str, classname: str) -> click.Command:
+        import pydanclick
+        from langchain_core.language_models.chat_models import BaseChatModel
+
+        from .loader import pydantic_class
+
         cls = pydantic_class((module, classname), BaseChatModel)
         fullname = module + "." + classname
         if cls is None:
@@ -69,16 +130,7 @@ class LazyModelGroup(click.Group):
         @pydanclick.from_pydantic(
             "model",
             cls,
-            exclude=(
-                "llm",
-                "client",
-                "async_client",
-                "client_preview",
-                "cache",
-                "callbacks",
-                "callback_manager",
-                "rate_limiter",
-            ),
+            exclude=EXCLUDED_FIELDS,
             # XXX ignore_unsupported=True
             parse_docstring=False,
         )
@@ -91,7 +143,48 @@ class LazyModelGroup(click.Group):
 
         return command
 
+    def build_indexed_model_command(
+        self, cmd_name: str, module: str, classname: str, options: list[dict[str, Any]]
+    ) -> click.Command:
+        """Build the command from its indexed option schema, the model is only imported when the command runs."""
+        fullname = module + "." + classname
+        converted = {option["name"] for option in options if option["is_flag"] or indexed_type(option["type"])}
+
+        @self.command(
+            cmd_name,
+            help=f"Model {fullname}",
+            params=[indexed_option(option) for option in options],
+        )
+        @click.pass_context
+        def command(ctx: click.Context, **kwargs) -> BaseChatModel:
+            from langchain_core.language_models.chat_models import BaseChatModel
+            from pydanclick.model import convert_to_click
+
+            from .loader import pydantic_class
+
+            cls = pydantic_class((module, classname), BaseChatModel)
+            if cls is None:
+                raise click.UsageError(f"{fullname} is not a BaseChatModel")
+            model_click_options, validate = convert_to_click(cls, exclude=EXCLUDED_FIELDS, parse_docstring=False)
+            # Values of types that couldn't be rebuilt from the index are converted with the model's own options
+            return validate(
+                {
+                    option.name: kwargs[option.name]
+                    if option.name in converted
+                    else option.type_cast_value(ctx, kwargs[option.name])
+                    for option in model_click_options
+                    if option.name in kwargs
+                    and ctx.get_parameter_source(option.name) is not click.core.ParameterSource.DEFAULT
+                }
+            )
+
+        return command
+
     def build_preset_model_command(self, presets: LazyLoader, cmd_name: str) -> click.Command:
+        from langchain_core.language_models.chat_models import BaseChatModel
+        from pydanclick.command import add_options
+        from pydanclick.model import convert_to_click
+
         model_info = presets.load_pydantic("models", cmd_name.removeprefix(PRESET_PREFIX))
         if (
             not model_info
@@ -103,16 +196,7 @@ class LazyModelGroup(click.Group):
 
         options, validate = convert_to_click(
             model_info["class"],
-            exclude=(
-                "llm",
-                "client",
-                "async_client",
-                "client_preview",
-                "cache",
-                "callbacks",
-                "callback_manager",
-                "rate_limiter",
-            ),
+            exclude=EXCLUDED_FIELDS,
             # XXX ignore_unsupported=True
             parse_docstring=False,
         )
@@ -127,7 +211,15 @@ class LazyModelGroup(click.Group):
             specified_kwargs = {
                 k: v for k, v in kwargs.items() if ctx.get_parameter_source(k) is not click.core.ParameterSource.DEFAULT
             }
-            return validate(model_info.get("kwargs", {}) | specified_kwargs)
+            preset_kwargs = model_info.get("kwargs", {})
+            model_kwargs = preset_kwargs | specified_kwargs
+            if preset_kwargs.get("rate_limiter") is not None and "max_retries" in model_info["class"].model_fields:
+                # Chat retries rate limited models itself, SDK retries would multiply its attempts
+                model_kwargs["max_retries"] = 0
+            # validate drops fields without options, so set those from the preset afterwards
+            excluded = {k: v for k, v in preset_kwargs.items() if k in EXCLUDED_FIELDS}
+            model = validate(model_kwargs)
+            return model.model_copy(update=excluded) if excluded else model
 
         # XXX fix
         # for p in command.params:
@@ -136,7 +228,131 @@ class LazyModelGroup(click.Group):
         return command
 
 
-def discover_models() -> dict[str, tuple[str, str]]:
+# Click types that convert values without the model class, by name
+INDEXED_TYPES = {
+    "text": click.STRING,
+    "integer": click.INT,
+    "float": click.FLOAT,
+    "boolean": click.BOOL,
+    "uuid": click.UUID,
+}
+
+
+def type_schema(param_type: click.ParamType) -> dict[str, Any]:
+    # pydanclick wraps the click type it converted the field to
+    param_type = getattr(param_type, "actual_type", param_type)
+    schema: dict[str, Any] = {"name": param_type.name}
+    if isinstance(param_type, click.Choice):
+        schema["choices"] = list(param_type.choices)
+    elif isinstance(param_type, click.IntRange | click.FloatRange):
+        schema |= {
+            "min": param_type.min,
+            "max": param_type.max,
+            "min_open": param_type.min_open,
+            "max_open": param_type.max_open,
+        }
+    elif isinstance(param_type, click.DateTime):
+        schema["formats"] = list(param_type.formats)
+    return schema
+
+
+def indexed_type(schema: dict[str, Any]) -> click.ParamType | None:
+    """Rebuild a click type from its schema, None for types only the model class can convert."""
+    match schema["name"]:
+        case "choice":
+            return click.Choice(schema["choices"])
+        case "integer range":
+            return click.IntRange(schema["min"], schema["max"], schema["min_open"], schema["max_open"])
+        case "float range":
+            return click.FloatRange(schema["min"], schema["max"], schema["min_open"], schema["max_open"])
+        case "datetime":
+            return click.DateTime(schema["formats"])
+        case "path":
+            import pathlib
+
+            return click.Path(path_type=pathlib.Path)
+    return INDEXED_TYPES.get(schema["name"])
+
+
+def option_default(option: click.Option) -> Any:
+    # pydanclick wraps defaults, factories are only known to the model class
+    default = getattr(option.default, "_default", option.default)
+    if callable(default):
+        return None
+    try:
+        json.dumps(default)
+    except (TypeError, ValueError):
+        return None
+    return default
+
+
+def option_schema(option: click.Option) -> dict[str, Any]:
+    return {
+        "name": option.name,
+        "opts": option.opts,
+        "secondary_opts": option.secondary_opts,
+        "type": type_schema(option.type),
+        "default": option_default(option),
+        "is_flag": option.is_flag,
+        "multiple": option.multiple,
+        "nargs": option.nargs,
+        "required": option.required,
+        "metavar": None if option.is_flag else option.make_metavar(),
+        "help": option.help,
+        "hidden": option.hidden,
+    }
+
+
+def indexed_option(schema: dict[str, Any]) -> click.Option:
+    decls = [schema["name"], *schema["opts"]]
+    if schema["secondary_opts"]:
+        decls[-1] += "/" + "/".join(schema["secondary_opts"])
+    if schema["is_flag"]:
+        return click.Option(
+            decls, is_flag=True, default=schema["default"], help=schema["help"], hidden=schema["hidden"]
+        )
+    return click.Option(
+        decls,
+        type=indexed_type(schema["type"]),
+        default=schema["default"],
+        multiple=schema["multiple"],
+        nargs=schema["nargs"],
+        required=schema["required"],
+        metavar=schema["metavar"],
+        help=schema["help"],
+        hidden=schema["hidden"],
+    )
+
+
+def model_options(cls: type[BaseChatModel]) -> str | None:
+    from pydanclick.model import convert_to_click
+
+    try:
+        options, _ = convert_to_click(cls, exclude=EXCLUDED_FIELDS, parse_docstring=False)
+    except Exception:
+        # Not indexed, the command is built from the model class and reports the error when used
+        return None
+    return json.dumps([option_schema(option) for option in options])
+
+
+def discover_models() -> dict[str, tuple[str, str, str | None]]:
+    with models_execute() as cursor:
+        distributions_keys = fingerprinted_distributions(cursor, "models")
+        if distributions_keys is None:
+            distributions_keys = scan_models(cursor)
+            prune(cursor, "models")
+            update_fingerprint(cursor, "models", distributions_keys)
+
+        return {
+            command_name(row["module"], row["class"]): (row["module"], row["class"], row["options"])
+            for row in cursor.execute(
+                f"SELECT * FROM models WHERE distributions IN ({','.join(['?'] * len(distributions_keys))})",  # noqa: S608
+                distributions_keys,
+            ).fetchall()
+        }
+
+
+def scan_models(cursor: sqlite3.Cursor) -> list[str]:
     # Default to langchain_ prefixed packages and langchain_community.chat_models
     ignored_packages = ("langchain_core", "langchain_text_splitters")
     packages_distributions = {
@@ -148,28 +364,35 @@ def discover_models() -> dict[str, tuple[str, str]]:
         packages_distributions["langchain_community.chat_models"] = packages_distributions.pop("langchain_community")
 
     distributions_keys: list[str] = []
-    with models_execute() as cursor:
-        for package, distributions in packages_distributions.items():
-            distributions_key = format_distributions_key(distributions)
-            distributions_keys.append(distributions_key)
-            if not distributions_cached(cursor, "models", distributions_key):
-                update_cache(cursor, package, distributions_key)
+    unscanned: dict[str, str] = {}
+    for package, distributions in packages_distributions.items():
+        distributions_key = format_distributions_key(distributions)
+        distributions_keys.append(distributions_key)
+        if not distributions_cached(cursor, "models", distributions_key):
+            unscanned[package] = distributions_key
 
-        return {
-            command_name(row["module"], row["class"]): (row["module"], row["class"])
-            for row in cursor.execute(
-                f"SELECT * FROM models WHERE distributions IN ({','.join(['?'] * len(distributions_keys))})",  # noqa: S608
-                distributions_keys,
-            ).fetchall()
-        }
+    for package, models in scan_packages(scan_package, unscanned).items():
+        cursor.executemany(
+            "INSERT OR IGNORE INTO models VALUES(:distributions, :module, :class, :options)",
+            ({"distributions": unscanned[package]} | model for model in models),
+        )
+    return distributions_keys
 
 
-def update_cache(cursor: sqlite3.Cursor, package: str, distributions_key: str) -> None:
-    values = (
-        {"distributions": distributions_key, "module": cls.__module__, "class": cls.__name__}
-        for cls in find_package_classes(package, BaseChatModel)
-    )
-    cursor.executemany("INSERT INTO models VALUES(:distributions, :module, :class)", values)
+def scan_package(package: str) -> list[dict[str, str | None]]:
+    # Runs in a worker process. Source parsing finds the models, but their option schemas need the class,
+    # so each model is still imported here. Help and listing then never import them
+    from langchain_core.language_models.chat_models import BaseChatModel
+
+    from .loader import pydantic_class
+
+    refs = StaticFinder().find_classes(package, BASE_CHAT_MODEL)
+    if refs is None:
+        # No source to parse, find them by importing the package
+        classes = find_package_classes(package, BaseChatModel)
+    else:
+        classes = [cls for ref in refs if (cls := pydantic_class(ref, BaseChatModel)) is not None]
+    return [{"module": cls.__module__, "class": cls.__name__, "options": model_options(cls)} for cls in classes]
 
 
 def command_name(module: str, classname: str) -> str:
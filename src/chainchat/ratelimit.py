@@ -0,0 +1,206 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import contextvars
+import email.utils
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.rate_limiters import BaseRateLimiter
+
+# Status codes worth retrying, 529 is Anthropic overloaded
+RETRY_STATUS_CODES = frozenset((408, 429, 500, 502, 503, 504, 529))
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Retry rate limited and transient provider errors, honouring Retry-After,
+    otherwise backing off exponentially with full jitter.
+    """
+
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    def delay(self, attempt: int, error: BaseException) -> float | None:
+        """Seconds to wait before retrying after attempt failed with error, None to give up."""
+        if attempt >= self.max_attempts or status_code(error) not in RETRY_STATUS_CODES:
+            return None
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.base_delay * 2 ** (attempt - 1), self.max_delay))  # noqa: S311
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def status_code(error: BaseException) -> int | None:
+    # openai/anthropic errors have status_code, httpx.HTTPStatusError a response
+    code = getattr(error, "status_code", None)
+    if code is None and (response := getattr(error, "response", None)) is not None:
+        code = getattr(response, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def retry_after_seconds(error: BaseException) -> float | None:
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if (value := headers.get("retry-after-ms")) is not None:
+            return max(float(value) / 1000, 0)
+        if (value := headers.get("retry-after")) is not None:
+            try:
+                return max(float(value), 0)
+            except ValueError:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (ValueError, TypeError):
+        pass
+    return None
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """Rate limiter with token buckets for requests per second and LLM tokens per minute.
+
+    Token usage is only known after a response, so it is recorded then and requests wait
+    while the tokens bucket is in debt. The request rate adapts to rate limiting,
+    halving when throttled and recovering as requests succeed.
+    """
+
+    CHECK_SECONDS = 0.05
+    MIN_RATE_FACTOR = 0.1
+    RECOVERY_FACTOR = 0.1
+
+    def __init__(
+        self,
+        requests_per_second: float | None = None,
+        tokens_per_minute: float | None = None,
+        max_burst: float = 1,
+        retry: RetryPolicy = DEFAULT_RETRY_POLICY,
+    ):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.max_burst = max_burst
+        self.retry = retry
+        self.rate = requests_per_second
+        self.requests = float(max_burst)
+        self.tokens = float(tokens_per_minute or 0)
+        self.blocked_until = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.last
+        self.last = now
+        if self.rate is not None:
+            self.requests = min(self.requests + elapsed * self.rate, self.max_burst)
+        if self.tokens_per_minute is not None:
+            self.tokens = min(self.tokens + elapsed * self.tokens_per_minute / 60, self.tokens_per_minute)
+
+    def _consume(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until or (self.tokens_per_minute is not None and self.tokens <= 0):
+                return False
+            if self.rate is None:
+                return True
+            if self.requests >= 1:
+                self.requests -= 1
+                return True
+            return False
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        if not blocking:
+            return self._consume()
+        while not self._consume():
+            time.sleep(self.CHECK_SECONDS)
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        if not blocking:
+            return self._consume()
+        while not self._consume():
+            await asyncio.sleep(self.CHECK_SECONDS)
+        return True
+
+    def record_usage(self, tokens: int) -> None:
+        """Record tokens used by a successful request."""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens_per_minute is not None:
+                self.tokens -= tokens
+            if self.rate is not None and self.requests_per_second is not None:
+                self.rate = min(self.rate + self.requests_per_second * self.RECOVERY_FACTOR, self.requests_per_second)
+
+    def throttle(self, delay: float) -> None:
+        """Hold all requests for delay seconds and slow down, after the provider rate limited us."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            if self.rate is not None and self.requests_per_second is not None:
+                self.rate = max(self.rate / 2, self.requests_per_second * self.MIN_RATE_FACTOR)
+
+
+rate_limiters: dict[tuple[str | None, float | None, float | None, float, int | None], TokenBucketRateLimiter] = {}
+
+
+def shared_rate_limiter(
+    name: str | None = None,
+    requests_per_second: float | None = None,
+    tokens_per_minute: float | None = None,
+    max_burst: float = 1,
+    max_retries: int | None = None,
+) -> TokenBucketRateLimiter:
+    """Rate limiter shared by every model in the process configured with the same name and limits."""
+    key = (name, requests_per_second, tokens_per_minute, max_burst, max_retries)
+    if key not in rate_limiters:
+        rate_limiters[key] = TokenBucketRateLimiter(
+            requests_per_second=requests_per_second,
+            tokens_per_minute=tokens_per_minute,
+            max_burst=max_burst,
+            retry=DEFAULT_RETRY_POLICY if max_retries is None else RetryPolicy(max_attempts=max_retries + 1),
+        )
+    return rate_limiters[key]
+
+
+class UsageHandler(BaseCallbackHandler):
+    """Records the token usage of model responses with a rate limiter."""
+
+    def __init__(self, rate_limiter: TokenBucketRateLimiter):
+        self.rate_limiter = rate_limiter
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    tokens += usage["total_tokens"]
+        self.rate_limiter.record_usage(tokens)
+
+
+class StreamedTokens:
+    """Counts the tokens streamed by a model call, which can't be retried once its tokens were rendered."""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+
+streamed_tokens: contextvars.ContextVar[StreamedTokens | None] = contextvars.ContextVar("streamed_tokens", default=None)
+
+
+class StreamedTokensHandler(BaseCallbackHandler):
+    """Counts streamed tokens in the StreamedTokens of the current context."""
+
+    run_inline = True
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if (streamed := streamed_tokens.get()) is not None:
+            streamed.count += 1
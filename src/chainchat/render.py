@@ -1,14 +1,22 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-from collections.abc import Iterator
+from __future__ import annotations
 
-from rich.console import Console
-from rich.live import Live
-from rich.markdown import Markdown
+import time
+from collections.abc import AsyncIterator, Iterator
+from typing import TYPE_CHECKING
+
+from rich.console import Console, Group, RenderableType
+
+if TYPE_CHECKING:
+    from rich.live import Live
+    from rich.markdown import Markdown
 
 console = Console()
 
+DEFAULT_REFRESH_PER_SECOND = 10.0
+
 
 def render_text(response: Iterator[str]) -> str:
     current = []
@@ -18,11 +26,85 @@ def render_text(response: Iterator[str]) -> str:
     return "".join(current)
 
 
-def render_markdown(response: Iterator[str]) -> str:
-    current = ""
+async def arender_text(response: AsyncIterator[str]) -> str:
+    current = []
+    async for chunk in response:
+        print(chunk, end="", flush=True)
+        current.append(chunk)
+    return "".join(current)
+
+
+class MarkdownStream:
+    """Incrementally render streamed markdown.
+
+    Top level blocks that can no longer change (every block before the last one)
+    are printed once and dropped, only the still open tail block is reparsed
+    and redrawn in the live display.
+    """
+
+    def __init__(self, live: Live, refresh_per_second: float = DEFAULT_REFRESH_PER_SECOND):
+        self.live = live
+        self.interval = 1 / refresh_per_second if refresh_per_second > 0 else 0
+        self.last_refresh = 0.0
+        self.tail: list[str] = []
+        # Whether rich would separate the next block from the last committed block with a blank line
+        self.new_line = False
+
+    def append(self, chunk: str) -> None:
+        self.tail.append(chunk)
+        now = time.monotonic()
+        if now - self.last_refresh >= self.interval:
+            self.last_refresh = now
+            self.update()
+
+    def separated(self, markdown: Markdown) -> RenderableType:
+        tokens = markdown.parsed
+        # Containers (lists, quotes, tables) already lead with the separator left by their last nested element,
+        # leaf blocks need the separator from the previously committed block.
+        leaf = bool(tokens) and (tokens[0].nesting == 0 or (len(tokens) > 1 and tokens[1].type == "inline"))
+        return Group("", markdown) if self.new_line and leaf else markdown
+
+    def update(self) -> None:
+        from rich.markdown import Markdown, UnknownElement
+
+        tail = "".join(self.tail)
+        markdown = Markdown(tail)
+        blocks = [token for token in markdown.parsed if token.level == 0 and token.nesting >= 0 and token.map]
+        if len(blocks) > 1:
+            lines = tail.splitlines(keepends=True)
+            start = blocks[-1].map[0]
+            # The last block must start on a complete line, a partial line may still change how it parses
+            if start < len(lines) - 1 or tail.endswith("\n"):
+                committed = blocks[-2]
+                self.live.console.print(self.separated(Markdown("".join(lines[:start]))))
+                self.new_line = Markdown.elements.get(committed.type, UnknownElement).new_line
+                tail = "".join(lines[start:])
+                self.tail = [tail]
+                markdown = Markdown(tail)
+        self.live.update(self.separated(markdown), refresh=True)
+
+
+def render_markdown(response: Iterator[str], refresh_per_second: float = DEFAULT_REFRESH_PER_SECOND) -> str:
+    from rich.live import Live
+
+    current = []
     with Live(auto_refresh=False, console=console) as live:
+        stream = MarkdownStream(live, refresh_per_second)
         for chunk in response:
-            current += chunk
-            markdown = Markdown(current)
-            live.update(markdown, refresh=True)
-    return current
+            current.append(chunk)
+            stream.append(chunk)
+        stream.update()
+    return "".join(current)
+
+
+async def arender_markdown(response: AsyncIterator[str], refresh_per_second: float = DEFAULT_REFRESH_PER_SECOND) -> str:
+    from rich.live import Live
+
+    current = []
+    with Live(auto_refresh=False, console=console) as live:
+        stream = MarkdownStream(live, refresh_per_second)
+        async for chunk in response:
+            current.append(chunk)
+            stream.append(chunk)
+        stream.update()
+    return "".join(current)
@@ -1,36 +1,67 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import asyncio
+import contextvars
+import difflib
+import json
 import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Sequence
+from concurrent.futures import Future
 from functools import cache
 from importlib import import_module
+from typing import Any
+from uuid import UUID, uuid4
 
 import click
+from langchain_core.callbacks.manager import AsyncCallbackManagerForToolRun, CallbackManagerForToolRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AnyMessage, ToolCall, ToolMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import (
+    get_async_callback_manager_for_config,
+    get_callback_manager_for_config,
+    patch_config,
+)
+from langchain_core.runnables.utils import gather_with_concurrency
 from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langgraph.prebuilt import ToolNode
+from langgraph.store.base import BaseStore
+from pydantic import BaseModel
 from pydantic_core import PydanticUndefinedType
 
-from .cache import distributions_cached, format_distributions_key, tools_execute
-from .finder import find_package_classes, find_packages_distributions
+from .cache import (
+    distributions_cached,
+    fingerprinted_distributions,
+    format_distributions_key,
+    match_tools,
+    prune,
+    tools_execute,
+    update_fingerprint,
+)
+from .finder import StaticFinder, find_package_classes, find_packages_distributions, scan_packages
+
+SUGGESTIONS = 3
+
+
+@cache
+def load_tools(tool_discovery: tuple[str, ...]) -> dict[str, sqlite3.Row]:
+    return discover_tools(tool_discovery)
 
 
 @cache
 def load_tool_descriptions(tool_discovery: tuple[str, ...]) -> dict[str, str]:
-    return {name: row["description"] for name, row in discover_tools(tool_discovery).items()}
+    return {name: row["description"] for name, row in load_tools(tool_discovery).items()}
 
 
 def discover_tools(tool_discovery: tuple[str, ...]) -> dict[str, sqlite3.Row]:
     tools: dict[str, sqlite3.Row] = {}
     with tools_execute() as cursor:
-        for package in tool_discovery:
-            module = package
-            package = package.split(".")[0]
-            if package not in find_packages_distributions():
-                continue
-            distributions = find_packages_distributions()[package]
-            distributions_key = format_distributions_key(distributions)
-            if not distributions_cached(cursor, "tools", distributions_key):
-                update_cache(cursor, module, distributions_key)
-
+        for distributions_key in discovered_distributions(cursor, tool_discovery):
             tools.update(
                 (row["name"], row)
                 for row in cursor.execute(
@@ -41,35 +72,254 @@ def discover_tools(tool_discovery: tuple[str, ...]) -> dict[str, sqlite3.Row]:
     return tools
 
 
+def search_tools(tool_discovery: tuple[str, ...], query: str, limit: int | None = None) -> dict[str, sqlite3.Row]:
+    with tools_execute() as cursor:
+        return {
+            row["name"]: row
+            for row in match_tools(cursor, discovered_distributions(cursor, tool_discovery), query, limit)
+        }
+
+
+def discovered_distributions(cursor: sqlite3.Cursor, tool_discovery: tuple[str, ...]) -> list[str]:
+    name = "tools:" + ",".join(tool_discovery)
+    distributions_keys = fingerprinted_distributions(cursor, name)
+    if distributions_keys is None:
+        distributions_keys = scan_tools(cursor, tool_discovery)
+        prune(cursor, "tools")
+        update_fingerprint(cursor, name, distributions_keys)
+    return distributions_keys
+
+
+def scan_tools(cursor: sqlite3.Cursor, tool_discovery: tuple[str, ...]) -> list[str]:
+    distributions_keys: list[str] = []
+    unscanned: dict[str, str] = {}
+    for package in tool_discovery:
+        module = package
+        package = package.split(".")[0]
+        if package not in find_packages_distributions():
+            continue
+        distributions = find_packages_distributions()[package]
+        distributions_key = format_distributions_key(distributions)
+        distributions_keys.append(distributions_key)
+        if not distributions_cached(cursor, "tools", distributions_key):
+            unscanned[module] = distributions_key
+
+    for module, tools in scan_packages(scan_package, unscanned).items():
+        cursor.executemany(
+            "INSERT OR IGNORE INTO tools (distributions, module, class, name, description) "
+            "VALUES(:distributions, :module, :class, :name, :description)",
+            ({"distributions": unscanned[module]} | tool for tool in tools),
+        )
+    return distributions_keys
+
+
 def get_tool_attr(cls: type[BaseTool], attr: str) -> str | None:
     value = cls.model_fields[attr].default
     return value if not isinstance(value, PydanticUndefinedType) else None
 
 
-def update_cache(cursor: sqlite3.Cursor, module: str, distributions_key: str) -> None:
-    values = (
-        {
-            "distributions": distributions_key,
-            "module": cls.__module__,
-            "class": cls.__name__,
-            "name": get_tool_attr(cls, "name"),
-            "description": get_tool_attr(cls, "description"),
-        }
-        for cls in find_package_classes(module, BaseTool)
-        if get_tool_attr(cls, "name") is not None
-    )
-    cursor.executemany("INSERT INTO tools VALUES(:distributions, :module, :class, :name, :description)", values)
+def scan_package(module: str) -> list[dict[str, str | None]]:
+    finder = StaticFinder()
+    refs = finder.find_classes(module, BaseTool)
+    if refs is None:
+        # No source to parse, import it
+        return [
+            tool_row(cls) for cls in find_package_classes(module, BaseTool) if get_tool_attr(cls, "name") is not None
+        ]
+
+    tools = []
+    for ref in refs:
+        defaults = finder.field_defaults(ref, ("name", "description"))
+        if defaults is None:
+            tools.append(tool_row(getattr(import_module(ref[0]), ref[1])))
+        else:
+            tools.append({"module": ref[0], "class": ref[1]} | defaults)
+    return [tool for tool in tools if tool["name"] is not None]
+
+
+def tool_row(cls: type[BaseTool]) -> dict[str, str | None]:
+    return {
+        "module": cls.__module__,
+        "class": cls.__name__,
+        "name": get_tool_attr(cls, "name"),
+        "description": get_tool_attr(cls, "description"),
+    }
 
 
 def create_tools(tool_names: tuple[str] | None, tool_discovery: tuple[str, ...]) -> list[BaseTool] | None:
     if not tool_names:
         return None
-    tools_data = discover_tools(tool_discovery)
+    tools_data = load_tools(tool_discovery)
     tools: list[BaseTool] = []
     for tool_name in tool_names:
         if tool_name not in tools_data:
-            raise click.UsageError(f"Tool {tool_name} not found. Use `list-tools`.")
+            suggestions = similar_tools(tool_name, tools_data.keys(), tool_discovery)
+            did_you_mean = f" Did you mean {', '.join(suggestions)}?" if suggestions else ""
+            raise click.UsageError(f"Tool {tool_name} not found.{did_you_mean} Use `list-tools`.")
         tool_data = tools_data[tool_name]
         cls = getattr(import_module(tool_data["module"]), tool_data["class"])
-        tools.append(cls())
+        tools.append(tool_instance(cls))
     return tools
+
+
+# Process level registry of tools and their schemas, so they are shared by every Chat in the process
+# instead of rebuilt per session. Least recently used entries are evicted.
+# Schema values hold the tools so the ids in their keys stay valid.
+MAX_TOOL_INSTANCES = 256
+MAX_TOOL_SCHEMAS = 256
+tool_instances: OrderedDict[tuple[type[BaseTool], tuple[tuple[str, Any], ...]], BaseTool] = OrderedDict()
+tool_schemas: OrderedDict[int, tuple[BaseTool, dict[str, Any], str]] = OrderedDict()
+# Models bound to tools, shared while in use. Entries live only as long as their bound model,
+# which references the model so the id in its key can't be reused.
+bound_models: weakref.WeakValueDictionary[tuple[int, tuple[str, ...]], Runnable] = weakref.WeakValueDictionary()
+
+
+def lru_get[K, V](entries: OrderedDict[K, V], key: K, maxsize: int, create: Callable[[], V]) -> V:
+    if key in entries:
+        entries.move_to_end(key)
+    else:
+        entries[key] = create()
+        if len(entries) > maxsize:
+            entries.popitem(last=False)
+    return entries[key]
+
+
+def tool_instance(cls: type[BaseTool], **kwargs: Any) -> BaseTool:
+    return lru_get(tool_instances, (cls, tuple(sorted(kwargs.items()))), MAX_TOOL_INSTANCES, lambda: cls(**kwargs))
+
+
+def tool_schema(tool: BaseTool) -> tuple[dict[str, Any], str]:
+    """Return the tool's schema and its serialization."""
+
+    def create() -> tuple[BaseTool, dict[str, Any], str]:
+        schema = convert_to_openai_tool(tool)
+        return (tool, schema, json.dumps(schema, sort_keys=True))
+
+    return lru_get(tool_schemas, id(tool), MAX_TOOL_SCHEMAS, create)[1:]
+
+
+def bind_tools(model: BaseChatModel, tools: Sequence[BaseTool]) -> Runnable:
+    """Bind tools to model, reusing the bound model while it is in use for the same model instance and tools."""
+    # Keyed by instance, the LLM string leaves out settings like the API key and HTTP client.
+    # Tools are keyed by their serialized schema, the bound model doesn't keep them alive
+    schemas = [tool_schema(tool) for tool in tools]
+    key = (id(model), tuple(serialized for _, serialized in schemas))
+    if (bound := bound_models.get(key)) is None:
+        # Bind the converted schemas, so each tool is only serialized once
+        bound = bound_models[key] = model.bind_tools([schema for schema, _ in schemas])
+    return bound
+
+
+def similar_tools(tool_name: str, tool_names: Iterable[str], tool_discovery: tuple[str, ...]) -> list[str]:
+    # Close spellings first, then tools matching the words of the name
+    suggestions = difflib.get_close_matches(tool_name, tool_names, n=SUGGESTIONS)
+    suggestions.extend(name for name in search_tools(tool_discovery, tool_name, SUGGESTIONS) if name not in suggestions)
+    return suggestions[:SUGGESTIONS]
+
+
+class ConcurrentToolNode(ToolNode):
+    """ToolNode that runs the tool calls of a turn concurrently with a bounded number of workers,
+    and returns an error ToolMessage for any call that exceeds the timeout.
+    """
+
+    def __init__(
+        self,
+        tools: list[BaseTool],
+        *,
+        max_concurrency: int | None = None,
+        timeout: float | None = None,
+        **kwargs: Any,
+    ):
+        super().__init__(tools, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+
+    def _timeout_message(self, call: ToolCall) -> ToolMessage:
+        return ToolMessage(
+            content=f"Error: tool {call["name"]} timed out after {self.timeout} seconds",
+            name=call["name"],
+            tool_call_id=call["id"],
+            status="error",
+        )
+
+    def _timeout_error(self, call: ToolCall) -> TimeoutError:
+        return TimeoutError(f"Tool {call["name"]} timed out after {self.timeout} seconds")
+
+    def _timed_out(self, call: ToolCall, config: RunnableConfig, run_id: UUID) -> ToolMessage:
+        # The abandoned run never ends, report it as failed so callback handlers like metrics see it
+        manager = get_callback_manager_for_config(config)
+        CallbackManagerForToolRun(
+            run_id=run_id,
+            handlers=manager.handlers,
+            inheritable_handlers=manager.inheritable_handlers,
+            parent_run_id=manager.parent_run_id,
+        ).on_tool_error(self._timeout_error(call))
+        return self._timeout_message(call)
+
+    async def _atimed_out(self, call: ToolCall, config: RunnableConfig, run_id: UUID) -> ToolMessage:
+        manager = get_async_callback_manager_for_config(config)
+        await AsyncCallbackManagerForToolRun(
+            run_id=run_id,
+            handlers=manager.handlers,
+            inheritable_handlers=manager.inheritable_handlers,
+            parent_run_id=manager.parent_run_id,
+        ).on_tool_error(self._timeout_error(call))
+        return self._timeout_message(call)
+
+    def _func(
+        self,
+        input: list[AnyMessage] | dict[str, Any] | BaseModel,  # noqa: A002
+        config: RunnableConfig,
+        *,
+        store: BaseStore,
+    ) -> Any:
+        # ToolNode maps calls over an executor sized by max_concurrency, preserving tool_call order
+        return super()._func(input, patch_config(config, max_concurrency=self.max_concurrency), store=store)
+
+    def _run_one(self, call: ToolCall, config: RunnableConfig) -> ToolMessage:
+        if self.timeout is None:
+            return super()._run_one(call, config)
+
+        # Threads can't be cancelled, so run the call in a daemon thread and abandon it on timeout.
+        # This frees the worker slot and won't block interpreter exit.
+        # The tool run gets a known id so its timeout can be reported.
+        run_id = uuid4()
+        config = {**config, "run_id": run_id}
+        future: Future[ToolMessage] = Future()
+        context = contextvars.copy_context()
+
+        def run() -> None:
+            try:
+                future.set_result(context.run(super(ConcurrentToolNode, self)._run_one, call, config))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f"tool-{call["name"]}", daemon=True).start()
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            return self._timed_out(call, config, run_id)
+
+    async def _afunc(
+        self,
+        input: list[AnyMessage] | dict[str, Any] | BaseModel,  # noqa: A002
+        config: RunnableConfig,
+        *,
+        store: BaseStore,
+    ) -> Any:
+        tool_calls, output_type = self._parse_input(input, store)
+        outputs = await gather_with_concurrency(
+            self.max_concurrency, *(self._arun_one(call, config) for call in tool_calls)
+        )
+        return outputs if output_type == "list" else {self.messages_key: outputs}
+
+    async def _arun_one(self, call: ToolCall, config: RunnableConfig) -> ToolMessage:
+        if self.timeout is None:
+            return await super()._arun_one(call, config)
+        # Cancelled runs never end, the tool run gets a known id so its timeout can be reported
+        run_id = uuid4()
+        config = {**config, "run_id": run_id}
+        try:
+            return await asyncio.wait_for(super()._arun_one(call, config), self.timeout)
+        except TimeoutError:
+            return await self._atimed_out(call, config, run_id)
@@ -2,7 +2,23 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 
+import asyncio
+import atexit
+import collections
+import enum
+import gzip
+import itertools
+import json
+import os
+import pathlib
+import queue
+import struct
 import sys
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
+from dataclasses import dataclass, field
+from typing import Any, BinaryIO, Literal
 
 import httpx
 
@@ -35,5 +51,291 @@ class LogTransport(httpx.BaseTransport):
 
 
 class HttpLogClient(httpx.Client):
-    def __init__(self):
-        super().__init__(transport=LogTransport(httpx.HTTPTransport()))
+    def __init__(self, transport: httpx.BaseTransport | None = None, **kwargs: Any):
+        super().__init__(transport=LogTransport(transport or httpx.HTTPTransport()), **kwargs)
+
+
+# Binary trace format, a magic header followed by records of
+# kind (B), exchange id (I), seconds since the trace started (d) and payload length (I), then the payload.
+# REQUEST and RESPONSE payloads are JSON, CHUNK payloads the raw response bytes.
+# Request headers are not recorded, they contain API keys.
+TRACE_MAGIC = b"CCTRACE\x01"
+RECORD_HEADER = struct.Struct("<BIdI")
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class RecordKind(enum.IntEnum):
+    REQUEST = 1
+    RESPONSE = 2
+    CHUNK = 3
+    END = 4
+
+
+def open_trace(path: str | os.PathLike, mode: Literal["rb", "wb"]) -> BinaryIO:
+    """Open a trace file, compressed with zstd or gzip based on the .zst/.gz suffix when writing
+    and the file contents when reading.
+    """
+    zstd = gzipped = False
+    if mode == "wb":
+        suffix = pathlib.Path(path).suffix
+        zstd, gzipped = suffix == ".zst", suffix == ".gz"
+    else:
+        with open(path, "rb") as f:
+            magic = f.read(len(ZSTD_MAGIC))
+        zstd, gzipped = magic == ZSTD_MAGIC, magic.startswith(GZIP_MAGIC)
+    if gzipped:
+        return gzip.open(path, mode)  # type: ignore[return-value]
+    if zstd:
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ValueError("zstd compressed traces require the zstandard package") from e
+        f = open(path, mode)
+        if mode == "wb":
+            return zstandard.ZstdCompressor().stream_writer(f)  # type: ignore[return-value]
+        return zstandard.ZstdDecompressor().stream_reader(f)  # type: ignore[return-value]
+    return open(path, mode)
+
+
+class TraceRecorder:
+    """Records HTTP exchanges to a trace file.
+
+    Records are queued and written by a background thread so recording adds
+    little latency to streaming responses.
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = path
+        self.file = open_trace(path, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.start = time.perf_counter()
+        self.exchanges = itertools.count(1)
+        self.queue: queue.SimpleQueue[tuple[RecordKind, int, float, bytes] | None] = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write, name="trace-recorder", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def _write(self) -> None:
+        while (record := self.queue.get()) is not None:
+            kind, exchange, timestamp, payload = record
+            self.file.write(RECORD_HEADER.pack(kind, exchange, timestamp, len(payload)))
+            self.file.write(payload)
+            if self.queue.empty():
+                self.file.flush()
+        self.file.close()
+
+    def record(self, kind: RecordKind, exchange: int, payload: bytes = b"") -> None:
+        self.queue.put((kind, exchange, time.perf_counter() - self.start, payload))
+
+    def record_request(self, request: httpx.Request) -> int:
+        exchange = next(self.exchanges)
+        try:
+            content = request.content.decode(errors="replace")
+        except httpx.RequestNotRead:
+            content = ""
+        self.record(
+            RecordKind.REQUEST,
+            exchange,
+            json.dumps({"method": request.method, "url": str(request.url), "content": content}).encode(),
+        )
+        return exchange
+
+    def record_response(self, exchange: int, response: httpx.Response) -> None:
+        self.record(
+            RecordKind.RESPONSE,
+            exchange,
+            json.dumps({"status_code": response.status_code, "headers": response.headers.multi_items()}).encode(),
+        )
+
+    def close(self) -> None:
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        atexit.unregister(self.close)
+
+
+recorders: dict[str, TraceRecorder] = {}
+
+
+def trace_recorder(path: str | os.PathLike) -> TraceRecorder:
+    """Recorder shared by every client tracing to path."""
+    key = os.path.abspath(path)
+    if key not in recorders:
+        recorders[key] = TraceRecorder(path)
+    return recorders[key]
+
+
+class RecordStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream | httpx.AsyncByteStream, recorder: TraceRecorder, exchange: int):
+        self.stream = stream
+        self.recorder = recorder
+        self.exchange = exchange
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self.stream:  # type: ignore[union-attr]
+            self.recorder.record(RecordKind.CHUNK, self.exchange, chunk)
+            yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:  # type: ignore[union-attr]
+            self.recorder.record(RecordKind.CHUNK, self.exchange, chunk)
+            yield chunk
+
+    def close(self) -> None:
+        self.recorder.record(RecordKind.END, self.exchange)
+        self.stream.close()  # type: ignore[union-attr]
+
+    async def aclose(self) -> None:
+        self.recorder.record(RecordKind.END, self.exchange)
+        await self.stream.aclose()  # type: ignore[union-attr]
+
+
+def recorded_response(response: httpx.Response, recorder: TraceRecorder, exchange: int) -> httpx.Response:
+    recorder.record_response(exchange, response)
+    return httpx.Response(
+        status_code=response.status_code,
+        headers=response.headers,
+        stream=RecordStream(response.stream, recorder, exchange),
+        extensions=response.extensions,
+    )
+
+
+class RecordTransport(httpx.BaseTransport):
+    def __init__(self, transport: httpx.BaseTransport, recorder: TraceRecorder):
+        self.transport = transport
+        self.recorder = recorder
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        exchange = self.recorder.record_request(request)
+        return recorded_response(self.transport.handle_request(request), self.recorder, exchange)
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRecordTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport, recorder: TraceRecorder):
+        self.transport = transport
+        self.recorder = recorder
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        exchange = self.recorder.record_request(request)
+        return recorded_response(await self.transport.handle_async_request(request), self.recorder, exchange)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+@dataclass
+class Exchange:
+    request: dict[str, Any]
+    status_code: int = 200
+    headers: list[tuple[str, str]] = field(default_factory=list)
+    # Seconds from the request to the response, and from the previous chunk to each chunk
+    response_delay: float = 0
+    chunks: list[tuple[float, bytes]] = field(default_factory=list)
+
+
+def read_exactly(f: BinaryIO, size: int) -> bytes:
+    """Read size bytes, or fewer at the end of the file. Decompressing readers may return short reads."""
+    data = f.read(size)
+    while len(data) < size and (more := f.read(size - len(data))):
+        data += more
+    return data
+
+
+def read_trace(path: str | os.PathLike) -> list[Exchange]:
+    """Read the exchanges in a trace file, in request order.
+
+    Files without the trace header are read as a single NUL separated stream of
+    server sent events, like the test fixtures.
+    A partial record at the end, left by a recorder that was killed, is skipped.
+    """
+    exchanges: dict[int, Exchange] = {}
+    last: dict[int, float] = {}
+    with open_trace(path, "rb") as f:
+        magic = read_exactly(f, len(TRACE_MAGIC))
+        if magic != TRACE_MAGIC:
+            data = magic + f.read()
+            return [
+                Exchange(
+                    request={},
+                    headers=[("Content-Type", "text/event-stream")],
+                    chunks=[(0, chunk) for chunk in data.split(b"\x00") if chunk],
+                )
+            ]
+
+        while len(header := read_exactly(f, RECORD_HEADER.size)) == RECORD_HEADER.size:
+            kind, exchange_id, timestamp, length = RECORD_HEADER.unpack(header)
+            if len(payload := read_exactly(f, length)) < length:
+                break
+            if kind == RecordKind.REQUEST:
+                exchanges[exchange_id] = Exchange(request=json.loads(payload))
+            elif (exchange := exchanges.get(exchange_id)) is None:
+                continue
+            elif kind == RecordKind.RESPONSE:
+                response = json.loads(payload)
+                exchange.status_code = response["status_code"]
+                exchange.headers = [tuple(header) for header in response["headers"]]
+                exchange.response_delay = timestamp - last[exchange_id]
+            elif kind == RecordKind.CHUNK:
+                exchange.chunks.append((timestamp - last[exchange_id], payload))
+            last[exchange_id] = timestamp
+    return list(exchanges.values())
+
+
+class ReplayStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    def __init__(self, chunks: list[tuple[float, bytes]], realtime: bool):
+        self.chunks = chunks
+        self.realtime = realtime
+
+    def __iter__(self) -> Iterator[bytes]:
+        for delay, chunk in self.chunks:
+            if self.realtime and delay > 0:
+                time.sleep(delay)
+            yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for delay, chunk in self.chunks:
+            if self.realtime and delay > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+
+
+class ReplayTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """Responds to requests with recorded exchanges, in the order they were recorded.
+
+    With realtime, responses and their chunks are delayed as they originally were,
+    otherwise they are replayed as fast as possible.
+    """
+
+    def __init__(self, *paths: str | os.PathLike, realtime: bool = False):
+        self.exchanges = collections.deque(exchange for path in paths for exchange in read_trace(path))
+        self.realtime = realtime
+        self.lock = threading.Lock()
+
+    def _next(self, request: httpx.Request) -> Exchange:
+        with self.lock:
+            if not self.exchanges:
+                raise httpx.TransportError(f"No recorded response for {request.method} {request.url}")
+            return self.exchanges.popleft()
+
+    def _response(self, exchange: Exchange) -> httpx.Response:
+        return httpx.Response(
+            status_code=exchange.status_code,
+            headers=exchange.headers,
+            stream=ReplayStream(exchange.chunks, self.realtime),
+        )
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        exchange = self._next(request)
+        if self.realtime:
+            time.sleep(exchange.response_delay)
+        return self._response(exchange)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        exchange = self._next(request)
+        if self.realtime:
+            await asyncio.sleep(exchange.response_delay)
+        return self._response(exchange)
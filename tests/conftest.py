@@ -7,13 +7,16 @@ import inspect
 import platformdirs
 import pytest
 
-from chainchat import cli
+from chainchat import cli, tool
 
 
 @pytest.fixture
 def mock_platformdirs(monkeypatch, tmp_path):
     # Reload so the cli singleton command instance will use the new patched cache path
     importlib.reload(cli)
+    # Discovered tools are memoized per process
+    tool.load_tools.cache_clear()
+    tool.load_tool_descriptions.cache_clear()
     for func, _ in inspect.getmembers(platformdirs, inspect.isfunction):
         if func.endswith("_path"):
             monkeypatch.setattr(platformdirs, func, lambda *args, **kwargs: tmp_path)
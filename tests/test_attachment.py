@@ -1,12 +1,32 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import base64
+import random
+import time
+
+import httpx
 import pytest
 from langchain_core.messages.human import HumanMessage
 
+from chainchat import attachment as attachment_module
+from chainchat import cache
 from chainchat.attachment import Attachment, AttachmentType, build_message_with_attachments
 
 
+def new_session():
+    attachment_module.load_local.cache_clear()
+    attachment_module.load_remote.cache_clear()
+    attachment_module.referenced_digests.clear()
+
+
+@pytest.fixture(autouse=True)
+def attachment_cache(mock_platformdirs):
+    new_session()
+    yield mock_platformdirs
+    new_session()
+
+
 @pytest.mark.parametrize(
     "attachment_type,message",
     [
@@ -105,10 +125,106 @@ def test_file_attachment(attachment_type, message, tmp_path):
     ],
 )
 def test_url_attachment(attachment_type, get, message, httpx_mock):
-    httpx_mock.add_response(method="HEAD", headers={"Content-Type": "image/jpeg"})
-    if get:
-        httpx_mock.add_response(method="GET", content=b"bogus")
+    # URLs passed through are only checked with HEAD, the content is only downloaded when sent
+    httpx_mock.add_response(method="GET" if get else "HEAD", content=b"bogus", headers={"Content-Type": "image/jpeg"})
     attachment = Attachment("https://example.com/image.jpg", attachment_type=attachment_type)
     assert not attachment.is_local
     assert attachment.resolved_mimetype == "image/jpeg"
     assert build_message_with_attachments("hello", [attachment]) == message
+    assert [request.method for request in httpx_mock.get_requests()] == ["GET" if get else "HEAD"]
+
+
+def test_file_attachment_cached(tmp_path, monkeypatch):
+    attachment_file = tmp_path / "test.pdf"
+    attachment_file.write_bytes(b"bogus")
+
+    assert Attachment(str(attachment_file)).base64_content() == "Ym9ndXM="
+    new_session()
+
+    # A new session is served from the persistent cache without reading the file
+    def fail_store(*args, **kwargs):
+        raise AssertionError("attachment should not be stored")
+
+    with monkeypatch.context() as m:
+        m.setattr(attachment_module, "store_cached", fail_store)
+        attachment = Attachment(str(attachment_file))
+        assert attachment.base64_content() == "Ym9ndXM="
+        assert attachment.content() == b"bogus"
+
+    # Modifying the file invalidates it
+    attachment_file.write_bytes(b"changed")
+    assert Attachment(str(attachment_file)).content() == b"changed"
+
+
+def test_url_attachment_cached(httpx_mock):
+    url = "https://example.com/doc.pdf"
+    httpx_mock.add_response(method="GET", url=url, content=b"bogus", headers={"ETag": '"v1"'})
+    attachment = Attachment(url)
+    assert attachment.base64_content() == "Ym9ndXM="
+    # Content is fetched once per session
+    assert Attachment(url).content() == b"bogus"
+    assert len(httpx_mock.get_requests()) == 1
+
+    attachment_module.load_remote.cache_clear()
+    httpx_mock.add_response(method="GET", url=url, status_code=304, match_headers={"If-None-Match": '"v1"'})
+    assert Attachment(url).base64_content() == "Ym9ndXM="
+    assert len(httpx_mock.get_requests()) == 2
+
+
+def test_attachment_cache_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "ATTACHMENTS_MAX_BYTES", 60)
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"test{i}.bin"
+        path.write_bytes(bytes([i]) * 6)
+        paths.append(path)
+
+    # Content loaded in this process is kept over the limit, its memoized loaders still refer to it
+    attachments = [Attachment(str(path)) for path in paths[:3]]
+    for attachment in attachments:
+        attachment.content()
+    assert [attachment.data_url() for attachment in attachments] == [
+        f"data:application/octet-stream;base64,{base64.b64encode(path.read_bytes()).decode()}" for path in paths[:3]
+    ]
+    with cache.attachments_execute() as cursor:
+        assert cursor.execute("SELECT count(*) FROM attachments").fetchone()[0] == 3
+
+    # Each entry is 6 raw + 45 data URL bytes, so only the most recently used fits
+    new_session()
+    Attachment(str(paths[3])).content()
+    with cache.attachments_execute() as cursor:
+        assert [row["source"] for row in cursor.execute("SELECT source FROM attachments")] == [str(paths[3])]
+    assert len(list(cache.attachments_path().iterdir())) == 2
+
+
+def test_url_attachment_error(httpx_mock):
+    httpx_mock.add_response(method="GET", status_code=404)
+    with pytest.raises(httpx.HTTPStatusError):
+        Attachment("https://example.com/missing.jpg").content()
+
+
+def test_chunked_base64(tmp_path, monkeypatch):
+    monkeypatch.setattr(attachment_module, "BASE64_CHUNK_SIZE", 3 * 4096)
+    data = random.randbytes(50_000)
+    attachment_file = tmp_path / "test.bin"
+    attachment_file.write_bytes(data)
+    attachment = Attachment(str(attachment_file), mimetype="application/octet-stream")
+    assert attachment.base64_content() == base64.b64encode(data).decode()
+    assert attachment.data_url() == f"data:application/octet-stream;base64,{base64.b64encode(data).decode()}"
+    assert attachment.content() == data
+
+
+def test_url_attachments_concurrent(httpx_mock):
+    def slow_response(request):
+        time.sleep(0.2)
+        return httpx.Response(200, content=b"bogus", headers={"Content-Type": "image/jpeg"})
+
+    urls = [f"https://example.com/image{i}.jpg" for i in range(8)]
+    for url in urls:
+        httpx_mock.add_callback(slow_response, method="GET", url=url)
+    attachments = [Attachment(url, AttachmentType.ANTHROPIC) for url in urls]
+    start = time.monotonic()
+    message = build_message_with_attachments("hello", attachments)
+    assert time.monotonic() - start < 1
+    assert len(message.content) == 9
+    assert {request.method for request in httpx_mock.get_requests()} == {"GET"}
@@ -0,0 +1,69 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import io
+import json
+
+from langchain_community.tools import ReadFileTool
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_openai import ChatOpenAI
+
+from chainchat.batch import BatchRunner
+from chainchat.chat import Chat
+from chainchat.render import arender_text
+
+from .test_cli import mock_openai
+
+
+def test_aprompt(httpx_mock, capsys):
+    mock_openai(httpx_mock, "gpt-4o-mini-cutoff.dat")
+    chat = Chat(ChatOpenAI(model_name="gpt-4o-mini", openai_api_key="XXX"))
+    result = asyncio.run(chat.aprompt("What is your knowledge cutoff date?", arender_text))
+    assert result == "My knowledge cutoff date is October 2021."
+    assert capsys.readouterr().out == result
+
+
+def test_aprompt_with_tool(httpx_mock, mock_platformdirs, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "simple.txt").write_text("This is a test file.")
+    mock_openai(httpx_mock, "gpt-4o-mini-tool1.dat")
+    mock_openai(httpx_mock, "gpt-4o-mini-tool2.dat")
+    chat = Chat(
+        ChatOpenAI(model_name="gpt-4o-mini", openai_api_key="XXX"),
+        tools=[ReadFileTool()],
+        conversation_id="test",
+    )
+    result = asyncio.run(chat.aprompt("Summarize the file ./simple.txt", arender_text))
+    assert result == 'The file contains a simple statement: "This is a test file."'
+    messages = chat.graph.get_state({"configurable": {"thread_id": "test"}}).values["messages"]
+    assert [message.type for message in messages] == ["human", "ai", "tool", "ai"]
+
+
+class NonStreamingModel(BaseChatModel):
+    """Only implements _generate, so streaming yields the complete response."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "non-streaming"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = AIMessage("hello there", usage_metadata={"input_tokens": 3, "output_tokens": 2, "total_tokens": 5})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def test_aprompt_non_streaming(capsys):
+    chat = Chat(NonStreamingModel())
+    assert asyncio.run(chat.aprompt("hi", arender_text)) == "hello there"
+    assert capsys.readouterr().out == "hello there"
+
+
+def test_batch_non_streaming():
+    runner = BatchRunner(lambda persistent: Chat(NonStreamingModel()), concurrency=2)
+    output = io.StringIO()
+    asyncio.run(runner.run(['{"prompt": "hi"}', '{"prompt": "hello"}'], output))
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [r["response"] for r in results] == ["hello there", "hello there"]
+    assert [(r["input_tokens"], r["output_tokens"]) for r in results] == [(3, 2), (3, 2)]
@@ -1,16 +1,18 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import json
 import os
 import pathlib
 import textwrap
 from unittest import mock
 
+import click
 import pytest
 from click.testing import CliRunner
 from pytest_httpx import IteratorStream
 
-from chainchat import cache, cli
+from chainchat import cache, cli, model
 
 
 @pytest.fixture
@@ -126,6 +128,31 @@ def test_prompt_with_tool(mock_platformdirs, tmp_path, httpx_mock):
         assert result.output == 'The file contains a simple statement: "This is a test file."'
 
 
+def test_prompt_stats(mock_platformdirs, httpx_mock):
+    mock_openai(httpx_mock, "gpt-4o-mini-cutoff.dat")
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(
+        cli.cli,
+        [
+            "chat",
+            "--no-markdown",
+            "--stats",
+            "json",
+            "--prompt",
+            "What is your knowledge cutoff date?",
+            "open-ai",
+            "--model-name",
+            "gpt-4o-mini",
+        ],
+        env={"OPENAI_API_KEY": "XXX"},
+    )
+    assert result.exit_code == 0
+    assert result.output == "My knowledge cutoff date is October 2021."
+    (turn,) = json.loads(result.stderr)["turns"]
+    assert turn["model"] == "gpt-4o-mini"
+    assert turn["time_to_first_token"] is not None
+
+
 def test_prompt_model_preset(tmp_path, mock_platformdirs, httpx_mock, mock_environ):
     assert not (mock_platformdirs / "chainchat.db").exists()
     mock_openai(httpx_mock, "gpt-4o-mini-cutoff.dat", url="https://api.x.ai/v1/chat/completions")
@@ -181,3 +208,113 @@ def test_list_tools(mock_platformdirs, tmp_path):
                 ).fetchone()[0]
                 == 1
             )
+
+
+def test_discovery_fingerprint(mock_platformdirs):
+    commands = model.discover_models()
+    assert "open-ai" in commands
+    with mock.patch.object(model, "find_packages_distributions", side_effect=AssertionError) as scan:
+        assert model.discover_models() == commands
+        scan.assert_not_called()
+    with (
+        mock.patch.object(cache, "installed_fingerprint", return_value="changed"),
+        mock.patch.object(model, "find_packages_distributions", wraps=model.find_packages_distributions) as scan,
+    ):
+        assert model.discover_models() == commands
+        scan.assert_called_once()
+
+
+def test_installed_fingerprint(tmp_path, monkeypatch):
+    site = tmp_path / "site-packages"
+    (site / "pkg-1.0.dist-info").mkdir(parents=True)
+    monkeypatch.setattr("sys.path", ["", str(tmp_path / "src"), str(site)])
+    monkeypatch.chdir(tmp_path)
+    cache.installed_fingerprint.cache_clear()
+    fingerprint = cache.installed_fingerprint()
+    # The current directory and other entries don't install distributions
+    (tmp_path / "src").mkdir()
+    (tmp_path / "new.txt").touch()
+    cache.installed_fingerprint.cache_clear()
+    assert cache.installed_fingerprint() == fingerprint
+    (site / "pkg-2.0.dist-info").mkdir()
+    cache.installed_fingerprint.cache_clear()
+    assert cache.installed_fingerprint() != fingerprint
+    cache.installed_fingerprint.cache_clear()
+
+
+def test_indexed_model_options(monkeypatch):
+    from langchain_openai import ChatOpenAI
+
+    monkeypatch.setenv("OPENAI_API_KEY", "XXX")
+    options = json.loads(model.model_options(ChatOpenAI))
+    command = model.LazyModelGroup().build_indexed_model_command(
+        "open-ai", ChatOpenAI.__module__, ChatOpenAI.__name__, options
+    )
+    # Types and defaults come from the index
+    ctx = command.make_context("open-ai", ["--temperature", "0.5"])
+    assert ctx.params["temperature"] == 0.5
+    assert ctx.params["max_retries"] == 2
+    assert ctx.params["model_name"] == "gpt-3.5-turbo"
+    with pytest.raises(click.BadParameter):
+        command.make_context("open-ai", ["--max-retries", "many"])
+
+    chat_model = command.main(["--temperature", "0.5", "--stop", '["END"]'], standalone_mode=False)
+    assert (chat_model.temperature, chat_model.stop, chat_model.max_retries) == (0.5, ["END"], 2)
+
+
+def test_cache_prune(mock_platformdirs):
+    model.discover_models()
+    with cache.models_execute() as cursor:
+        rows = cursor.execute("SELECT count(*) FROM models").fetchone()[0]
+        cursor.execute("INSERT INTO models VALUES('langchain-openai-0.0.1', 'langchain_openai', 'ChatOpenAI', NULL)")
+        # Repopulating existing rows doesn't duplicate them
+        cursor.execute("INSERT OR IGNORE INTO models SELECT * FROM models")
+
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(cli.cli, ["cache", "prune"])
+    assert result.exit_code == 0
+    assert "models: pruned 1 rows" in result.output
+    with cache.models_execute() as cursor:
+        assert cursor.execute("SELECT count(*) FROM models").fetchone()[0] == rows
+
+
+def test_list_tools_search(mock_platformdirs, tmp_path):
+    runner = CliRunner(mix_stderr=False)
+    result = runner.invoke(cli.cli, ["list-tools", "--search", "read file"])
+    assert result.exit_code == 0
+    assert result.output.splitlines()[0] == "read_file"
+
+    result = runner.invoke(
+        cli.cli, ["chat", "--tool", "raed_file", "--prompt", "hi", "open-ai"], env={"OPENAI_API_KEY": "XXX"}
+    )
+    assert result.exit_code == 2
+    assert "Did you mean read_file" in result.stderr
+
+
+def test_batch(mock_platformdirs, tmp_path, httpx_mock):
+    mock_openai(httpx_mock, "gpt-4o-mini-cutoff.dat")
+    mock_openai(httpx_mock, "gpt-4o-mini-cutoff.dat")
+    runner = CliRunner(mix_stderr=False)
+    prompts = "\n".join(
+        [
+            '{"id": "a", "prompt": "What is your knowledge cutoff date?"}',
+            "not json",
+            "",
+            '{"id": "b", "prompt": "What is your knowledge cutoff date?", "conversation_id": "batch-test"}',
+        ]
+    )
+    result = runner.invoke(
+        cli.cli,
+        ["batch", "--concurrency", "2", "open-ai", "--model-name", "gpt-4o-mini"],
+        input=prompts,
+        env={"OPENAI_API_KEY": "XXX"},
+    )
+    assert result.exit_code == 1
+    assert result.stderr == "1 prompts failed\n"
+    results = [json.loads(line) for line in result.output.splitlines()]
+    assert [r["index"] for r in results] == [0, 1, 2]
+    assert [r.get("id") for r in results] == ["a", None, "b"]
+    assert results[0]["response"] == results[2]["response"] == "My knowledge cutoff date is October 2021."
+    assert "JSONDecodeError" in results[1]["error"]
+    assert results[2]["conversation_id"] == "batch-test"
+    assert all(r["latency"] > 0 for r in results)
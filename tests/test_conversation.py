@@ -0,0 +1,236 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import multiprocessing
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from click.testing import CliRunner
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.graph import START, MessagesState, StateGraph
+
+from chainchat import cli, conversation
+from chainchat.conversation import (
+    DeltaSqliteSaver,
+    close_connections,
+    message_ranges,
+    open_checkpointer,
+    shared_checkpointer,
+)
+
+CONFIG = {"configurable": {"thread_id": "test"}}
+
+
+def echo_graph(checkpointer):
+    graph = StateGraph(state_schema=MessagesState)
+    graph.add_edge(START, "echo")
+    graph.add_node(
+        "echo",
+        lambda state: {
+            "messages": [AIMessage(f"echo {state['messages'][-1].content}", response_metadata={"model_name": "echo-1"})]
+        },
+    )
+    return graph.compile(checkpointer=checkpointer)
+
+
+def chat(checkpointer, turns, start=0, config=CONFIG):
+    graph = echo_graph(checkpointer)
+    for turn in range(start, start + turns):
+        graph.invoke({"messages": [HumanMessage(f"turn {turn}")]}, config)
+    return graph
+
+
+def contents(graph, config=CONFIG):
+    return [message.content for message in graph.get_state(config).values["messages"]]
+
+
+def expected(turns):
+    return [content for turn in range(turns) for content in (f"turn {turn}", f"echo turn {turn}")]
+
+
+def test_message_ranges():
+    assert message_ranges([]) == []
+    assert message_ranges([0, 1, 2, 5, 6, 3]) == [[0, 3], [5, 7], [3, 4]]
+
+
+def test_delta_checkpoints(tmp_path):
+    path = tmp_path / "checkpoint.db"
+    with sqlite3.connect(path, check_same_thread=False) as conn:
+        graph = chat(DeltaSqliteSaver(conn), 10)
+        assert contents(graph) == expected(10)
+        # Each message is stored once, not once per checkpoint
+        assert conn.execute("SELECT count(*) FROM messages").fetchone()[0] == 20
+        history = list(graph.get_state_history(CONFIG))
+        assert [len(state.values.get("messages", [])) for state in history[:3]] == [20, 19, 18]
+
+    # A new saver continues the conversation without storing its messages again
+    with sqlite3.connect(path, check_same_thread=False) as conn:
+        graph = chat(DeltaSqliteSaver(conn), 2, start=10)
+        assert contents(graph) == expected(12)
+        assert conn.execute("SELECT count(*) FROM messages").fetchone()[0] == 24
+
+
+def test_migrate_checkpoints(tmp_path):
+    path = tmp_path / "checkpoint.db"
+    with sqlite3.connect(path, check_same_thread=False) as conn:
+        graph = chat(SqliteSaver(conn), 5)
+        history = [state.values for state in graph.get_state_history(CONFIG)]
+
+    with sqlite3.connect(path, check_same_thread=False) as conn:
+        graph = echo_graph(DeltaSqliteSaver(conn))
+        assert [state.values for state in graph.get_state_history(CONFIG)] == history
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 4
+        assert conn.execute("SELECT count(*) FROM messages").fetchone()[0] == 10
+        graph = chat(graph.checkpointer, 1, start=5)
+        assert contents(graph) == expected(6)
+        assert conn.execute("SELECT count(*) FROM messages").fetchone()[0] == 12
+        assert conn.execute("SELECT title, messages, model FROM conversations").fetchall() == [("turn 0", 12, "echo-1")]
+        assert conn.execute("SELECT count(*) FROM messages_fts WHERE messages_fts MATCH 'echo'").fetchone()[0] == 6
+
+
+def listed(output):
+    return [line.rstrip() for line in output.splitlines()]
+
+
+def test_list_conversations(mock_platformdirs):
+    with open_checkpointer() as checkpointer:
+        chat(checkpointer, 3, config={"configurable": {"thread_id": "first"}})
+        chat(checkpointer, 1, config={"configurable": {"thread_id": "second"}})
+        (created, updated), *_ = checkpointer.conn.execute(
+            "SELECT created, updated FROM conversations WHERE thread_id = 'first'"
+        ).fetchall()
+        assert created < updated
+
+    runner = CliRunner()
+    result = runner.invoke(cli.cli, ["conversations", "list"])
+    assert result.exit_code == 0
+    assert listed(result.output) == ["second: turn 0", "first: turn 0"]
+    result = runner.invoke(cli.cli, ["conversations", "list", "--sort", "messages", "--limit", "1"])
+    assert listed(result.output) == ["first: turn 0"]
+    result = runner.invoke(cli.cli, ["conversations", "list", "--since", "2999-01-01"])
+    assert listed(result.output) == []
+
+
+def test_search_conversations(mock_platformdirs):
+    with open_checkpointer() as checkpointer:
+        chat(checkpointer, 3, config={"configurable": {"thread_id": "first"}})
+        echo_graph(checkpointer).invoke(
+            {"messages": [HumanMessage("Tell me about [bold]sqlite[/bold] full text searching")]},
+            {"configurable": {"thread_id": "second"}},
+        )
+
+    runner = CliRunner()
+    result = runner.invoke(cli.cli, ["conversations", "search", "searches"])
+    assert result.exit_code == 0
+    # Both the human message and its echo match, only the best is listed
+    assert listed(result.output) == ["second: Tell me about [bold]sqlite[/bold] full text searching"]
+    result = runner.invoke(cli.cli, ["conversations", "search", "full sqlite"])
+    assert listed(result.output) == ["second: Tell me about [bold]sqlite[/bold] full text searching"]
+    result = runner.invoke(cli.cli, ["conversations", "search", "turn sqlite"])
+    assert listed(result.output) == []
+    result = runner.invoke(cli.cli, ["conversations", "search", "--limit", "1", "echo turn 2"])
+    assert listed(result.output) == ["first: echo turn 2"]
+
+
+def test_prune_conversations(mock_platformdirs):
+    def count(table, thread_id):
+        return checkpointer.conn.execute(
+            f"SELECT count(*) FROM {table} WHERE thread_id = ?",
+            (thread_id,),
+        ).fetchone()[0]
+
+    with open_checkpointer() as checkpointer:
+        for thread_id in ("first", "second", "third", "fourth"):
+            chat(checkpointer, 3, config={"configurable": {"thread_id": thread_id}})
+        checkpointer.conn.execute("UPDATE conversations SET updated = '2000-01-01' WHERE thread_id = 'third'")
+        checkpointer.conn.commit()
+        assert count("checkpoints", "first") == 3 * 3
+
+    runner = CliRunner()
+    result = runner.invoke(cli.cli, ["conversations", "prune"])
+    assert result.exit_code == 2
+    result = runner.invoke(cli.cli, ["conversations", "prune", "--latest-only", "--older-than", "30"])
+    assert result.exit_code == 0
+    assert listed(result.output) == [
+        "conversations: deleted 1 not updated recently",
+        "checkpoints: deleted 24 older checkpoints",
+    ]
+    result = runner.invoke(cli.cli, ["conversations", "delete", "second", "missing"])
+    assert listed(result.output) == ["conversations: deleted 1"]
+    assert listed(runner.invoke(cli.cli, ["conversations", "list"]).output) == ["fourth: turn 0", "first: turn 0"]
+
+    with open_checkpointer() as checkpointer:
+        assert contents(echo_graph(checkpointer), {"configurable": {"thread_id": "first"}}) == expected(3)
+        assert count("checkpoints", "first") == 1
+        assert count("writes", "first") == 0
+        assert count("messages", "first") == 6
+        for thread_id in ("second", "third"):
+            for table in ("checkpoints", "writes", "checkpoint_messages", "messages", "conversations"):
+                assert count(table, thread_id) == 0
+    result = runner.invoke(cli.cli, ["conversations", "search", "turn"])
+    assert sorted(listed(result.output)) == ["first: turn 0", "fourth: turn 0"]
+
+    result = runner.invoke(cli.cli, ["conversations", "prune", "--max-size", "0"])
+    assert listed(result.output) == ["conversations: deleted 2 to fit size"]
+    result = runner.invoke(cli.cli, ["conversations", "vacuum"])
+    assert result.exit_code == 0
+    before, after = (int(size) for size in result.output.split()[1:4:2])
+    assert after < before
+
+
+def test_prune_to_size(mock_platformdirs):
+    with open_checkpointer() as checkpointer:
+        for i in range(30):
+            chat(checkpointer, 2, config={"configurable": {"thread_id": f"thread-{i:02}"}})
+        # Just over the limit, only the oldest conversation needs deleting
+        assert checkpointer.prune_to_size(checkpointer.used_bytes() - 1) == 1
+        assert checkpointer.prune_to_size(checkpointer.used_bytes() - 1) == 1
+        assert checkpointer.prune_to_size(checkpointer.used_bytes()) == 0
+        remaining = checkpointer.conn.execute("SELECT thread_id FROM conversations ORDER BY updated").fetchall()
+        assert [row[0] for row in remaining] == [f"thread-{i:02}" for i in range(2, 30)]
+
+
+def write_conversation(thread_id, turns):
+    try:
+        chat(shared_checkpointer(), turns, config={"configurable": {"thread_id": thread_id}})
+    finally:
+        close_connections()
+
+
+def test_concurrent_processes(monkeypatch, tmp_path):
+    # Spawned processes find the database through the environment, not the patched platformdirs
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=write_conversation, args=(f"thread-{i}", 20)) for i in range(8)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 8
+
+    with open_checkpointer() as checkpointer:
+        assert checkpointer.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        for i in range(8):
+            config = {"configurable": {"thread_id": f"thread-{i}"}}
+            assert contents(echo_graph(checkpointer), config) == expected(20)
+        assert checkpointer.conn.execute("SELECT count(*) FROM conversations").fetchone()[0] == 8
+
+
+def test_shared_checkpointer_threads(mock_platformdirs, monkeypatch):
+    def slow_connect(path):
+        time.sleep(0.05)
+        return connect(path)
+
+    connect = conversation.connect
+    monkeypatch.setattr(conversation, "connect", slow_connect)
+    close_connections()
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            checkpointers = list(executor.map(lambda _: shared_checkpointer(), range(8)))
+        assert len({id(checkpointer.conn) for checkpointer in checkpointers}) == 1
+        assert len({id(checkpointer.lock) for checkpointer in checkpointers}) == 1
+        assert len(conversation.connections) == 1
+    finally:
+        close_connections()
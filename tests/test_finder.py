@@ -1,12 +1,102 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import textwrap
+
 from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.tools import BaseTool
 
-from chainchat.finder import find_package_classes
+from chainchat import model, tool
+from chainchat.finder import StaticFinder, find_package_classes, scan_packages
 
 
 def test_find_package_classes():
     assert {"AzureChatOpenAI", "ChatOpenAI"} == set(
         c.__name__ for c in find_package_classes("langchain_openai", BaseChatModel)
     )
+
+
+def test_scan_packages(capsys):
+    results = scan_packages(model.scan_package, ["langchain_openai", "chainchat_nonexistent"])
+    assert list(results.keys()) == ["langchain_openai"]
+    assert {"AzureChatOpenAI", "ChatOpenAI"} == set(m["class"] for m in results["langchain_openai"])
+    # Options are indexed with the models
+    assert all(m["options"] is not None for m in results["langchain_openai"])
+    assert "Failed to scan chainchat_nonexistent" in capsys.readouterr().err
+
+
+def test_static_find_classes():
+    assert set(StaticFinder().find_classes("langchain_openai", BaseChatModel)) == set(
+        (c.__module__, c.__name__) for c in find_package_classes("langchain_openai", BaseChatModel)
+    )
+
+
+def test_static_find_lazy_classes(tmp_path, monkeypatch):
+    package = tmp_path / "chainchat_static_tools"
+    package.mkdir()
+    (package / "__init__.py").write_text(
+        textwrap.dedent(
+            """
+            from typing import TYPE_CHECKING
+
+            if TYPE_CHECKING:
+                from .base import Named
+            __all__ = ["Named", "Derived", "Computed", "NotATool"]
+            _module_lookup = {
+                "Derived": "chainchat_static_tools.derived",
+                "Computed": "chainchat_static_tools.derived",
+                "NotATool": "chainchat_static_tools.derived",
+            }
+            """
+        )
+    )
+    (package / "base.py").write_text(
+        textwrap.dedent(
+            """
+            from langchain_core import tools
+            from pydantic import Field
+
+            class Named(tools.BaseTool):
+                name: str = "named"
+                description: str = Field(default="A named tool")
+            """
+        )
+    )
+    (package / "derived.py").write_text(
+        textwrap.dedent(
+            """
+            from . import base
+
+            class Derived(base.Named):
+                description: str = "A derived tool"
+
+            class Computed(Derived):
+                name: str = "computed".upper()
+
+            class NotATool:
+                name = "not a tool"
+            """
+        )
+    )
+    monkeypatch.syspath_prepend(tmp_path)
+
+    finder = StaticFinder()
+    refs = finder.find_classes("chainchat_static_tools", BaseTool)
+    assert refs == [
+        ("chainchat_static_tools.base", "Named"),
+        ("chainchat_static_tools.derived", "Derived"),
+        ("chainchat_static_tools.derived", "Computed"),
+    ]
+    assert finder.field_defaults(refs[0], ("name", "description")) == {
+        "name": "named",
+        "description": "A named tool",
+    }
+    assert finder.field_defaults(refs[1], ("name", "description")) == {
+        "name": "named",
+        "description": "A derived tool",
+    }
+    assert finder.field_defaults(refs[2], ("name", "description")) is None
+    # Non literal defaults are read by importing the class
+    assert {"module": "chainchat_static_tools.derived", "class": "Computed", "name": "COMPUTED"} in [
+        {k: v for k, v in row.items() if k != "description"} for row in tool.scan_package("chainchat_static_tools")
+    ]
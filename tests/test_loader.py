@@ -1,13 +1,16 @@
 # Copyright (C) 2024 Andrew Wason
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import httpx
 import pydantic
 import pytest
 import yaml
 from langchain_core.language_models.chat_models import BaseChatModel
 
-from chainchat import trace
+from chainchat import httpclient, trace
 from chainchat.loader import LazyLoader
 
 
@@ -83,6 +86,76 @@ def test_load_httplog(tmp_path):
     assert isinstance(model["kwargs"]["client"], trace.HttpLogClient)
 
 
+def test_load_http_client(tmp_path, monkeypatch):
+    monkeypatch.setattr(httpclient, "client_configs", {})
+    monkeypatch.setattr(httpclient, "clients", {})
+    yaml_file = tmp_path / "test.yaml"
+    yaml_content = """
+    models:
+      model1: !pydantic:tests.test_loader.BaseTestChatModel
+        client: !http_client pooled
+      model2: !pydantic:tests.test_loader.BaseTestChatModel
+        client: !http_client pooled
+      model3: !pydantic:tests.test_loader.BaseTestChatModel
+        client: !http_client
+      model4: !pydantic:tests.test_loader.BaseTestChatModel
+        client: !http_client unknown
+      model5: !pydantic:tests.test_loader.BaseTestChatModel
+        client: !http_client
+          name: pooled
+          max_connections: 20
+    http_clients:
+      pooled:
+        max_connections: 10
+        timeout: 30
+    """
+    yaml_file.write_text(yaml_content)
+
+    # Only the referencing preset is loaded, the client section is configured first
+    loader = LazyLoader(str(yaml_file))
+    client = loader.load_pydantic("models", "model2")["kwargs"]["client"]
+    assert client.timeout.read == 30
+    assert httpclient.client_configs["pooled"].max_connections == 10
+    assert loader.load_pydantic("models", "model1")["kwargs"]["client"] is client
+    assert httpclient.shared_client("pooled") is client
+    assert loader.load_pydantic("models", "model3")["kwargs"]["client"] is httpclient.shared_client()
+    with pytest.raises(yaml.YAMLError, match="Unknown HTTP client unknown"):
+        loader.load_pydantic("models", "model4")
+    with pytest.raises(yaml.YAMLError, match="referenced by name"):
+        loader.load_pydantic("models", "model5")
+
+
+def test_load_invalid_http_client(tmp_path, monkeypatch):
+    monkeypatch.setattr(httpclient, "client_configs", {})
+    yaml_file = tmp_path / "test.yaml"
+    yaml_content = """
+    http_clients:
+      pooled:
+        bogus: 1
+    models:
+      model1: !pydantic:tests.test_loader.BaseTestChatModel
+    """
+    yaml_file.write_text(yaml_content)
+
+    loader = LazyLoader(str(yaml_file))
+    with pytest.raises(yaml.YAMLError, match="Invalid HTTP client pooled"):
+        loader.load_pydantic("models", "model1")
+
+
+def test_shared_client_threads(monkeypatch):
+    class SlowClient(httpx.Client):
+        def __init__(self, **kwargs):
+            time.sleep(0.05)
+            super().__init__(**kwargs)
+
+    monkeypatch.setattr(httpclient, "client_configs", {})
+    monkeypatch.setattr(httpclient, "clients", {})
+    monkeypatch.setattr(httpx, "Client", SlowClient)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: httpclient.shared_client("threaded"), range(8)))
+    assert len({id(client) for client in clients}) == 1
+
+
 def test_env_var(monkeypatch):
     yaml_content = """
     config:
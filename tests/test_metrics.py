@@ -0,0 +1,85 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import time
+
+import pytest
+from langchain_community.tools import ReadFileTool
+from langchain_core.messages import AIMessage
+from langchain_openai import ChatOpenAI
+
+from chainchat.chat import Chat
+from chainchat.metrics import MetricsHandler, StatsFormat
+from chainchat.render import arender_text
+from chainchat.tool import ConcurrentToolNode
+
+from .test_cli import mock_openai
+from .test_tool import sleeper
+
+
+def test_metrics(httpx_mock, mock_platformdirs, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "simple.txt").write_text("This is a test file.")
+    mock_openai(httpx_mock, "gpt-4o-mini-tool1.dat")
+    mock_openai(httpx_mock, "gpt-4o-mini-tool2.dat")
+    metrics = MetricsHandler()
+    chat = Chat(
+        ChatOpenAI(model_name="gpt-4o-mini", openai_api_key="XXX"),
+        tools=[ReadFileTool()],
+        conversation_id="test",
+        metrics=metrics,
+    )
+    asyncio.run(chat.aprompt("Summarize the file ./simple.txt", arender_text))
+
+    stats = metrics.to_json()
+    assert [turn["model"] for turn in stats["turns"]] == ["gpt-4o-mini", "gpt-4o-mini"]
+    for turn in stats["turns"]:
+        assert 0 <= turn["time_to_first_token"] <= turn["duration"]
+        assert turn["chunks"] > 0
+        assert not turn["error"]
+    assert [tool["name"] for tool in stats["tools"]] == ["read_file"]
+    assert stats["checkpoints"]["saves"] > 0
+    latency = stats["inter_token_latency"]
+    assert latency["count"] == sum(turn["chunks"] - 1 for turn in stats["turns"])
+    assert latency["buckets"][-1] == ["+Inf", latency["count"]]
+
+    openmetrics = metrics.format(StatsFormat.OPENMETRICS)
+    assert 'chainchat_time_to_first_token_seconds{turn="1",model="gpt-4o-mini"}' in openmetrics
+    assert f'chainchat_inter_token_latency_seconds_bucket{{le="+Inf"}} {latency["count"]}' in openmetrics
+    assert 'tool="read_file"' in openmetrics
+    assert openmetrics.endswith("# EOF\n")
+
+    summary = metrics.format(StatsFormat.SUMMARY).splitlines()
+    assert summary[0].startswith("turn 1 gpt-4o-mini: first token ")
+    assert summary[2].startswith("inter-token latency: ")
+    assert summary[3].startswith("tool read_file: ")
+    assert summary[4].startswith("checkpoints: ")
+
+
+@pytest.mark.parametrize("run_async", [False, True])
+def test_metrics_tool_timeout(run_async):
+    timeout = 0.25
+    tool_calls = AIMessage(
+        content="",
+        tool_calls=[
+            {"name": "sleeper", "args": {"seconds": seconds}, "id": f"call{i}"} for i, seconds in enumerate([0.5, 0.1])
+        ],
+    )
+    metrics = MetricsHandler()
+    node = ConcurrentToolNode([sleeper], max_concurrency=4, timeout=timeout)
+    config = {"callbacks": [metrics], "configurable": {}}
+    if run_async:
+        asyncio.run(node.ainvoke({"messages": [tool_calls]}, config))
+    else:
+        node.invoke({"messages": [tool_calls]}, config)
+    # Let the abandoned call finish, its late end isn't recorded again
+    time.sleep(0.4)
+    # The 0.5s call timed out, the other finished
+    assert len(metrics.tools) == 2
+    assert sum(tool.error for tool in metrics.tools) == 1
+    (timed_out,) = (tool for tool in metrics.tools if tool.error)
+    assert timed_out.name == "sleeper"
+    # Timed from the tool start, which is a little after the timeout starts
+    assert timeout / 2 < timed_out.duration < timeout + 1
+    assert not metrics.active_tools
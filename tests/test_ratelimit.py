@@ -0,0 +1,175 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import textwrap
+import time
+
+import httpx
+import pytest
+import yaml
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_openai import ChatOpenAI
+
+from chainchat.chat import Chat
+from chainchat.loader import LazyLoader
+from chainchat.model import LazyModelGroup
+from chainchat.ratelimit import RetryPolicy, TokenBucketRateLimiter, shared_rate_limiter
+from chainchat.render import arender_text, render_text
+
+from .test_cli import mock_openai
+
+
+def rate_limited(headers):
+    return httpx.HTTPStatusError(
+        "Too Many Requests",
+        request=httpx.Request("POST", "https://example.com"),
+        response=httpx.Response(429, headers=headers),
+    )
+
+
+@pytest.mark.parametrize(
+    "headers,delay",
+    [
+        ({"retry-after": "2"}, 2),
+        ({"retry-after-ms": "1500"}, 1.5),
+        ({"retry-after": "120"}, 60),
+    ],
+)
+def test_retry_after(headers, delay):
+    assert RetryPolicy().delay(1, rate_limited(headers)) == delay
+
+
+def test_retry_policy():
+    policy = RetryPolicy(max_attempts=3, base_delay=1)
+    assert 0 <= policy.delay(2, rate_limited({})) <= 2
+    assert policy.delay(3, rate_limited({})) is None
+    assert policy.delay(1, ValueError()) is None
+
+
+def test_requests_per_second():
+    limiter = TokenBucketRateLimiter(requests_per_second=20)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_tokens_per_minute():
+    limiter = TokenBucketRateLimiter(tokens_per_minute=6000)
+    assert limiter.acquire(blocking=False)
+    limiter.record_usage(7000)
+    assert not limiter.acquire(blocking=False)
+
+
+def test_throttle():
+    limiter = TokenBucketRateLimiter(requests_per_second=10, max_burst=10)
+    limiter.throttle(60)
+    assert not limiter.acquire(blocking=False)
+    assert limiter.rate == 5
+
+
+def test_preset_rate_limit(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "XXX")
+    presets = tmp_path / "models.yaml"
+    presets.write_text(
+        textwrap.dedent(
+            """
+            models:
+              limited: !pydantic:langchain_openai.ChatOpenAI
+                model_name: gpt-4o-mini
+                rate_limiter: !rate_limit
+                  name: openai
+                  requests_per_second: 5
+                  tokens_per_minute: 100000
+                  max_retries: 2
+              invalid: !pydantic:langchain_openai.ChatOpenAI
+                rate_limiter: !rate_limit
+                  requests_per_minute: 5
+            """
+        )
+    )
+    loader = LazyLoader(str(presets))
+    rate_limiter = loader.load_pydantic("models", "limited")["kwargs"]["rate_limiter"]
+    assert rate_limiter is shared_rate_limiter("openai", 5, 100000, max_retries=2)
+    assert rate_limiter.retry.max_attempts == 3
+    with pytest.raises(yaml.YAMLError):
+        loader.load_pydantic("models", "invalid")
+    # Chat retries rate limited models, so the SDK doesn't
+    command = LazyModelGroup().build_preset_model_command(loader, "preset-limited")
+    model = command.main([], standalone_mode=False)
+    assert model.rate_limiter is rate_limiter
+    assert model.max_retries == 0
+
+
+def test_retry_rate_limited(httpx_mock):
+    httpx_mock.add_response(method="POST", status_code=429, headers={"retry-after": "0.1"}, json={})
+    mock_openai(httpx_mock, "gpt-4o-mini-cutoff.dat")
+    rate_limiter = TokenBucketRateLimiter(requests_per_second=10, max_burst=2)
+    chat = Chat(ChatOpenAI(model_name="gpt-4o-mini", openai_api_key="XXX", max_retries=0, rate_limiter=rate_limiter))
+    assert (
+        chat.prompt("What is your knowledge cutoff date?", render_text) == "My knowledge cutoff date is October 2021."
+    )
+    assert len(httpx_mock.get_requests()) == 2
+    assert rate_limiter.rate < 10
+
+
+def test_aretry_rate_limited(httpx_mock):
+    httpx_mock.add_response(method="POST", status_code=429, headers={"retry-after": "0.1"}, json={})
+    mock_openai(httpx_mock, "gpt-4o-mini-cutoff.dat")
+    chat = Chat(ChatOpenAI(model_name="gpt-4o-mini", openai_api_key="XXX", max_retries=0), retry=RetryPolicy())
+    result = asyncio.run(chat.aprompt("What is your knowledge cutoff date?", arender_text))
+    assert result == "My knowledge cutoff date is October 2021."
+
+
+def test_retry_exhausted(httpx_mock):
+    httpx_mock.add_response(method="POST", status_code=429, headers={"retry-after": "0"}, json={})
+    httpx_mock.add_response(method="POST", status_code=429, headers={"retry-after": "0"}, json={})
+    chat = Chat(ChatOpenAI(model_name="gpt-4o-mini", openai_api_key="XXX", max_retries=0), retry=RetryPolicy(2))
+    with pytest.raises(Exception, match="429"):
+        chat.prompt("What is your knowledge cutoff date?", render_text)
+
+
+def test_no_retry_policy(httpx_mock):
+    httpx_mock.add_response(method="POST", status_code=429, headers={"retry-after": "0"}, json={})
+    chat = Chat(ChatOpenAI(model_name="gpt-4o-mini", openai_api_key="XXX", max_retries=0))
+    with pytest.raises(Exception, match="429"):
+        chat.prompt("What is your knowledge cutoff date?", render_text)
+    assert len(httpx_mock.get_requests()) == 1
+
+
+class FailingModel(GenericFakeChatModel):
+    """Streams chunks tokens before failing with a 503 the first time."""
+
+    chunks: int = 0
+    calls: int = 0
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            for i in range(self.chunks):
+                chunk = AIMessageChunk(content=f"partial{i} ")
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.content, chunk=chunk)
+                yield ChatGenerationChunk(message=chunk)
+            raise httpx.HTTPStatusError(
+                "Service Unavailable",
+                request=httpx.Request("POST", "https://example.com"),
+                response=httpx.Response(503),
+            )
+        yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+@pytest.mark.parametrize("chunks,calls", [(0, 2), (2, 1)])
+def test_retry_streamed(chunks, calls):
+    model = FailingModel(messages=iter([AIMessage("complete")]), chunks=chunks)
+    chat = Chat(model, retry=RetryPolicy(base_delay=0))
+    if chunks:
+        # Retrying would render the partial response again
+        with pytest.raises(httpx.HTTPStatusError):
+            chat.prompt("hello", render_text)
+    else:
+        assert chat.prompt("hello", render_text) == "complete"
+    assert model.calls == calls
@@ -0,0 +1,68 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import random
+
+import pytest
+from rich.console import Console
+from rich.live import Live
+from rich.markdown import Markdown
+
+from chainchat import render
+
+MARKDOWN = """\
+# Heading
+
+Some *emphasis* and **strong** text
+that continues on a second line.
+
+- item one
+- item two
+
+  continued item two
+
+1. first
+2. second
+
+---
+After the rule.
+
+```python
+def hello():
+
+    print("hello")
+```
+
+> quoted
+> text
+
+| a | b |
+|---|---|
+| 1 | 2 |
+
+Final paragraph."""
+
+
+def make_console() -> Console:
+    return Console(width=80, force_terminal=False, color_system=None, record=True)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_render_markdown_incremental(monkeypatch, seed):
+    # Final frame of a single full document render
+    expected_console = make_console()
+    with Live(auto_refresh=False, console=expected_console) as live:
+        live.update(Markdown(MARKDOWN), refresh=True)
+
+    console = make_console()
+    monkeypatch.setattr(render, "console", console)
+    rng = random.Random(seed)
+    chunks = []
+    i = 0
+    while i < len(MARKDOWN):
+        n = rng.randint(1, 12)
+        chunks.append(MARKDOWN[i : i + n])
+        i += n
+
+    assert render.render_markdown(iter(chunks), refresh_per_second=0) == MARKDOWN
+    assert console.export_text() == expected_console.export_text()
@@ -0,0 +1,80 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Generous cumulative import time budget for the cli module, in microseconds
+IMPORT_BUDGET_US = 1_000_000
+
+HEAVY_MODULES = {
+    "langchain_core",
+    "langgraph",
+    "httpx",
+    "pydanclick",
+    "pydantic",
+    "yaml",
+    "rich.markdown",
+    "rich.live",
+    "readline",
+}
+
+
+def imported_modules(env: dict[str, str], *args: str) -> dict[str, int]:
+    """Run the cli with args under -X importtime, return cumulative import time by module."""
+    stderr = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import sys; from chainchat.cli import cli; cli(sys.argv[1:])",
+            *args,
+        ],
+        env=os.environ | env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+@pytest.mark.parametrize(
+    "args,extra_forbidden",
+    [
+        (["--help"], {"dotenv"}),
+        (["conversations", "--help"], set()),
+        (["list-tools", "--help"], set()),
+    ],
+)
+def test_startup_imports(tmp_path, args, extra_forbidden):
+    modules = imported_modules({"XDG_CACHE_HOME": str(tmp_path)}, *args)
+    forbidden = HEAVY_MODULES | extra_forbidden
+    assert not {name for name in modules if name in forbidden or name.split(".")[0] in forbidden}
+    assert modules["chainchat.cli"] < IMPORT_BUDGET_US
+
+
+def test_model_help_imports(tmp_path):
+    env = {"XDG_CACHE_HOME": str(tmp_path)}
+    # The first run populates the model index, including the command options
+    imported_modules(env, "chat", "--help")
+    modules = imported_modules(env, "chat", "open-ai", "--help")
+    assert not {name for name in modules if name.split(".")[0] in {"langchain_openai", "pydanclick"}}
+
+
+def test_list_conversations_imports(tmp_path):
+    env = {"XDG_CACHE_HOME": str(tmp_path), "XDG_DATA_HOME": str(tmp_path)}
+    # The first run creates the checkpoint database
+    imported_modules(env, "conversations", "list")
+    modules = imported_modules(env, "conversations", "list")
+    assert not {name for name in modules if name.split(".")[0] in {"langgraph", "langchain_core"}}
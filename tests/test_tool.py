@@ -0,0 +1,146 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import gc
+import inspect
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from unittest import mock
+
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.tools import tool
+from langchain_openai import ChatOpenAI
+from langgraph.prebuilt import ToolNode
+
+from chainchat import tool as chainchat_tool
+from chainchat.tool import ConcurrentToolNode, bind_tools, create_tools
+
+running = 0
+max_running = 0
+lock = threading.Lock()
+
+
+@tool
+def sleeper(seconds: float) -> str:
+    """Sleep for the specified seconds."""
+    global running, max_running
+    with lock:
+        running += 1
+        max_running = max(max_running, running)
+    time.sleep(seconds)
+    with lock:
+        running -= 1
+    return f"slept {seconds}"
+
+
+@pytest.fixture
+def tool_calls():
+    global max_running
+    max_running = 0
+    return AIMessage(
+        content="",
+        tool_calls=[
+            {"name": "sleeper", "args": {"seconds": seconds}, "id": f"call{i}"}
+            for i, seconds in enumerate([0.3, 0.1, 0.2, 0.1])
+        ],
+    )
+
+
+def check_messages(messages, timed_out=()):
+    assert [m.tool_call_id for m in messages] == ["call0", "call1", "call2", "call3"]
+    for m, seconds in zip(messages, [0.3, 0.1, 0.2, 0.1], strict=True):
+        if m.tool_call_id in timed_out:
+            assert m.status == "error"
+            assert "timed out" in m.content
+        else:
+            assert m.content == f"slept {seconds}"
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 2, 4])
+def test_tool_concurrency(tool_calls, max_concurrency):
+    node = ConcurrentToolNode([sleeper], max_concurrency=max_concurrency)
+    check_messages(node.invoke({"messages": [tool_calls]})["messages"])
+    assert max_running == max_concurrency
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 2, 4])
+def test_tool_concurrency_async(tool_calls, max_concurrency):
+    node = ConcurrentToolNode([sleeper], max_concurrency=max_concurrency)
+    check_messages(asyncio.run(node.ainvoke({"messages": [tool_calls]}))["messages"])
+    assert max_running == max_concurrency
+
+
+def test_tool_timeout(tool_calls):
+    timeout = 0.25
+    node = ConcurrentToolNode([sleeper], max_concurrency=4, timeout=timeout)
+    start = time.monotonic()
+    check_messages(node.invoke({"messages": [tool_calls]})["messages"], timed_out={"call0"})
+    # Loose bound so loaded machines don't fail, the timed out message is what matters
+    assert time.monotonic() - start < timeout + 1
+
+
+def test_tool_timeout_async(tool_calls):
+    node = ConcurrentToolNode([sleeper], max_concurrency=4, timeout=0.25)
+    check_messages(asyncio.run(node.ainvoke({"messages": [tool_calls]}))["messages"], timed_out={"call0"})
+
+
+def test_tool_node_private_api():
+    # ConcurrentToolNode overrides and calls private ToolNode methods, langgraph is pinned so they don't change.
+    # This fails if an upgrade changes them
+    def parameters(method):
+        return [
+            f"*{p.name}" if p.kind is inspect.Parameter.KEYWORD_ONLY else p.name
+            for p in inspect.signature(method).parameters.values()
+        ]
+
+    for name, expected in (
+        ("_func", ["self", "input", "config", "*store"]),
+        ("_afunc", ["self", "input", "config", "*store"]),
+        ("_run_one", ["self", "call", "config"]),
+        ("_arun_one", ["self", "call", "config"]),
+    ):
+        assert parameters(getattr(ToolNode, name)) == expected
+        assert parameters(getattr(ConcurrentToolNode, name)) == expected
+    assert parameters(ToolNode._parse_input) == ["self", "input", "store"]
+
+
+def test_tool_registry(mock_platformdirs):
+    tools = create_tools(("read_file", "write_file"), ("langchain_community.tools",))
+    assert all(
+        a is b for a, b in zip(tools, create_tools(("read_file",), ("langchain_community.tools",)), strict=False)
+    )
+
+    with mock.patch.object(
+        chainchat_tool, "convert_to_openai_tool", wraps=chainchat_tool.convert_to_openai_tool
+    ) as convert:
+        chat_model = ChatOpenAI(model="gpt-4o-mini", api_key="KEY-A")
+        model = bind_tools(chat_model, tools)
+        assert bind_tools(chat_model, tools) is model
+        # Another instance differing only in unserialized settings gets its own bound model
+        other = bind_tools(ChatOpenAI(model="gpt-4o-mini", api_key="KEY-B"), tools)
+        assert other is not model
+        assert other.bound.openai_api_key.get_secret_value() == "KEY-B"
+        assert convert.call_count <= len(tools)
+    # Bound models are only shared while in use
+    other_ref = weakref.ref(other)
+    del other
+    gc.collect()
+    assert other_ref() is None
+    assert any(bound is model for bound in chainchat_tool.bound_models.values())
+    assert [t["function"]["name"] for t in model.kwargs["tools"]] == ["read_file", "write_file"]
+
+
+def test_tool_instances_evicted(monkeypatch):
+    from langchain_community.tools import ReadFileTool
+
+    monkeypatch.setattr(chainchat_tool, "MAX_TOOL_INSTANCES", 1)
+    monkeypatch.setattr(chainchat_tool, "tool_instances", OrderedDict())
+    read_file = chainchat_tool.tool_instance(ReadFileTool, root_dir="a")
+    assert chainchat_tool.tool_instance(ReadFileTool, root_dir="a") is read_file
+    assert chainchat_tool.tool_instance(ReadFileTool, root_dir="b") is not read_file
+    assert len(chainchat_tool.tool_instances) == 1
+    assert chainchat_tool.tool_instance(ReadFileTool, root_dir="a") is not read_file
@@ -0,0 +1,74 @@
+# Copyright (C) 2024 Andrew Wason
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import pathlib
+
+import httpx
+import pytest
+from langchain_openai import ChatOpenAI
+
+from chainchat import trace
+from chainchat.chat import Chat
+from chainchat.render import arender_text
+
+FIXTURES = pathlib.Path(__file__).parent / "fixtures"
+
+
+def test_replay_fixture(capsys):
+    transport = trace.ReplayTransport(FIXTURES / "gpt-4o-mini-cutoff.dat")
+    model = ChatOpenAI(
+        model_name="gpt-4o-mini", openai_api_key="XXX", http_async_client=httpx.AsyncClient(transport=transport)
+    )
+    result = asyncio.run(Chat(model).aprompt("What is your knowledge cutoff date?", arender_text))
+    assert result == "My knowledge cutoff date is October 2021."
+    with pytest.raises(httpx.TransportError):
+        httpx.Client(transport=transport).get("https://api.openai.com/v1/models")
+
+
+@pytest.mark.parametrize("suffix", ["dat", "gz", "zst"])
+def test_record_replay(tmp_path, suffix):
+    if suffix == "zst":
+        # Optional, not a declared dependency
+        pytest.importorskip("zstandard")
+    path = tmp_path / f"trace.{suffix}"
+    recorder = trace.TraceRecorder(path)
+    transport = trace.RecordTransport(trace.ReplayTransport(FIXTURES / "gpt-4o-mini-tool1.dat"), recorder)
+    with (
+        httpx.Client(transport=transport) as client,
+        client.stream("POST", "https://api.openai.com/v1/chat/completions", json={"model": "gpt-4o-mini"}) as response,
+    ):
+        recorded = list(response.iter_raw())
+    recorder.close()
+
+    (exchange,) = trace.read_trace(path)
+    assert exchange.request == {
+        "method": "POST",
+        "url": "https://api.openai.com/v1/chat/completions",
+        "content": '{"model": "gpt-4o-mini"}',
+    }
+    assert exchange.status_code == 200
+    assert ("content-type", "text/event-stream") in exchange.headers
+    assert [chunk for _, chunk in exchange.chunks] == recorded
+    assert exchange.response_delay >= 0
+    assert all(delay >= 0 for delay, _ in exchange.chunks)
+
+    with httpx.Client(transport=trace.ReplayTransport(path, realtime=True)) as client:
+        assert b"".join(recorded) == client.post("https://api.openai.com/v1/chat/completions").content
+
+
+@pytest.mark.parametrize(
+    "partial", [b"\x03\x01", trace.RECORD_HEADER.pack(trace.RecordKind.CHUNK, 1, 1.0, 100) + b"data"]
+)
+def test_read_truncated_trace(tmp_path, partial):
+    path = tmp_path / "trace.dat"
+    recorder = trace.TraceRecorder(path)
+    transport = trace.RecordTransport(trace.ReplayTransport(FIXTURES / "gpt-4o-mini-cutoff.dat"), recorder)
+    with httpx.Client(transport=transport) as client:
+        client.post("https://api.openai.com/v1/chat/completions")
+    recorder.close()
+    complete = trace.read_trace(path)
+    # A recorder killed while writing leaves a partial header or payload
+    with open(path, "ab") as f:
+        f.write(partial)
+    assert trace.read_trace(path) == complete